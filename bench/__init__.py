@@ -0,0 +1,5 @@
+"""
+Benchmarks of seltest's own overhead, which run without a browser or network.
+
+Run from the root of the repository with `python -m bench`.
+"""
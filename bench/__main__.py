@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark seltest's own overhead. Run with `python -m bench`.
+
+Usage:
+  bench [options]
+
+Options:
+  -h --help              Show this screen.
+  -o FILE --output FILE  Write results to FILE as JSON, as well as printing
+                         them.
+  --compare FILE         Compare median times against the results in FILE,
+                         exiting with an error if any are slower by more than
+                         the threshold.
+  --threshold RATIO      How much slower a result may be than in --compare's
+                         FILE before it's a regression. Defaults to 0.25.
+  --only NAMES           Comma-separated list of the benchmarks to run, of
+                         proxy, images and waits. Defaults to all of them.
+  --repeat N             Times to repeat each measurement. Defaults to 20.
+  --page-kb KB           Size of the fixture page. Defaults to 50.
+  --assets N             Number of assets on the fixture page. Defaults to 20.
+  --asset-kb KB          Size of each asset on the fixture page. Defaults to
+                         10.
+  --threads N            Concurrent clients for proxy throughput. Defaults
+                         to 4.
+  --latency MS           Time each call to the fake WebDriver takes. Defaults
+                         to 2.
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+
+import docopt
+
+import json
+import platform
+import sys
+
+import seltest
+from seltest.helpers import atomic_write
+
+from bench import benchmarks
+
+
+BENCHMARKS = ('proxy', 'images', 'waits')
+
+
+def _run(args):
+    """
+    Yield the results of the benchmarks selected by args.
+    """
+    repeat = int(args['--repeat'] or 20)
+    only = (args['--only'] or ','.join(BENCHMARKS)).split(',')
+    unknown = set(only) - set(BENCHMARKS)
+    if unknown:
+        sys.exit('No benchmarks named {}'.format(', '.join(sorted(unknown))))
+    if 'proxy' in only:
+        for r in benchmarks.bench_proxy(
+                repeat,
+                page_kb=int(args['--page-kb'] or 50),
+                assets=int(args['--assets'] or 20),
+                asset_kb=int(args['--asset-kb'] or 10),
+                threads=int(args['--threads'] or 4)):
+            yield r
+    if 'images' in only:
+        for r in benchmarks.bench_images(repeat):
+            yield r
+    if 'waits' in only:
+        for r in benchmarks.bench_waits(max(1, repeat // 4),
+                                        float(args['--latency'] or 2)):
+            yield r
+        for r in benchmarks.bench_idle(max(1, repeat // 4)):
+            yield r
+
+
+def _key(result):
+    params = ','.join('{}={}'.format(k, v)
+                      for k, v in sorted(result['params'].items()))
+    return '{}[{}]'.format(result['name'], params)
+
+
+def _print_result(result):
+    if 'median_ms' in result:
+        summary = 'median {median_ms:.2f}ms, p95 {p95_ms:.2f}ms'.format(
+            **result)
+        if 'driver_calls' in result:
+            summary += ', {} driver calls'.format(result['driver_calls'])
+    else:
+        summary = '{requests_per_s:.0f} req/s, {mb_per_s:.1f} MB/s'.format(
+            **result)
+    print('{:<72} {}'.format(_key(result), summary))
+    sys.stdout.flush()
+
+
+def _regressions(results, baseline, threshold):
+    """
+    Return list of descriptions of results slower than those in baseline (a
+    previous run's output) by more than threshold.
+    """
+    previous = dict((_key(r), r) for r in baseline['results'])
+    regressions = []
+    for result in results:
+        old = previous.get(_key(result))
+        if old is None:
+            continue
+        if 'median_ms' in result and 'median_ms' in old:
+            ratio = result['median_ms'] / max(old['median_ms'], 1e-6)
+            if ratio > 1 + threshold:
+                regressions.append('{}: {:.2f}ms -> {:.2f}ms'.format(
+                    _key(result), old['median_ms'], result['median_ms']))
+        elif 'requests_per_s' in result and 'requests_per_s' in old:
+            ratio = old['requests_per_s'] / max(result['requests_per_s'], 1e-6)
+            if ratio > 1 + threshold:
+                regressions.append('{}: {:.0f} -> {:.0f} req/s'.format(
+                    _key(result), old['requests_per_s'],
+                    result['requests_per_s']))
+    return regressions
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    results = []
+    for result in _run(args):
+        _print_result(result)
+        results.append(result)
+
+    output = {'seltest_version': seltest.__version__,
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'results': results}
+    if args['--output']:
+        atomic_write(args['--output'],
+                     json.dumps(output, indent=1, sort_keys=True)
+                     .encode('utf-8'))
+
+    if args['--compare']:
+        with open(args['--compare']) as f:
+            baseline = json.load(f)
+        regressions = _regressions(results, baseline,
+                                   float(args['--threshold'] or 0.25))
+        if regressions:
+            print('Regressions:')
+            for regression in regressions:
+                print('  ' + regression)
+            sys.exit(1)
+        print('No regressions.')
+
+
+if __name__ == '__main__':
+    main()
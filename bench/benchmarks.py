@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of seltest's own overhead: the proxy, comparing screenshots, and
+waiting for pages.
+
+Each benchmark function yields results, dicts of a name, its parameters, and
+timings in milliseconds (see measure) or rates.
+"""
+from __future__ import absolute_import, unicode_literals, division
+
+import PIL.Image as Image
+
+import io
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import requests
+
+from seltest import Base, diff, waitfor
+from seltest.baselines import Manifest
+from seltest.cli import ReverseProxy
+from seltest.proxy import TRACKING_PENDING_REQUESTS_JS
+from seltest.seltest import NETWORK_IDLE, WAITFORS_STATUS_JS, _are_same_files
+
+from bench.fixture import FixtureServer
+
+
+RESOLUTIONS = [(800, 600), (1280, 800), (1920, 1080), (2560, 1440)]
+IDLE_TIMEOUT = 5000  # ms a page has to go idle in, in bench_idle.
+# Runs the proxy's tracking script (on stdin) in node, against a stand-in for
+# a browser's page which makes no requests at all, and prints how long after
+# the page loaded it went idle (or null if it didn't within the timeout).
+IDLE_PAGE_JS = """
+var listeners = {window: {}, document: {}};
+function target(name) {
+  return {addEventListener: function(type, fn) {
+    (listeners[name][type] = listeners[name][type] || []).push(fn);
+  }};
+}
+global.window = Object.assign(global, target('window'));
+global.document = Object.assign(target('document'), {
+  readyState: 'loading', images: [], fonts: {status: 'loaded'}});
+global.XMLHttpRequest = function() {};
+window.requestAnimationFrame = function(fn) { setTimeout(fn, 16); };
+window.fetch = window.WebSocket = window.PerformanceObserver = undefined;
+var script = '', quiet = +process.argv[1], timeout = +process.argv[2];
+process.stdin.on('data', function(data) { script += data; });
+process.stdin.on('end', function() {
+  eval(script.replace(/<\\/?script>/g, ''));
+  setTimeout(function() {
+    var loaded = Date.now();
+    document.readyState = 'complete';
+    (listeners.window.load || []).forEach(function(fn) { fn({}); });
+    (function poll() {
+      var elapsed = Date.now() - loaded;
+      if (window.__SELTEST_IS_IDLE(quiet)) return console.log(elapsed);
+      if (elapsed > timeout) return console.log('null');
+      setTimeout(poll, 5);
+    })();
+  }, 10);
+});
+"""
+
+
+def measure(fn, repeat, warmup=1):
+    """
+    Return dict of timings (in ms) of repeat calls to fn, after warmup calls.
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        times.append((time.time() - start) * 1000)
+    return _timings(times)
+
+
+def _timings(times):
+    """
+    Return dict of the statistics of times (in ms).
+    """
+    times = sorted(times)
+    return {'repeat': len(times),
+            'min_ms': times[0],
+            'median_ms': times[len(times) // 2],
+            'p95_ms': times[min(len(times) - 1, int(len(times) * 0.95))],
+            'mean_ms': sum(times) / len(times)}
+
+
+def result(name, timings, **params):
+    return dict(timings, name=name, params=params)
+
+
+def bench_proxy(repeat, page_kb, assets, asset_kb, threads):
+    """
+    Yield the latency of loading a page and its assets from the fixture app,
+    directly and through the proxy (with and without its cache), and the
+    proxy's throughput with threads concurrent clients.
+    """
+    params = dict(page_kb=page_kb, assets=assets, asset_kb=asset_kb)
+    fixture = FixtureServer().start()
+    cache_dir = tempfile.mkdtemp(prefix='seltest-bench-cache-')
+    page_path = fixture.page_path(page_kb, assets, asset_kb)
+    asset_paths = fixture.asset_paths(assets, asset_kb)
+    try:
+        direct = 'http://{}/'.format(fixture.host)
+        yield result('proxy.page_load.direct',
+                     measure(_page_loader(direct, page_path, asset_paths),
+                             repeat), **params)
+
+        for name, cache in (('uncached', None), ('cached', cache_dir)):
+            proxy = ReverseProxy(cache_dir=cache)
+            try:
+                port = proxy.add_hosts([fixture.host])[fixture.host]
+                base = 'http://localhost:{}/'.format(port)
+                yield result('proxy.page_load.' + name,
+                             measure(_page_loader(base, page_path,
+                                                  asset_paths), repeat),
+                             **params)
+                yield result('proxy.throughput.' + name,
+                             _throughput(base, [page_path] + asset_paths,
+                                         threads, repeat),
+                             threads=threads, **params)
+            finally:
+                proxy.stop()
+    finally:
+        fixture.stop()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def _page_loader(base, page_path, asset_paths):
+    """
+    Return function loading the page at page_path, then its assets, as a
+    browser would: navigation first, then subresources on one connection.
+    """
+    session = requests.Session()
+    def load():
+        session.get(base + page_path, headers={'Accept': 'text/html'}).content
+        for path in asset_paths:
+            session.get(base + path).content
+    return load
+
+
+def _throughput(base, paths, threads, repeat):
+    """
+    Return dict of requests and megabytes per second served to threads
+    clients each requesting every one of paths repeat times.
+    """
+    totals = {'requests': 0, 'bytes': 0}
+    lock = threading.Lock()
+    def client():
+        session = requests.Session()
+        count = size = 0
+        for _ in range(repeat):
+            for path in paths:
+                size += len(session.get(base + path).content)
+                count += 1
+        with lock:
+            totals['requests'] += count
+            totals['bytes'] += size
+    workers = [threading.Thread(target=client) for _ in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+    return {'requests_per_s': totals['requests'] / elapsed,
+            'mb_per_s': totals['bytes'] / elapsed / (1024 * 1024),
+            'requests': totals['requests']}
+
+
+def bench_images(repeat, resolutions=RESOLUTIONS):
+    """
+    Yield the time taken to compare synthetic screenshots at each of
+    resolutions: with _are_same_files, with a warm baseline manifest, and
+    with the NumPy diff engine if it's installed.
+    """
+    tmp = tempfile.mkdtemp(prefix='seltest-bench-images-')
+    try:
+        for width, height in resolutions:
+            params = dict(width=width, height=height)
+            pngs = _screenshots(width, height)
+            paths = {}
+            for case, png in pngs.items():
+                paths[case] = os.path.join(tmp, '{}.png'.format(case))
+                with open(paths[case], 'wb') as f:
+                    f.write(png)
+
+            for case in ('same_bytes', 'same_pixels', 'changed_top',
+                         'changed_bottom'):
+                files = (paths['baseline'], paths[case])
+                yield result('images.are_same_files.' + case,
+                             measure(lambda: _are_same_files(*files),
+                                     repeat), **params)
+
+            manifest = Manifest(tmp)
+            manifest.entry('baseline', paths['baseline'])  # Warm it up.
+            for case in ('same_bytes', 'same_pixels', 'changed_top',
+                         'changed_bottom'):
+                png = pngs[case]
+                yield result('images.manifest_matches.' + case,
+                             measure(lambda: manifest.matches(
+                                 'baseline', paths['baseline'], png), repeat),
+                             **params)
+
+            if diff.available():
+                for case in ('same_pixels', 'changed_bottom'):
+                    old, new = pngs['baseline'], pngs[case]
+                    yield result('images.diff.' + case,
+                                 measure(lambda: diff.diff(old, new,
+                                                           threshold=8),
+                                         repeat), **params)
+            os.remove(manifest.path)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _screenshots(width, height):
+    """
+    Return dict of synthetic screenshots (PNG bytes) of width x height: a
+    baseline, and variations on it.
+    """
+    gradient = Image.linear_gradient('L').resize((width, height))
+    fractal = Image.effect_mandelbrot((width, height),
+                                      (-2.0, -1.25, 1.0, 1.25), 100)
+    image = Image.merge('RGB', (gradient, fractal,
+                                gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+    pngs = {'baseline': _png(image), 'same_bytes': _png(image),
+            'same_pixels': _png(image, compress_level=1)}
+    for case, xy in (('changed_top', (0, 0)),
+                     ('changed_bottom', (width - 1, height - 1))):
+        changed = image.copy()
+        changed.putpixel(xy, (255, 0, 255))
+        pngs[case] = _png(changed)
+    return pngs
+
+
+def _png(image, compress_level=6):
+    buf = io.BytesIO()
+    image.save(buf, 'PNG', compress_level=compress_level)
+    return buf.getvalue()
+
+
+def bench_waits(repeat, latency_ms, polls=(0, 1, 2)):
+    """
+    Yield the time taken, and number of driver calls made, waiting for
+    waitfors which are satisfied after each of polls polls, against a fake
+    driver taking latency_ms per call.
+    """
+    for ready_after in polls:
+        driver = FakeDriver(latency_ms, ready_after)
+        suite = _WaitSuite(driver, network_idle=0)
+        test = _WaitSuite.__dict__['__test_methods'][0]
+        def wait():
+            driver.reset()
+            suite._handle_waitfors(test)
+            suite._wait_for_network_idle()
+        timings = measure(wait, repeat)
+        timings['driver_calls'] = driver.calls
+        yield result('waits.poll', timings, ready_after=ready_after,
+                     latency_ms=latency_ms)
+
+
+def bench_idle(repeat, quiet_ms=NETWORK_IDLE):
+    """
+    Yield how long after loading a page which makes no requests the proxy's
+    tracking script takes to consider it idle, for quiet_ms of quiet (run in
+    node, so nothing if node isn't installed).
+    """
+    try:
+        subprocess.check_output(['node', '--version'])
+    except (OSError, subprocess.CalledProcessError):
+        return
+    times = []
+    for _ in range(repeat):
+        node = subprocess.Popen(
+            ['node', '-e', IDLE_PAGE_JS, str(quiet_ms), str(IDLE_TIMEOUT)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        out, _ = node.communicate(TRACKING_PENDING_REQUESTS_JS)
+        elapsed = json.loads(out.decode('utf-8'))
+        if elapsed is None:
+            raise AssertionError('A page with nothing to load never went '
+                                 'idle (in {}ms)'.format(IDLE_TIMEOUT))
+        times.append(elapsed)
+    yield result('waits.idle.static_page', _timings(times),
+                 quiet_ms=quiet_ms)
+
+
+class FakeDriver(object):
+    """
+    Stands in for a WebDriver whose page's waitfors are satisfied after
+    ready_after polls, and whose calls each take latency_ms.
+    """
+    def __init__(self, latency_ms, ready_after):
+        self.latency = latency_ms / 1000.0
+        self.ready_after = ready_after
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.polls = 0
+
+    def execute_script(self, script, *args):
+        self._call()
+        if script == WAITFORS_STATUS_JS:
+            self.polls += 1
+            ready = self.polls > self.ready_after
+            return ['ok' if ready else 'missing' for _ in args[0]]
+        return True  # e.g. the network's idle.
+
+    def set_window_size(self, width, height):
+        self._call()
+
+    def implicitly_wait(self, seconds):
+        self._call()
+
+    def _call(self):
+        self.calls += 1
+        time.sleep(self.latency)
+
+
+host = 'localhost'
+
+
+class _WaitSuite(Base):
+    @waitfor('#a')
+    @waitfor('#b', text='b')
+    @waitfor('#c', classes=['c'])
+    def page(self, driver):
+        pass
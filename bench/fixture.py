@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+A local HTTP app for benchmarking against, which needs no network.
+
+Serves:
+  /page?kb=K&assets=N&asset_kb=A  An HTML page of about K KB, referencing N
+                                  images of A KB each.
+  /asset/<i>?kb=A                 An A KB asset, cacheable for an hour.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+import threading
+try:  # py2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:  # py3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+
+PAGE_KB = 50
+ASSETS = 20
+ASSET_KB = 10
+FILLER = b'<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit.</p>\n'
+
+
+class FixtureServer(object):
+    """
+    The fixture app, served from a background thread on a free port.
+    """
+    def __init__(self, bind='localhost'):
+        self._server = _ThreadingHTTPServer((bind, 0), _Handler)
+        self.host = '{}:{}'.format(bind, self._server.server_port)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def page_path(self, kb=PAGE_KB, assets=ASSETS, asset_kb=ASSET_KB):
+        """
+        Return the path of a page of kb KB with assets assets of asset_kb KB.
+        """
+        return 'page?kb={}&assets={}&asset_kb={}'.format(kb, assets, asset_kb)
+
+    def asset_paths(self, assets=ASSETS, asset_kb=ASSET_KB):
+        """
+        Return list of the paths of the assets of a page.
+        """
+        return ['asset/{}?kb={}'.format(i, asset_kb) for i in range(assets)]
+
+
+def page(kb, assets, asset_kb):
+    """
+    Return the HTML (bytes) of a page of about kb KB, with assets images.
+    """
+    head = (b'<!doctype html>\n<html>\n<head><title>fixture</title></head>\n'
+            b'<body>\n')
+    imgs = b''.join('<img src="/asset/{}?kb={}">\n'.format(i, asset_kb)
+                    .encode('ascii') for i in range(assets))
+    tail = b'</body>\n</html>\n'
+    size = kb * 1024 - len(head) - len(imgs) - len(tail)
+    filler = FILLER * max(0, size // len(FILLER))
+    return head + imgs + filler + tail
+
+
+def asset(index, kb):
+    """
+    Return kb KB of bytes, different for each index.
+    """
+    seed = hashlib.sha1(str(index).encode('ascii')).digest()
+    return (seed * (kb * 1024 // len(seed) + 1))[:kb * 1024]
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep connections alive, as servers do.
+    # Send headers and body together, rather than waiting on delayed ACKs.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict((k, int(v[0])) for k, v in parse_qs(url.query).items())
+        if url.path == '/page':
+            self._send(page(params.get('kb', PAGE_KB),
+                            params.get('assets', ASSETS),
+                            params.get('asset_kb', ASSET_KB)),
+                       'text/html; charset=utf-8')
+        elif url.path.startswith('/asset/'):
+            body = asset(url.path.rsplit('/', 1)[1], params.get('kb', ASSET_KB))
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            if self.headers.get('If-None-Match') == etag:
+                self._send(b'', 'image/png', status=304, etag=etag)
+            else:
+                self._send(body, 'image/png', etag=etag)
+        else:
+            self._send(b'not found', 'text/plain', status=404)
+
+    def _send(self, body, content_type, status=200, etag=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if etag:
+            self.send_header('Cache-Control', 'max-age=3600')
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Don't drown out the results.
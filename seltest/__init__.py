@@ -3,10 +3,12 @@
 seltest means easy browser-based testing with no overhead.
 """
 from .seltest import Base, BaseMeta
-from .helpers import url, waitfor, waitforjs, dontwaitfor, hide
+from .helpers import (url, waitfor, waitforjs, dontwaitfor, hide, tolerate,
+                      snapshot)
 import seltest
 
-__all__ = ['Base', 'url', 'waitfor', 'waitforjs', 'dontwaitfor']
+__all__ = ['Base', 'url', 'waitfor', 'waitforjs', 'dontwaitfor', 'tolerate',
+           'snapshot']
 __author__ = 'Isaac Hodes <isaachodes@gmail.com>'
 __version__ = '1.0.1'
 
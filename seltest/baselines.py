@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Bookkeeping for baseline screenshots.
+
+The manifest (baselines.json, in the image directory) records a hash of each
+baseline's pixels and its dimensions, along with a hash, size and mtime of the
+file they were computed from. A baseline which hasn't changed on disk since
+then never has to be decoded to be compared against.
+
+It also keeps a CRC-32 of each TILE_SIZE x TILE_SIZE tile of the baseline.
+New screenshots are decoded whole, but hashed one band of tiles at a time, so
+comparisons can stop hashing at the first band with a changed tile, and say
+which tiles changed. Tiles are only needed for screenshots which aren't
+byte-for-byte their baseline, so rather than weigh down the manifest, they're
+kept in tiles/ in the image directory, one file for each distinct image, named
+by the hash of its pixels.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import PIL.Image as Image
+
+import base64
+import contextlib
+import hashlib
+import io
+import json
+import os
+import shutil
+import struct
+import zlib
+
+from seltest.helpers import atomic_write, file_lock, makedirs
+
+
+MANIFEST_FILENAME = 'baselines.json'
+MANIFEST_VERSION = 3
+TILES_DIRNAME = 'tiles'
+TILE_SIZE = 64  # pixels
+
+
+class Manifest(object):
+    """
+    The manifest of baseline screenshots in image_dir.
+
+    Safe to share between processes (e.g. parallel workers): updates are made
+    under a lock, to the latest version of the manifest on disk.
+    """
+    def __init__(self, image_dir):
+        self.image_dir = image_dir
+        self.path = os.path.join(image_dir, MANIFEST_FILENAME)
+        self.tiles_dir = os.path.join(image_dir, TILES_DIRNAME)
+        self._entries = self._read()
+        self._pending = None  # Changes deferred by batch.
+
+    def entry(self, name, path):
+        """
+        Return the manifest entry for baseline name, stored at path. Computes
+        (and records) it if the baseline is new or has changed on disk.
+        """
+        entry = self._entries.get(name)
+        if entry is not None and _matches_stat(entry, path):
+            return entry
+        return self.record(name, path)
+
+    def record(self, name, path, entry=None):
+        """
+        Return the entry recorded for baseline name, just written to path,
+        with its tiles.
+
+        If given, entry (see describe) is recorded rather than computed from
+        the file at path.
+        """
+        if entry is None or 'tiles' not in entry:
+            entry = _describe_file(path)
+        entry = dict(entry, **_stat(path))
+        entry.pop('changed_tiles', None)
+        write_tiles(self.tiles_dir, entry)
+        self._update({name: dict((key, value) for key, value in entry.items()
+                                 if key != 'tiles')})
+        return entry
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Write the entries recorded in the block all at once, at its end,
+        rather than rewriting the manifest for each. Nested blocks are part
+        of the outermost one.
+        """
+        if self._pending is not None:
+            yield
+            return
+        self._pending = {}
+        try:
+            yield
+        finally:
+            pending, self._pending = self._pending, None
+            if pending:
+                self._update(pending)
+
+    def delete(self):
+        """
+        Remove the manifest, and the tiles.
+        """
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        if os.path.isdir(self.tiles_dir):
+            shutil.rmtree(self.tiles_dir)
+        self._entries = {}
+
+    def _update(self, changes):
+        """
+        Apply changes, a dict of baseline name to its new entry, to the
+        manifest, removing the tiles no baseline has any more.
+        """
+        if self._pending is not None:
+            self._pending.update(changes)
+            self._entries.update(changes)
+            return
+        with file_lock(self.path):
+            self._entries = self._read()
+            replaced = set(self._entries[name]['pixel_hash']
+                           for name in changes if name in self._entries)
+            self._entries.update(changes)
+            atomic_write(self.path, json.dumps(
+                {'version': MANIFEST_VERSION, 'baselines': self._entries},
+                indent=1, sort_keys=True).encode('utf-8'))
+            replaced -= set(e['pixel_hash'] for e in self._entries.values())
+            for pixel_hash in replaced:
+                remove_tiles(self.tiles_dir, pixel_hash)
+
+    def matches(self, name, baseline_path, png, early_exit=True):
+        """
+        Return (is_same, entry) where is_same is True if the screenshot png
+        (bytes) has the same pixels as baseline name (stored at
+        baseline_path), and entry describes png (see describe).
+
+        With early_exit, stops at the first band of tiles which differs; the
+        entry is then incomplete, and can't be recorded.
+        """
+        baseline = self.entry(name, baseline_path)
+        if ('tiles' not in baseline
+                and hashlib.sha1(png).hexdigest() != baseline['file_hash']):
+            tiles = read_tiles(self.tiles_dir, baseline['pixel_hash'])
+            if tiles is None:  # Removed since; compute them again.
+                tiles = self.record(name, baseline_path)['tiles']
+            baseline = dict(baseline, tiles=tiles)
+        entry = describe(png, baseline, early_exit)
+        return entry['pixel_hash'] == baseline['pixel_hash'], entry
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if manifest.get('version') != MANIFEST_VERSION:
+            return {}
+        return manifest['baselines']
+
+
+def describe(data, baseline=None, early_exit=False):
+    """
+    Return dict describing the PNG data (bytes): the hash of the file, the
+    hash of its pixels, its dimensions, and the CRC-32s of its tiles.
+
+    If data is byte-for-byte identical to the file described by baseline (a
+    manifest entry), its pixels aren't decoded; baseline's are used (and its
+    tiles, if it has them). Otherwise, if baseline is the same size, the tiles
+    which differ from its tiles are listed in 'changed_tiles' as (column, row)
+    pairs. With early_exit, the description stops at the first band of tiles
+    with any changes, and has no pixel_hash. Either way, data is decoded in
+    full (by PIL, all at once), so needs the memory for all of its pixels.
+    """
+    file_hash = hashlib.sha1(data).hexdigest()
+    if baseline is not None and baseline.get('file_hash') == file_hash:
+        return dict((key, baseline[key])
+                    for key in ('file_hash', 'pixel_hash', 'size', 'tiles')
+                    if key in baseline)
+    with Image.open(io.BytesIO(data)) as image:
+        entry = _describe_image(image, baseline, early_exit)
+    entry['file_hash'] = file_hash
+    return entry
+
+
+def _describe_image(image, baseline, early_exit):
+    """
+    Return dict of the pixel hash, size, and tile CRC-32s of image, compared
+    against baseline, if any (see describe).
+
+    The image is decoded whole on the first crop; after that, only one band
+    of it is copied out at a time, to hash.
+    """
+    width, height = image.size
+    baseline_crcs = None
+    if baseline is not None and baseline['size'] == [width, height]:
+        baseline_crcs = _unpack_crcs(baseline['tiles'])
+    digest = hashlib.sha512()
+    crcs = []
+    changed_tiles = []
+    for row, top in enumerate(range(0, height, TILE_SIZE)):
+        band = image.crop((0, top, width, min(top + TILE_SIZE, height)))
+        digest.update(band.tobytes())
+        for left in range(0, width, TILE_SIZE):
+            tile = band.crop((left, 0, min(left + TILE_SIZE, width),
+                              band.size[1]))
+            crc = zlib.crc32(tile.tobytes()) & 0xffffffff
+            if baseline_crcs is not None and crc != baseline_crcs[len(crcs)]:
+                changed_tiles.append((left // TILE_SIZE, row))
+            crcs.append(crc)
+        if changed_tiles and early_exit:
+            return {'pixel_hash': None,
+                    'size': [width, height],
+                    'changed_tiles': changed_tiles}
+    digest.update('{} {}x{}'.format(image.mode, width, height).encode('utf-8'))
+    return {'pixel_hash': digest.hexdigest(),
+            'size': [width, height],
+            'tiles': _pack_crcs(crcs),
+            'changed_tiles': changed_tiles}
+
+
+def write_tiles(directory, entry):
+    """
+    Keep the tiles of entry (see describe) in directory, unless they already
+    are: they're the same for every image with its pixels.
+    """
+    path = _tiles_path(directory, entry['pixel_hash'])
+    if not os.path.isfile(path):
+        makedirs(os.path.dirname(path))
+        atomic_write(path, base64.b64decode(entry['tiles']))
+
+
+def read_tiles(directory, pixel_hash):
+    """
+    Return the tiles (as in describe's entries) of the image with pixel_hash
+    kept in directory, or None if they aren't there.
+    """
+    try:
+        with open(_tiles_path(directory, pixel_hash), 'rb') as f:
+            return base64.b64encode(f.read()).decode('ascii')
+    except IOError:
+        return None
+
+
+def remove_tiles(directory, pixel_hash):
+    """
+    Remove the tiles of the image with pixel_hash from directory, if there.
+    """
+    try:
+        os.remove(_tiles_path(directory, pixel_hash))
+    except OSError:
+        pass
+
+
+def _tiles_path(directory, pixel_hash):
+    return os.path.join(directory, pixel_hash[:2], pixel_hash)
+
+
+def _pack_crcs(crcs):
+    packed = struct.pack('>{}I'.format(len(crcs)), *crcs)
+    return base64.b64encode(packed).decode('ascii')
+
+
+def _unpack_crcs(tiles):
+    packed = base64.b64decode(tiles)
+    return struct.unpack('>{}I'.format(len(packed) // 4), packed)
+
+
+def _describe_file(path):
+    with open(path, 'rb') as f:
+        return describe(f.read())
+
+
+def _stat(path):
+    stat = os.stat(path)
+    return {'mtime': stat.st_mtime, 'bytes': stat.st_size}
+
+
+def _matches_stat(entry, path):
+    try:
+        return _stat(path) == {'mtime': entry.get('mtime'),
+                               'bytes': entry.get('bytes')}
+    except OSError:
+        return False
@@ -0,0 +1,281 @@
+"""
+A disk-backed cache of upstream responses for the reverse proxy.
+
+Bodies are stored by the SHA-1 of their content, so an asset served from many
+URLs (or for many variants of a URL) is only stored once. An index maps each
+request key to its response headers and body, and the least recently used
+entries are evicted once the stored bodies exceed the cache's size.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from collections import OrderedDict
+from email.utils import parsedate_tz, mktime_tz
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+from seltest.helpers import atomic_write, makedirs
+
+
+INDEX_FILENAME = 'index.json'
+SAVE_DELAY = 2  # seconds the index is left unsaved after a change.
+MAX_AGE_RE = re.compile(r'(?:^|,)\s*max-age\s*=\s*"?(\d+)"?', re.I)
+# Headers which describe a connection, not a response, so aren't cached.
+HOP_BY_HOP_HEADERS = ('connection', 'keep-alive', 'transfer-encoding',
+                      'proxy-authenticate', 'proxy-authorization', 'te',
+                      'trailer', 'upgrade')
+# Request headers making the response to a request particular to its user, so
+# not to be shared with other requests through the cache.
+CREDENTIAL_HEADERS = ('authorization', 'cookie')
+
+
+class AssetCache(object):
+    """
+    Cache of upstream responses in directory, holding at most max_bytes of
+    response bodies.
+
+    Respects `Cache-Control` and `Expires` for freshness, and revalidates
+    stale entries with `ETag` and `Last-Modified` when the response has them.
+    Like any shared cache, never stores private responses, responses setting
+    cookies, or responses to requests with credentials.
+    Safe to use from multiple threads, but not from multiple processes.
+
+    Changes to the index are saved SAVE_DELAY seconds after the first change
+    since it was last saved, rather than on every change; call flush to save
+    them sooner (e.g. before exiting).
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> entry, least recently used first
+        self._vary = {}  # url -> names of request headers its response varies on
+        self._save_timer = None  # Pending save of the index, if it's changed.
+        self._load()
+
+    def key(self, url, headers):
+        """
+        Return the key of the response to a request for url with headers.
+        """
+        headers = _lower_keys(headers)
+        parts = [url] + ['{}: {}'.format(name, headers.get(name, ''))
+                         for name in self._vary.get(url, [])]
+        return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def lookup(self, url, headers):
+        """
+        Return (entry, is_fresh) for a request for url with headers, or
+        (None, False) if nothing is cached for it.
+        """
+        with self._lock:
+            key = self.key(url, headers)
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, False
+            self._entries.pop(key)
+            self._entries[key] = entry
+            return entry, _is_fresh(entry)
+
+    def read(self, entry, chunk_size):
+        """
+        Return an iterator over the cached body of entry, in chunks. Raises
+        IOError if the body has since been evicted.
+        """
+        return _iter_file(open(self._blob_path(entry['blob']), 'rb'),
+                          chunk_size)
+
+    def validators(self, entry):
+        """
+        Return dict of conditional request headers to revalidate entry with.
+        """
+        validators = {}
+        headers = _lower_keys(entry['headers'])
+        if headers.get('etag'):
+            validators['If-None-Match'] = headers['etag']
+        if headers.get('last-modified'):
+            validators['If-Modified-Since'] = headers['last-modified']
+        return validators
+
+    def refresh(self, entry, headers):
+        """
+        Return entry, updated with the headers of a `304 Not Modified`
+        response revalidating it.
+        """
+        with self._lock:
+            updated = _lower_keys(entry['headers'])
+            for name, value in _lower_keys(headers).items():
+                if name in ('cache-control', 'expires', 'etag',
+                            'last-modified', 'date'):
+                    updated[name] = value
+            entry['headers'] = updated
+            entry['stored_at'] = time.time()
+            self._changed()
+            return entry
+
+    def is_cacheable_request(self, req_headers):
+        """
+        Return True if the response to a request with req_headers may be
+        looked up in, or stored in, the cache: if it carries no credentials.
+        """
+        return not any(name.lower() in CREDENTIAL_HEADERS
+                       for name in req_headers)
+
+    def is_cacheable(self, status, headers):
+        """
+        Return True if a response with status and headers may be stored.
+        """
+        headers = _lower_keys(headers)
+        cache_control = headers.get('cache-control', '').lower()
+        if status != 200 or 'no-store' in cache_control:
+            return False
+        if 'private' in cache_control or 'set-cookie' in headers:
+            return False
+        if headers.get('vary', '').strip() == '*':
+            return False
+        has_freshness = (MAX_AGE_RE.search(cache_control)
+                         or headers.get('expires'))
+        has_validator = headers.get('etag') or headers.get('last-modified')
+        return bool(has_freshness or has_validator)
+
+    def tee(self, url, req_headers, status, headers, body):
+        """
+        Return an iterator yielding the chunks of body, which stores the
+        response once body has been read to its end.
+
+        Bodies larger than a quarter of the cache aren't stored.
+        """
+        limit = self.max_bytes // 4
+        chunks = []
+        size = 0
+        for chunk in body:
+            if chunks is not None:
+                size += len(chunk)
+                if size > limit:
+                    chunks = None
+                else:
+                    chunks.append(chunk)
+            yield chunk
+        if chunks is not None:
+            self.store(url, req_headers, status, headers, b''.join(chunks))
+
+    def store(self, url, req_headers, status, headers, data):
+        """
+        Store the response with status, headers and body data for a request
+        for url with req_headers, evicting old entries to make room.
+        """
+        headers = dict((name, value)
+                       for name, value in _lower_keys(headers).items()
+                       if name not in HOP_BY_HOP_HEADERS)
+        blob = hashlib.sha1(data).hexdigest()
+        blob_path = self._blob_path(blob)
+        with self._lock:
+            if not os.path.exists(blob_path):
+                makedirs(os.path.dirname(blob_path))
+                atomic_write(blob_path, data)
+            self._vary[url] = [name.strip().lower()
+                               for name in headers.get('vary', '').split(',')
+                               if name.strip()]
+            key = self.key(url, req_headers)
+            self._entries.pop(key, None)
+            self._entries[key] = {
+                'url': url,
+                'status': status,
+                'headers': headers,
+                'blob': blob,
+                'size': len(data),
+                'stored_at': time.time()
+            }
+            self._evict()
+            self._changed()
+
+    def flush(self):
+        """
+        Save the index now, if it's changed since it was last saved.
+        """
+        with self._lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+                self._save()
+
+    def _changed(self):
+        """
+        Schedule saving the index, unless it's already scheduled, so a burst
+        of changes is saved once. Called with the lock held.
+        """
+        if self._save_timer is None:
+            self._save_timer = threading.Timer(SAVE_DELAY, self.flush)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def _evict(self):
+        sizes = dict((e['blob'], e['size']) for e in self._entries.values())
+        total = sum(sizes.values())
+        while total > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            if not any(e['blob'] == entry['blob']
+                       for e in self._entries.values()):
+                total -= entry['size']
+                try:
+                    os.remove(self._blob_path(entry['blob']))
+                except OSError:
+                    pass
+
+    def _blob_path(self, blob):
+        return os.path.join(self.directory, 'blobs', blob[:2], blob)
+
+    def _load(self):
+        path = os.path.join(self.directory, INDEX_FILENAME)
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as f:
+                index = json.load(f)
+        except ValueError:
+            return  # A corrupt index just means a cold cache.
+        self._vary = index.get('vary', {})
+        for key, entry in index.get('entries', []):
+            if os.path.exists(self._blob_path(entry['blob'])):
+                self._entries[key] = entry
+
+    def _save(self):
+        index = {'vary': self._vary, 'entries': list(self._entries.items())}
+        makedirs(self.directory)
+        atomic_write(os.path.join(self.directory, INDEX_FILENAME),
+                      json.dumps(index).encode('utf-8'))
+
+
+def _iter_file(f, chunk_size):
+    with f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            yield chunk
+
+
+def _is_fresh(entry):
+    """
+    Return True if entry may be served without revalidating it.
+    """
+    headers = entry['headers']
+    cache_control = headers.get('cache-control', '').lower()
+    if 'no-cache' in cache_control:
+        return False
+    max_age = MAX_AGE_RE.search(cache_control)
+    if max_age:
+        return time.time() - entry['stored_at'] < int(max_age.group(1))
+    expires = _parse_http_date(headers.get('expires'))
+    date = _parse_http_date(headers.get('date')) or entry['stored_at']
+    if expires is not None:
+        return time.time() - entry['stored_at'] < expires - date
+    return False
+
+
+def _parse_http_date(value):
+    parsed = parsedate_tz(value) if value else None
+    return mktime_tz(parsed) if parsed else None
+
+
+def _lower_keys(headers):
+    return dict((name.lower(), value) for name, value in headers.items())
@@ -6,7 +6,12 @@ Usage:
   sel test [options] <path>
   sel update [options] <path>
   sel list [options] <path>
+  sel watch [options] <path>
   sel interactive [options]
+  sel daemon [options]
+  sel merge [options] <results>...
+  sel migrate [options] <path>
+  sel gc [options] <path>
   sel --version
 
 Options:
@@ -27,10 +32,63 @@ Options:
   --config-profile NAME          Name of the profile to use. Inherits from the
                                  `default` profile.
   --config-list                  Print out the current configuration being used.
+  --shard INDEX/COUNT            Only run the INDEX-th of COUNT shards of the
+                                 tests (counting from 1), e.g. on one of COUNT
+                                 CI machines. Each test is assigned by a hash
+                                 of its name, or to balance the shards by the
+                                 durations in --durations.
+  --durations FILE               Results file (see --results) of a previous
+                                 run, whose durations --shard balances shards
+                                 by.
+  --results FILE                 Write whether each test passed, and how long
+                                 it took, to FILE as JSON. For merge, where to
+                                 write the merged results. Defaults to
+                                 seltest-results-INDEX-of-COUNT.json when
+                                 sharding.
+  --changed-only                 Only run tests which haven't passed since
+                                 their module or the responses served for
+                                 their page last changed, as recorded by
+                                 earlier runs with this option (or watch).
+                                 Runs every test if there's no record of them.
+  --store KIND                   Kind of store for migrate to move the
+                                 baselines in the image directory to: flat,
+                                 one NAME.png file each, or blobs,
+                                 deduplicated and compressed. Defaults to
+                                 blobs.
+  --pack                         For gc, also pack the blobs left into a few
+                                 large files.
+  --watch-dir DIRS               Comma-separated list of the directories of
+                                 the app under test for `sel watch` to watch
+                                 for changes, as well as the tests' modules.
   --wait SECONDS                 Wait SECONDS between each test. Useful for
                                  debugging tests and manually monitoring them.
                                  Defaults to 0.
+  --wait-mode MODE               How to wait for pages to be ready before
+                                 taking screenshots: poll, which repeatedly
+                                 checks, or push, which is notified by the page
+                                 as soon as they are. Defaults to poll.
+  --network-idle MS              Wait for there to have been no network
+                                 activity for MS milliseconds before taking
+                                 screenshots. Defaults to 100.
+  --profile FILE                 Write a timeline of each test's phases, and
+                                 of the requests the proxy served, to FILE in
+                                 Chrome's trace format, and print the slowest
+                                 tests and phases.
+  --daemon-socket PATH           Unix socket `sel daemon` listens on, and
+                                 which test, update and list send their work
+                                 to if it's running, to use its browsers and
+                                 proxy. Defaults to ~/.seltest-daemon.sock.
+  --no-daemon                    Don't use a running `sel daemon`.
   --display-proxy-server-logs    Print proxy-server logs + debug info.
+  --proxy-pool-size N            Number of keep-alive connections the proxy
+                                 keeps open to each host under test.
+                                 Defaults to 10.
+  --proxy-cache DIR              Cache cacheable responses from the hosts
+                                 under test in DIR, across runs.
+  --proxy-cache-size MB          Maximum size of the proxy cache in megabytes.
+                                 Defaults to 256.
+  --workers N                    Number of browsers to run tests with in
+                                 parallel. Defaults to 1.
   --firefox-path PATH            Path to Firefox binary, if you don't want to
                                  use the default.
   --chrome-path PATH             Path to Chrome binary, if you don't want to
@@ -43,6 +101,9 @@ Options:
                                  want to use the default.
   --imgur_client_id ID           Provide an imgur.com API client ID to upload
                                  photos of failed tests to imgur.
+  --upload-endpoint URL          Image API to upload photos of failed tests
+                                 to, which takes them as imgur's does.
+                                 Defaults to https://api.imgur.com/3/image.
   --remote-capabilities JSON     JSON describing the capabilities to be passed
                                  to the remote driver.
   --remote-command-executor URL  URL of the Selenium Remote Server to connect to.
@@ -50,36 +111,92 @@ Options:
 from __future__ import absolute_import, unicode_literals
 
 import seltest
-import seltest.proxy
+from seltest import (daemon, dependencies, history, index, shards, store,
+                     uploads, watch)
+from seltest.profile import Profiler
+from seltest.seltest import _host_of, _screenshot_names
 
 import docopt
 
 import importlib
+import io
 import json
 import multiprocessing
 import os
+try:  # py2
+    from Queue import Empty
+except ImportError:  # py3
+    from queue import Empty
 import re
-from selenium import webdriver
-from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
-import socket
+import signal
 import sys
+import time
+import traceback
 
 
+PROXY_READY_TIMEOUT = 10  # seconds
+# Time workers are given to write their bookkeeping and quit their browsers
+# once all the tests have run, before they're stopped.
+WORKER_EXIT_TIMEOUT = 30  # seconds
+WATCH_INTERVAL = 0.2  # seconds between checking for changes.
+WATCH_SETTLE = 0.1  # seconds to wait for the rest of a change to be saved.
+FAILED_MSG = 'ERROR: some tests failed'
+# Options naming paths, which are made absolute before being sent to the
+# daemon, as it has its own working directory.
+PATH_OPTIONS = ('<path>', '--output', '--profile', '--results',
+                '--durations', '--firefox-path', '--chrome-path',
+                '--phantomjs-path', '--safari-path', '--ie-path')
+# Options configuring the driver: the daemon keeps a driver for each
+# combination of them it's asked for.
+DRIVER_OPTIONS = ('--browser', '--firefox-path', '--chrome-path',
+                  '--phantomjs-path', '--safari-path', '--ie-path',
+                  '--remote-capabilities', '--remote-command-executor')
+CLEAR_STORAGE_JS = """
+try { window.localStorage.clear(); } catch (e) {}
+try { window.sessionStorage.clear(); } catch (e) {}
+"""
+
 DEFAULTS = {
-    '--browser': 'firefox'
+    '--browser': 'firefox',
+    '--workers': '1',
+    '--wait-mode': 'poll',
+    '--network-idle': '100',
+    '--proxy-pool-size': '10',
+    '--proxy-cache-size': '256',
+    '--store': 'blobs',
+    '--upload-endpoint': uploads.UPLOAD_ENDPOINT,
+    '--daemon-socket': daemon.SOCKET_PATH
 }
 
 
-def _get_modules_from_path(path):
+def _get_modules_from_path(path, names=None):
     """
-    Return list of (imported) modules from list of filenames on path.
+    Return list of (imported) modules from list of filenames on path, or only
+    those of them named in names, if given.
     """
     path = _expand_path(path)
-    filenames = [f for f in os.listdir(path)
-                 if os.path.isfile(os.path.join(path, f)) and f.startswith('test')
-                 and f.endswith('.py')]
-    sys.path = [path] + sys.path
-    return [importlib.import_module(m.split('.')[0]) for m in filenames]
+    filenames = index.test_filenames(path)
+    if names is not None:
+        filenames = [f for f in filenames if f.split('.')[0] in names]
+    if path not in sys.path:
+        sys.path = [path] + sys.path
+    if hasattr(importlib, 'invalidate_caches'):  # py3
+        importlib.invalidate_caches()
+    return [_import_fresh(m.split('.')[0], path) for m in filenames]
+
+
+def _import_fresh(name, path):
+    """
+    Return module name, imported from path. If it already has been (e.g. for
+    an earlier request to `sel daemon`) it's imported again, as it may have
+    changed since, and filtering tests modifies its classes.
+    """
+    module = sys.modules.get(name)
+    filename = getattr(module, '__file__', None)
+    if (filename and os.path.dirname(os.path.abspath(filename))
+            == os.path.abspath(path)):
+        del sys.modules[name]
+    return importlib.import_module(name)
 
 
 def _get_test_classes_from_modules(modules):
@@ -98,18 +215,24 @@ def _get_test_classes_from_modules(modules):
     return classes
 
 
+def _name_filter(patterns):
+    """
+    Return a function taking a name and returning whether it matches any of
+    the comma-separated regexps patterns (always True if there are none).
+    """
+    if not patterns:
+        return lambda name: True
+    res = [re.compile(p, re.I) for p in patterns.split(',')]
+    return lambda name: any(f.search(name) for f in res)
+
+
 def _filter_classes(classes, args):
     """
     Return list of classes. Given a list of classes args, return list of test
     classes to be run.
     """
-    class_name_filters = args['--classname']
-    if class_name_filters:
-        class_name_filters = class_name_filters.split(',')
-        class_name_res = [re.compile(p, re.I) for p in class_name_filters]
-        classes = [c for c in classes
-                   if any(f.search(c.__name__) for f in class_name_res)]
-    return classes
+    pred = _name_filter(args['--classname'])
+    return [c for c in classes if pred(c.__name__)]
 
 
 def _filter_test_methods(cls, pred):
@@ -136,30 +259,95 @@ def _filter_tests(classes, args):
     Return list of classes. Given test classes and args, filters out tests in
     classes.
     """
-    test_name_filters = args['--filter']
-    if test_name_filters:
-        test_name_filters = test_name_filters.split(',')
-        test_name_res = [re.compile(p, re.I) for p in test_name_filters]
-        def pred(name):
-            return any(f.search(name) for f in test_name_res)
+    if args['--filter']:
+        pred = _name_filter(args['--filter'])
         for cls in classes:
             cls = _filter_test_methods(cls, pred)
     return classes
 
 
+def _get_indexed_modules(args):
+    """
+    Return list of the modules in seltest.index.index of args' path with test
+    classes matching args, with only those classes, and their tests matching
+    args, left in them. Dynamic modules are always returned, in full.
+    """
+    class_pred = _name_filter(args['--classname'])
+    test_pred = _name_filter(args['--filter'])
+    modules = []
+    for module in index.index(_expand_path(args['<path>'])):
+        if not module['dynamic']:
+            classes = [dict(cls, tests=[t for t in cls['tests']
+                                        if test_pred(t['name'])])
+                       for cls in module['classes'] if class_pred(cls['name'])]
+            if args['--filter']:
+                classes = [cls for cls in classes if cls['tests']]
+            if not classes:
+                continue
+            module = dict(module, classes=classes)
+        modules.append(module)
+    return modules
+
+
 def _get_filtered_classes_to_run(args):
     """
     Return list of classes with all tests filtered out that don't match
     criteria.
+
+    Only the test modules which seltest.index finds matching tests in are
+    imported.
     """
     path = _expand_path(args['<path>'])
-    modules = _get_modules_from_path(path)
+    names = [module['module'] for module in _get_indexed_modules(args)]
+    modules = _get_modules_from_path(path, names)
     classes = _get_test_classes_from_modules(modules)
     classes = _filter_classes(classes, args)
     classes = _filter_tests(classes, args)
     return classes
 
 
+def _list_tests(args):
+    """
+    Print the tests matching args, as found by seltest.index: only modules it
+    can't index are imported.
+    """
+    modules = _get_indexed_modules(args)
+    classes = []
+    for module in modules:
+        if not module['dynamic']:
+            classes.extend(module['classes'])
+    dynamic = [module['module'] for module in modules if module['dynamic']]
+    if dynamic:
+        imported = _get_test_classes_from_modules(
+            _get_modules_from_path(args['<path>'], dynamic))
+        imported = _filter_tests(_filter_classes(imported, args), args)
+        for Test in imported:
+            if args['--filter'] and not Test.__test_methods:
+                continue
+            classes.append({'name': Test.__name__,
+                            'tests': [{'name': test.__name,
+                                       'doc': test.__doc__}
+                                      for test in Test.__test_methods]})
+
+    durations = {}
+    if args['-v']:
+        durations = history.load(_expand_path(args['--output']
+                                              or args['<path>']))
+    print('All matched tests:')
+    for cls in classes:
+        print(' {}: {} tests'.format(cls['name'], len(cls['tests'])))
+        for test in cls['tests']:
+            if test['name'] in durations:
+                duration = history.format_duration(durations[test['name']])
+                print('   {} ({})'.format(test['name'], duration))
+            else:
+                print('   {}'.format(test['name']))
+            if args['-v'] and test['doc']:
+                print('     "{}"'.format(test['doc']))
+    _print_estimate([test['name'] for cls in classes for test in cls['tests']],
+                    durations, int(args['--workers']))
+
+
 def _start_interactive_session(driver):
     print('Starting interactive browsing session...')
     print('(Use the `driver` variable to control the browser)')
@@ -229,6 +417,7 @@ def _get_args():
 
 
 def _create_driver(args):
+    from selenium import webdriver
     config = {}
     browser = args['--browser'].lower()
     if browser == 'remote':
@@ -297,32 +486,120 @@ class RedirectStdStreams(object):
         sys.stderr = self.old_stderr
 
 
-def _start_reverse_proxy(host, show_logs=False):
-    # This socket business is to ensure we get a free port to bind to.
-    sock = socket.socket()
-    sock.bind(('', 0))
-    port = sock.getsockname()[1]
-    sock.close()
+def _create_reverse_proxy(args, profile_requests=False):
+    cache_dir = args['--proxy-cache']
+    if cache_dir:
+        cache_dir = _expand_path(cache_dir)
+    return ReverseProxy(
+        show_logs=args['--display-proxy-server-logs'],
+        pool_size=int(args['--proxy-pool-size']),
+        cache_dir=cache_dir,
+        cache_size=int(float(args['--proxy-cache-size']) * 1024 * 1024),
+        profile_requests=profile_requests)
 
-    # Now we spin off our reverse proxy into another process, so that we can run
-    # tests through it.
-    def run_server(port, show_logs):
-        # Send the proxy server's logs to devnull if requested (default yes)
-        if show_logs:
-            devnull = None
-        else:
-            devnull = open(os.devnull, 'w')
 
-        with RedirectStdStreams(stdout=devnull, stderr=devnull):
-            seltest.proxy.init(host).run('localhost', port=port)
+class ReverseProxy(object):
+    """
+    A single reverse proxy process serving every host under test for a run.
+
+    Each host is proxied on its own port, so that pages can use absolute paths
+    for their assets.
+    """
+    def __init__(self, show_logs=False, pool_size=None, cache_dir=None,
+                 cache_size=None, profile_requests=False):
+        # None leaves pool_size and cache_size to seltest.proxy's defaults.
+        options = dict(cache_dir=cache_dir, profile_requests=profile_requests)
+        if pool_size is not None:
+            options['pool_size'] = pool_size
+        if cache_size is not None:
+            options['cache_size'] = cache_size
+        self.ports = {}
+        self._commands = multiprocessing.Queue()
+        self._replies = multiprocessing.Queue()
+        self._process = multiprocessing.Process(
+            target=_serve_reverse_proxy,
+            args=(self._commands, self._replies, show_logs, options))
+        self._process.daemon = True
+        self._process.start()
+
+    def add_hosts(self, hosts):
+        """
+        Return dict of host to proxy port, after starting to proxy any of hosts
+        not already proxied. Blocks until the proxy is ready for them.
+        """
+        new_hosts = [h for h in set(hosts) if h and h not in self.ports]
+        if new_hosts:
+            self._commands.put(new_hosts)
+            try:
+                self.ports.update(
+                    self._replies.get(timeout=PROXY_READY_TIMEOUT))
+            except Empty:
+                self.stop()
+                sys.exit('Timed out starting the reverse proxy for {}'.format(
+                    ', '.join(new_hosts)))
+        return self.ports
+
+    def stats(self):
+        """
+        Return dict of upstream connection pool stats (see
+        seltest.proxy.pool_stats), or None if nothing has been proxied.
+        """
+        if not self.ports:
+            return None
+        return self._get('stats')
 
-    p = multiprocessing.Process(target=run_server, args=(port, show_logs))
-    p.start()
-    return p, port
+    def dependencies(self):
+        """
+        Return dict of test name to the upstream responses the proxy has
+        served for it (see seltest.dependencies).
+        """
+        if not self.ports:
+            return {}
+        return self._get('dependencies')
 
+    def record_dependencies(self, on):
+        """
+        Have the proxy record the upstream responses it serves for each test,
+        for dependencies, if on, or stop recording them.
+        """
+        if self.ports:
+            self._get('record-dependencies?on={}'.format(int(bool(on))))
 
-def _kill_reverse_proxy(p):
-    p.terminate()
+    def trace(self):
+        """
+        Return list of trace events of the requests the proxy has served (see
+        seltest.profile), if it's profiling them.
+        """
+        if not self.ports:
+            return []
+        return self._get('trace')
+
+    def _get(self, endpoint):
+        """
+        Return the JSON response of the proxy's /__seltest__/<endpoint>.
+        """
+        import requests
+        port = list(self.ports.values())[0]
+        return requests.get('http://localhost:{}/__seltest__/{}'.format(
+            port, endpoint)).json()
+
+    def stop(self):
+        if self._process.is_alive():
+            self._process.terminate()
+        self._process.join()
+
+
+def _serve_reverse_proxy(commands, replies, show_logs, options):
+    # Send the proxy server's logs to devnull if requested (default yes)
+    if show_logs:
+        devnull = None
+    else:
+        devnull = open(os.devnull, 'w')
+
+    # Imported here, so only the proxy's process pays for importing Flask.
+    import seltest.proxy
+    with RedirectStdStreams(stdout=devnull, stderr=devnull):
+        seltest.proxy.serve(commands, replies, **options)
 
 
 def _get_image_output_path(args):
@@ -339,7 +616,7 @@ def _get_image_output_path(args):
 
 
 def _list_config(args):
-    for key, val in args.iteritems():
+    for key, val in args.items():
         if key.startswith('--'):
             if val is True:
                 print('{}'.format(key))
@@ -347,56 +624,668 @@ def _list_config(args):
                 print('{}={}'.format(key, val))
 
 
-def _run(args, driver):
+def _run_class(args, driver, Test, image_path, ports, profiler=None,
+               uploader=None, baselines=None):
+    """
+    Return (results, durations): dicts of the name of each test in Test to
+    whether it passed (or was updated), and how long it took in seconds. Runs
+    (or updates) the tests of Test with driver, through the reverse proxy
+    port in ports for its host, timing them with profiler, and giving the
+    images of failed tests to uploader (see seltest.uploads), if any.
+    baselines is the store of the baselines in image_path, if it's open.
+    """
+    options = {'wait_mode': args['--wait-mode'],
+               'network_idle': int(args['--network-idle']),
+               'profiler': profiler}
+    if args['update']:
+        suite = Test(driver, **options)
+    else:
+        suite = Test(driver, uploader=uploader, **options)
+    port = ports[suite.host]
+    if args['update']:
+        suite._update(image_path, port,
+                      wait=args['--wait'],
+                      baselines=baselines)
+    else:
+        suite._run(image_dir=image_path,
+                   proxy_port=port,
+                   wait=args['--wait'],
+                   baselines=baselines)
+    return suite.results, suite.durations
+
+
+def _work(args, classes, test_jobs, image_path, ports, jobs, results):
+    """
+    Run tests from the jobs queue on a driver of this process' own.
+
+    Jobs are indices into test_jobs, a list of (class index, test name),
+    ending with None. For each, puts (index, job_results, output, events,
+    images) on the results queue, where job_results are those of _run_class
+    for just that test (None if it raised), output is everything it printed
+    while running, events its profile, and images the (name, path) of the
+    images it failed with, for the parent process to upload.
+
+    The baselines' bookkeeping is read once, and the worker's changes to it
+    merged into the latest version on disk once it's done.
+    """
+    driver = _create_driver(args)
+    profiler = Profiler(enabled=bool(args['--profile']),
+                        label='worker {}'.format(os.getpid()))
+    tests = [list(Test.__test_methods) for Test in classes]
+    baselines = store.open_store(image_path)
+    try:
+        with baselines.batch():
+            for idx in iter(jobs.get, None):
+                class_idx, name = test_jobs[idx]
+                Test = classes[class_idx]
+                Test.__test_methods = [test for test in tests[class_idx]
+                                       if test.__name == name]
+                output = io.StringIO()
+                deferred = uploads.Deferred()
+                with RedirectStdStreams(stdout=output, stderr=output):
+                    try:
+                        job_results = _run_class(
+                            args, driver, Test, image_path, ports, profiler,
+                            deferred, baselines)
+                    except Exception:
+                        traceback.print_exc()
+                        job_results = None
+                results.put((idx, job_results, output.getvalue(),
+                             profiler.events, deferred.images))
+                profiler.events = []
+    finally:
+        driver.quit()
+
+
+def _run_in_workers(args, classes, image_path, ports, num_workers,
+                    profiler, uploader=None):
+    """
+    Return (results, durations): dicts of the name of each test in classes
+    to whether it passed, and how long it took. Runs the tests across
+    num_workers processes, each with its own driver, longest first (see
+    seltest.history), printing each class' output in the order of classes
+    as it becomes available, adding their profiles to profiler, and giving
+    the images of failed tests to uploader, if any. Tests which didn't get
+    to run didn't pass.
+    """
+    class_tests = [[test.__name for test in Test.__test_methods]
+                   for Test in classes]
+    estimates = history.estimates(
+        [name for names in class_tests for name in names],
+        history.load(image_path))
+    test_jobs = sorted(
+        ((class_idx, name) for class_idx, names in enumerate(class_tests)
+         for name in names),
+        key=lambda job: -estimates[job[1]])
+    job_indices = dict((job, idx) for idx, job in enumerate(test_jobs))
+
+    jobs = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    for idx in range(len(test_jobs)):
+        jobs.put(idx)
+    workers = []
+    for _ in range(min(num_workers, len(test_jobs))):
+        jobs.put(None)
+        worker = multiprocessing.Process(
+            target=_work,
+            args=(args, classes, test_jobs, image_path, ports, jobs, results))
+        worker.start()
+        workers.append(worker)
+
+    finished = {}  # job index -> (job_results, output)
+    printed = [0]  # How many classes' output has been printed.
+
+    def print_finished_classes():
+        while printed[0] < len(classes):
+            idxs = [job_indices[(printed[0], name)]
+                    for name in class_tests[printed[0]]]
+            if not all(idx in finished for idx in idxs):
+                return
+            print(' for {}'.format(classes[printed[0]].__name__))
+            for idx in idxs:
+                sys.stdout.write(finished[idx][1])
+            sys.stdout.flush()
+            printed[0] += 1
+
+    try:
+        while len(finished) < len(test_jobs):
+            print_finished_classes()
+            try:
+                idx, job_results, output, events, images = results.get(
+                    timeout=1)
+            except Empty:
+                if any(w.is_alive() for w in workers):
+                    continue
+                try:  # Results may still be in flight from exited workers.
+                    idx, job_results, output, events, images = results.get(
+                        timeout=1)
+                except Empty:
+                    break
+            finished[idx] = (job_results, output)
+            profiler.extend(events)
+            if uploader:
+                for name, path in images:
+                    uploader.upload(name, path)
+    finally:
+        done = len(finished) == len(test_jobs)
+        for worker in workers:
+            worker.join(WORKER_EXIT_TIMEOUT if done else 0)
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+    results, durations = {}, {}
+    for idx, (_, name) in enumerate(test_jobs):
+        if idx not in finished:
+            finished[idx] = (None, '  ✗ {}: worker exited before running '
+                                   'it\n'.format(name))
+        job_results = finished[idx][0] or ({name: False}, {})
+        results.update(job_results[0])
+        durations.update(job_results[1])
+    print_finished_classes()
+    return results, durations
+
+
+def _select_changed(classes, image_path):
+    """
+    Return classes, with only the tests which need to run (see
+    seltest.dependencies.changed_tests) left in them.
+    """
+    recorded = dependencies.load(image_path)
+    if recorded is None:
+        print('No record of what tests depend on; running them all.')
+        return classes
+    changed = dependencies.changed_tests(recorded, classes, image_path)
+    total = sum(len(Test.__test_methods) for Test in classes)
+    print('{} of {} tests affected by changes.'.format(len(changed), total))
+    classes = [_filter_test_methods(Test, lambda name: name in changed)
+               for Test in classes]
+    return [Test for Test in classes if Test.__test_methods]
+
+
+def _select_shard(classes, args):
+    """
+    Return classes, with only the tests in args' --shard left in them (see
+    seltest.shards.assign).
+    """
+    shard = shards.parse(args['--shard'])
+    if shard is None:
+        sys.exit('--shard must be INDEX/COUNT, e.g. 1/4, not {}'.format(
+            args['--shard']))
+    index, count = shard
+    durations = None
+    if args['--durations']:
+        previous = shards.load_results(_expand_path(args['--durations']))
+        if previous is None:
+            print('No results in {}; sharding without durations.'.format(
+                args['--durations']))
+        else:
+            durations = shards.durations_of(previous)
+    names = [test.__name for Test in classes for test in Test.__test_methods]
+    selected = shards.assign(names, count, durations)[index - 1]
+    print('Shard {} of {}: {} of {} tests.'.format(index, count, len(selected),
+                                                   len(names)))
+    classes = [_filter_test_methods(Test, lambda name: name in selected)
+               for Test in classes]
+    return [Test for Test in classes if Test.__test_methods]
+
+
+def _results_path(args):
+    """
+    Return the absolute path args' results should be written to, or None.
+    """
+    if args['--results']:
+        return os.path.abspath(_expand_path(args['--results']))
+    shard = shards.parse(args['--shard'] or '')
+    if shard:
+        return os.path.abspath('seltest-results-{}-of-{}.json'.format(*shard))
+    return None
+
+
+def _merge(args):
+    """
+    Return whether all tests passed, according to the results files in args,
+    printing a report of them, and writing them combined to --results.
+    """
+    all_results = []
+    for path in args['<results>']:
+        results = shards.load_results(_expand_path(path))
+        if results is None:
+            sys.exit('No results in {}'.format(path))
+        all_results.append(results)
+    merged = shards.merge(all_results)
+    tests = merged['tests']
+    failed = sorted(name for name, test in tests.items() if not test['passed'])
+    missing = shards.missing_shards(merged)
+
+    if merged['shards']:
+        print('Merged shards {} of {}.'.format(
+            ', '.join(str(index) for index, _ in merged['shards']),
+            max(count for _, count in merged['shards'])))
+    for name in sorted(tests):
+        if tests[name]['passed'] and not args['-v']:
+            continue
+        duration = tests[name]['duration']
+        print(' {} {}{}'.format('✓' if tests[name]['passed'] else '✗', name,
+                                '' if duration is None
+                                else ' ({:.2f}s)'.format(duration)))
+    print('{} tests: {} passed, {} failed.'.format(
+        len(tests), len(tests) - len(failed), len(failed)))
+    if missing:
+        print('✗ Missing results for shards {}.'.format(
+            ', '.join(str(index) for index in missing)))
+    if args['--results']:
+        results_path = _expand_path(args['--results'])
+        shards.save_results(results_path, merged)
+        print('Wrote merged results to {}'.format(results_path))
+    return not failed and not missing
+
+
+def _migrate(args):
+    """
+    Move the baselines in args' image directory to the kind of store in
+    args (see seltest.store).
+    """
+    image_path = _get_image_output_path(args)
+    kind = args['--store']
+    if kind not in store.KINDS:
+        sys.exit('--store must be one of {}, not {}'.format(
+            ', '.join(store.KINDS), kind))
+    source = store.open_store(image_path)
+    if source.kind == kind:
+        print('Baselines in {} are already in a {} store.'.format(image_path,
+                                                                  kind))
+        return
+    count = store.migrate(source, store.new_store(image_path, kind))
+    print('Moved {} baselines to a {} store.'.format(count, kind))
+
+
+def _gc(args):
+    """
+    Remove the baselines of tests which no longer exist, and the blobs no
+    baseline uses, from the blob store in args' image directory.
+
+    Every test module is imported, whatever args' filters, so that only the
+    baselines of tests which really are gone are removed.
+    """
+    image_path = _get_image_output_path(args)
+    baselines = store.open_store(image_path)
+    if baselines.kind != 'blobs':
+        sys.exit('{} has no blob store to collect; see `sel migrate`.'.format(
+            image_path))
+    classes = _get_test_classes_from_modules(
+        _get_modules_from_path(_expand_path(args['<path>'])))
+    names = set(name for Test in classes for test in Test.__test_methods
+                for name in _screenshot_names(Test, test))
+    removed, blobs = baselines.gc(names, pack=args['--pack'])
+    print('Removed {} baselines of tests which no longer exist, and {} '
+          'unused blobs.'.format(removed, blobs))
+    if args['--pack']:
+        print('Packed the blobs left.')
+
+
+def _print_proxy_stats(stats):
+    if stats:
+        print('Proxy made {requests} upstream requests on {new_connections} '
+              'new connections ({pool_hits} reused a pooled connection)'
+              .format(**stats))
+        if 'cache_hits' in stats:
+            print('Proxy cache served {cache_hits} responses fresh and '
+                  '{cache_revalidated} after revalidating; {cache_misses} '
+                  'missed'.format(**stats))
+
+
+def _run(args, driver, proxy=None):
+    """
+    Return whether the command in args succeeded, running it with driver,
+    and proxy (a ReverseProxy), if given, or one of its own.
+    """
     if args['interactive']:
         _start_interactive_session(driver)
+    elif args['list']:
+        _list_tests(args)
+    elif args['watch']:
+        _watch(args, driver)
     else:
         classes = _get_filtered_classes_to_run(args)
         image_path = _get_image_output_path(args)
-        proxy_logs = args['--display-proxy-server-logs']
-        if not args['list'] and args['-v']:
+        if args['-v']:
             print('Saving images to {}'.format(image_path))
-        if args['test']:
-            print('Running tests...')
-            passing_tests = []
-            failing_tests = []
-            for Test in classes:
-                print(' for {}'.format(Test.__name__))
-                imgur_client_id = args['--imgur_client_id']
-                suite = Test(driver,
-                             imgur_client_id=imgur_client_id)
-                p, port = _start_reverse_proxy(suite.host, proxy_logs)
-                passes = suite._run(image_dir=image_path,
-                                    proxy_port=port,
-                                    wait=args['--wait'])
-                if passes:
-                    passing_tests.append(Test)
-                else:
-                    failing_tests.append(Test)
-                _kill_reverse_proxy(p)
-            if failing_tests:
+        if args['test'] or args['update']:
+            if args['test']:
+                print('Running tests...')
+            else:
+                print('Updating images...')
+            if args['--shard']:
+                classes = _select_shard(classes, args)
+            if args['--changed-only']:
+                classes = _select_changed(classes, image_path)
+            own_proxy = proxy is None
+            if own_proxy:
+                proxy = _create_reverse_proxy(
+                    args, profile_requests=bool(args['--profile']))
+            profiler = Profiler(enabled=bool(args['--profile']), label='sel')
+            try:
+                results, durations, _ = _run_tests(args, driver, classes,
+                                                   image_path, proxy, profiler)
+            finally:
+                if own_proxy:
+                    proxy.stop()
+            passes = all(results.values())
+            results_path = _results_path(args)
+            if results_path:
+                shards.write_results(
+                    results_path, 'test' if args['test'] else 'update',
+                    results, durations,
+                    shard=shards.parse(args['--shard'] or ''))
+                print('Wrote results to {}'.format(results_path))
+            if args['--profile']:
+                profile_path = _expand_path(args['--profile'])
+                profiler.write(profile_path)
+                profiler.print_summary()
+                print('Wrote profile to {}'.format(profile_path))
+            if args['test'] and not passes:
                 return False
-        elif args['update']:
-            print('Updating images...')
-            for Test in classes:
-                print(' for {}'.format(Test.__name__))
-                suite = Test(driver)
-                p, port = _start_reverse_proxy(suite.host, proxy_logs)
-                suite._update(image_path, port,
-                                     wait=args['--wait'])
-                _kill_reverse_proxy(p)
-        elif args['list']:
-            print('All matched tests:')
-            for Test in classes:
-                methods = Test.__test_methods
-                print(' {}: {} tests'.format(Test.__name__, len(methods)))
-                for test in methods:
-                    print('   {}'.format(test.__name))
-                    if args['-v'] and test.__doc__:
-                        print('     "{}"').format(test.__doc__)
     return True
 
 
+def _run_tests(args, driver, classes, image_path, proxy, profiler):
+    """
+    Return (results, durations, served): dicts of the name of each test in
+    classes to whether it passed (or was updated), how long it took, and the
+    upstream responses proxy served for it (see seltest.dependencies), after
+    running them with driver, or in workers, and recording what they depend
+    on. The images of failed tests are uploaded as they fail, if args ask
+    for it, and the links to them printed at the end.
+
+    What tests depend on is only recorded for the commands which use it
+    (`--changed-only` and watch): recording it stops the browser caching
+    anything. Otherwise served is empty, and only failures are recorded.
+    """
+    ports = proxy.add_hosts(_host_of(Test) for Test in classes)
+    record = bool(args['--changed-only'] or args['watch'])
+    proxy.record_dependencies(record)
+    num_workers = int(args['--workers'])
+    _print_estimate(
+        [test.__name for Test in classes for test in Test.__test_methods],
+        history.load(image_path), num_workers)
+    uploader = None
+    if args['--imgur_client_id'] and not args['update']:
+        uploader = uploads.Uploader(args['--imgur_client_id'],
+                                    args['--upload-endpoint'])
+    try:
+        if num_workers > 1:
+            results, durations = _run_in_workers(
+                args, classes, image_path, ports, num_workers, profiler,
+                uploader)
+        else:
+            results, durations = {}, {}
+            # Write the baselines' bookkeeping once, for the whole run.
+            baselines = store.open_store(image_path)
+            with baselines.batch():
+                for Test in classes:
+                    print(' for {}'.format(Test.__name__))
+                    class_results, class_durations = _run_class(
+                        args, driver, Test, image_path, ports, profiler,
+                        uploader, baselines)
+                    results.update(class_results)
+                    durations.update(class_durations)
+    finally:
+        if uploader:
+            uploads.print_uploads(uploader.finish())
+    served = proxy.dependencies()
+    dependencies.record(image_path, classes, results,
+                        served if record else None)
+    history.record(image_path, durations)
+    if args['-v']:
+        _print_proxy_stats(proxy.stats())
+    if args['--profile']:
+        profiler.extend(proxy.trace())
+    return results, durations, served
+
+
+def _print_estimate(names, durations, num_workers):
+    """
+    Print how long running the tests named names on num_workers workers
+    should take, given the durations (see seltest.history) of previous runs,
+    if there are any.
+    """
+    known = [name for name in names if name in durations]
+    if not known:
+        return
+    seconds = history.run_time(history.estimates(names, durations),
+                               num_workers)
+    unknown = len(names) - len(known)
+    print('Estimated time: {}{}'.format(
+        history.format_duration(seconds),
+        ' ({} tests have no history)'.format(unknown) if unknown else ''))
+
+
+def _watch(args, driver):
+    """
+    Run the tests affected by each change to their modules, or to the files
+    in args' --watch-dir, as they're saved, until interrupted.
+
+    Tests are affected by changes to their own module, and to the files they
+    loaded from the app. Changes to files which no test loaded (e.g.
+    templates, or server code) affect the tests whose responses they changed.
+    """
+    path = _expand_path(args['<path>'])
+    image_path = _get_image_output_path(args)
+    watch_dirs = [_expand_path(d)
+                  for d in (args['--watch-dir'] or '').split(',') if d]
+    # Screenshots (and our bookkeeping) may be written to a watched directory.
+    ignore = [image_path, os.path.join(path, index.INDEX_FILENAME)]
+    proxy = _create_reverse_proxy(args,
+                                  profile_requests=bool(args['--profile']))
+    profiler = Profiler(enabled=bool(args['--profile']), label='sel')
+    recorded = dependencies.load(image_path) or {}
+    served = dict((name, test['resources'])
+                  for name, test in recorded.items())
+
+    def snapshot():
+        modules = dict((os.path.join(path, f),
+                        os.stat(os.path.join(path, f)).st_mtime)
+                       for f in index.test_filenames(path))
+        return modules, watch.snapshot(watch_dirs, ignore)
+
+    def run(classes):
+        if classes:
+            results, _, test_served = _run_tests(args, driver, classes,
+                                                 image_path, proxy, profiler)
+            served.update(test_served)
+            print('All tests pass.' if all(results.values()) else FAILED_MSG)
+        print('Watching for changes...')
+
+    signal.signal(signal.SIGTERM, _interrupt)  # See _serve_daemon.
+    try:
+        print('Running tests which are out of date...')
+        modules, files = snapshot()
+        run(_select_changed(_get_filtered_classes_to_run(args), image_path))
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            new_modules, new_files = snapshot()
+            if new_modules == modules and new_files == files:
+                continue
+            time.sleep(WATCH_SETTLE)
+            new_modules, new_files = snapshot()
+            changed_modules = watch.changed_files(modules, new_modules)
+            changed_files = watch.changed_files(files, new_files)
+            modules, files = new_modules, new_files
+            classes = _affected_classes(args, changed_modules, changed_files,
+                                        watch_dirs, served)
+            run(classes)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        proxy.stop()
+        if args['--profile']:
+            profile_path = _expand_path(args['--profile'])
+            profiler.write(profile_path)
+            print('Wrote profile to {}'.format(profile_path))
+
+
+def _affected_classes(args, changed_modules, changed_files, watch_dirs,
+                      served):
+    """
+    Return list of the test classes matching args with the tests affected by
+    changes to the test modules changed_modules and the app's changed_files
+    (see _watch) left in them, printing why they're affected. Only the modules
+    of those tests are imported, anew.
+
+    served is a dict of each test's name to what the proxy served for it.
+    """
+    names = set()
+    for filename in sorted(changed_modules):
+        print('Changed: {}'.format(filename))
+    for filename in sorted(changed_files):
+        print('Changed: {}'.format(filename))
+    tests, unmatched = watch.tests_using_files(changed_files, watch_dirs,
+                                               served)
+    names.update(tests)
+    if unmatched:
+        urls = {}
+        for test_urls in served.values():
+            urls.update(test_urls)
+        names.update(watch.tests_using_urls(dependencies.changed_urls(urls),
+                                            served))
+
+    changed = set(os.path.basename(f).split('.')[0] for f in changed_modules)
+    to_import = set()
+    for module in _get_indexed_modules(args):
+        tests = set(test['name'] for cls in module['classes']
+                    for test in cls['tests'])
+        if (module['dynamic'] or module['module'] in changed
+                or names.intersection(tests)):
+            to_import.add(module['module'])
+    modules = _get_modules_from_path(args['<path>'], to_import)
+    classes = _filter_tests(_filter_classes(
+        _get_test_classes_from_modules(modules), args), args)
+    affected = []
+    for Test in classes:
+        if Test.__module__ not in changed:
+            Test = _filter_test_methods(Test, lambda name: name in names)
+        if Test.__test_methods:
+            affected.append(Test)
+    count = sum(len(Test.__test_methods) for Test in affected)
+    print('{} tests affected.'.format(count))
+    return affected
+
+
+def _serve_daemon(args):
+    """
+    Serve the commands sent by `sel` (see _run_on_daemon) until interrupted,
+    with drivers, and a reverse proxy, kept open between them.
+    """
+    socket_path = _expand_path(args['--daemon-socket'])
+    # The proxy always records the requests it serves, for the commands which
+    # ask for a profile; the rest are discarded.
+    proxy = _create_reverse_proxy(args, profile_requests=True)
+    drivers = {}  # _driver_key(args) -> (driver, its initial window size)
+
+    def handle(request, output):
+        request_args = request['args']
+        with RedirectStdStreams(stdout=output, stderr=output):
+            try:
+                # Forget what the proxy recorded for earlier commands.
+                proxy.trace()
+                proxy.dependencies()
+                driver = None
+                if ((request_args['test'] or request_args['update'])
+                        and int(request_args['--workers']) == 1):
+                    driver = _warm_driver(drivers, request_args, proxy.ports)
+                passes = _run(request_args, driver, proxy)
+            except SystemExit as e:
+                return e.code
+            except Exception:
+                traceback.print_exc()
+                return FAILED_MSG
+        return 0 if passes else FAILED_MSG
+
+    # Close the browsers when we're killed, as when interrupted. (Commands
+    # exiting raise SystemExit, so that can't be what stops us.)
+    signal.signal(signal.SIGTERM, _interrupt)
+    print('Listening on {}'.format(socket_path))
+    try:
+        daemon.serve(socket_path, handle)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for driver, _ in drivers.values():
+            driver.quit()
+        proxy.stop()
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def _warm_driver(drivers, args, ports):
+    """
+    Return the driver for args in drivers (see _serve_daemon), reset for a
+    new command, creating it if there isn't one, or it's stopped working.
+    """
+    key = _driver_key(args)
+    if key in drivers:
+        driver, window_size = drivers[key]
+        try:
+            _reset_driver(driver, ports, window_size)
+            return driver
+        except Exception:  # e.g. the browser's been closed.
+            print('Restarting the browser...')
+            try:
+                driver.quit()
+            except Exception:
+                pass
+    driver = _create_driver(args)
+    drivers[key] = (driver, driver.get_window_size())
+    return driver
+
+
+def _driver_key(args):
+    return tuple(args[option] for option in DRIVER_OPTIONS)
+
+
+def _reset_driver(driver, ports, window_size):
+    """
+    Return driver as it was when created, with window_size, only one window,
+    and no cookies or storage from any of the hosts proxied on ports.
+    """
+    handles = driver.window_handles
+    for handle in handles[1:]:
+        driver.switch_to.window(handle)
+        driver.close()
+    driver.switch_to.window(handles[0])
+    for port in sorted(set(ports.values())):
+        driver.get('http://localhost:{}/__seltest__/blank'.format(port))
+        driver.execute_script(CLEAR_STORAGE_JS)
+    # Cookies aren't specific to a port, so those of every proxied host are
+    # deleted from whichever of them the driver is on.
+    driver.delete_all_cookies()
+    driver.set_window_size(window_size['width'], window_size['height'])
+    return driver
+
+
+def _run_on_daemon(args):
+    """
+    Run the command in args on `sel daemon`, exiting with its exit code, if
+    it's running. Otherwise, return.
+    """
+    if (args['interactive'] or args['daemon'] or args['watch']
+            or args['merge'] or args['migrate'] or args['gc']
+            or args['--no-daemon']):
+        return
+    sock = daemon.connect(_expand_path(args['--daemon-socket']))
+    if sock is None:
+        return
+    args = dict(args)
+    for option in PATH_OPTIONS:
+        if args.get(option):
+            args[option] = os.path.abspath(_expand_path(args[option]))
+    args['--results'] = _results_path(args)
+    sys.exit(daemon.request(sock, {'args': args}))
+
+
 def main(args=None):
     if args is None:
         args = _get_args()
@@ -405,8 +1294,22 @@ def main(args=None):
         _list_config(args)
         sys.exit(0)
 
+    if args['daemon']:
+        _serve_daemon(args)
+        sys.exit(0)
+    if args['merge']:
+        sys.exit(0 if _merge(args) else FAILED_MSG)
+    if args['migrate']:
+        _migrate(args)
+        sys.exit(0)
+    if args['gc']:
+        _gc(args)
+        sys.exit(0)
+    _run_on_daemon(args)
+
     driver = None
-    if not args['list']:
+    parallel = int(args['--workers']) > 1 and not args['interactive']
+    if not args['list'] and not parallel:
         driver = _create_driver(args)
 
     passes = False
@@ -419,7 +1322,7 @@ def main(args=None):
     if passes:
         sys.exit(0)
     else:
-        sys.exit('ERROR: some tests failed')
+        sys.exit(FAILED_MSG)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+The local socket `sel daemon` serves commands on, and the client `sel` sends
+them with.
+
+Messages are JSON objects, one per line, over a unix socket. A client sends a
+single request, and the daemon replies with any number of {"output": text}
+messages, streaming what the command prints as it runs, and finally
+{"exit": code}, with the code the command would have exited with (see
+sys.exit).
+"""
+from __future__ import absolute_import, unicode_literals
+
+import json
+import os
+import socket
+import sys
+
+
+SOCKET_PATH = '~/.seltest-daemon.sock'
+FAILED_TO_FINISH_MSG = 'ERROR: the seltest daemon exited before finishing.'
+
+
+def serve(socket_path, handle):
+    """
+    Serve the requests made to socket_path, one at a time, until interrupted.
+
+    handle is called with each request (a dict) and a file-like object to
+    write its output to, and returns the code it exits with.
+    """
+    if os.path.exists(socket_path):
+        sock = connect(socket_path)
+        if sock is not None:
+            sock.close()
+            sys.exit('A seltest daemon is already listening on {}'.format(
+                socket_path))
+        os.remove(socket_path)  # Left by a daemon which didn't exit cleanly.
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)  # Only this user may run things on our browsers.
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(umask)
+    server.listen(5)
+    try:
+        while True:
+            conn, _ = server.accept()
+            try:
+                _handle(conn, handle)
+            finally:
+                conn.close()
+    finally:
+        server.close()
+        os.remove(socket_path)
+
+
+def connect(socket_path):
+    """
+    Return a socket connected to the daemon listening on socket_path, or None
+    if there isn't one.
+    """
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+
+def request(sock, message, out=None):
+    """
+    Return the exit code of the command message, sent to the daemon on sock,
+    writing its output to out (default sys.stdout) as it arrives.
+    """
+    out = out or sys.stdout
+    f = sock.makefile('rwb')
+    try:
+        _send(f, message)
+        for line in f:
+            reply = json.loads(line.decode('utf-8'))
+            if 'output' in reply:
+                out.write(reply['output'])
+                out.flush()
+            elif 'exit' in reply:
+                return reply['exit']
+    finally:
+        f.close()
+        sock.close()
+    return FAILED_TO_FINISH_MSG
+
+
+def _handle(conn, handle):
+    f = conn.makefile('rwb')
+    try:
+        try:
+            message = json.loads(f.readline().decode('utf-8'))
+        except ValueError:
+            return
+        output = _Output(f)
+        code = handle(message, output)
+        output.send({'exit': code})
+    finally:
+        f.close()
+
+
+def _send(f, message):
+    f.write(json.dumps(message).encode('utf-8') + b'\n')
+    f.flush()
+
+
+class _Output(object):
+    """
+    A file-like object sending what's written to it to the client, as output
+    messages. If the client goes away, the rest is dropped, so the command
+    can finish (and leave the browser as it should).
+    """
+    def __init__(self, f):
+        self._f = f
+        self.closed = False
+
+    def write(self, text):
+        if isinstance(text, bytes):
+            text = text.decode('utf-8', 'replace')
+        if text:
+            self.send({'output': text})
+
+    def send(self, message):
+        if self.closed:
+            return
+        try:
+            _send(self._f, message)
+        except (IOError, OSError, socket.error):
+            self.closed = True
+
+    def flush(self):
+        pass
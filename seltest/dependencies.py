@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Bookkeeping of what each test's page depended on, for `sel test
+--changed-only`.
+
+The proxy records every upstream response served for each test, with a hash
+of its content (see seltest.proxy). Once a test passes (or is updated), those
+are saved in dependencies.json, in the image directory, along with a hash of
+the test's module, and of the pixels of each of its baselines. A test only
+needs to run again once its module, one of its baselines or one of those
+responses has changed, which can be checked without a browser, mostly with
+conditional requests.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+import json
+import os
+import sys
+import threading
+try:  # py2
+    from Queue import Queue
+except ImportError:  # py3
+    from queue import Queue
+
+from seltest import store
+from seltest.helpers import atomic_write
+from seltest.seltest import _screenshot_names
+
+
+DEPENDENCIES_FILENAME = 'dependencies.json'
+DEPENDENCIES_VERSION = 2
+CHECK_THREADS = 8
+CHECK_TIMEOUT = 10  # seconds
+
+
+def load(image_dir):
+    """
+    Return dict of test name to its recorded dependencies, or None if there
+    aren't any recorded for image_dir.
+    """
+    try:
+        with open(os.path.join(image_dir, DEPENDENCIES_FILENAME)) as f:
+            recorded = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if recorded.get('version') != DEPENDENCIES_VERSION:
+        return None
+    return recorded['tests']
+
+
+def record(image_dir, classes, results, served):
+    """
+    Save the dependencies of the tests in classes which just ran.
+
+    results maps the name of each test which ran to whether it passed (or
+    was updated), and served maps test names to the responses the proxy
+    served for them, or is None if it wasn't recording them, in which case
+    the dependencies recorded before are kept for the tests which passed.
+    Tests which didn't pass (or didn't get to run) are forgotten, so they
+    run again next time.
+    """
+    tests = load(image_dir) or {}
+    module_hashes = _module_hashes(classes)
+    baselines = store.open_store(image_dir)
+    with baselines.batch():
+        for Test in classes:
+            for test in Test.__test_methods:
+                name = getattr(test, '__name')
+                if served is None:
+                    if not results.get(name):
+                        tests.pop(name, None)
+                elif results.get(name) and served.get(name):
+                    tests[name] = {
+                        'module_hash': module_hashes[Test],
+                        'baselines': _baseline_hashes(baselines, Test, test),
+                        'resources': served[name]}
+                else:
+                    tests.pop(name, None)
+    atomic_write(os.path.join(image_dir, DEPENDENCIES_FILENAME),
+                 json.dumps({'version': DEPENDENCIES_VERSION, 'tests': tests},
+                            indent=1, sort_keys=True).encode('utf-8'))
+
+
+def changed_tests(tests, classes, image_dir):
+    """
+    Return set of the names of the tests in classes which need to run, given
+    the recorded dependencies tests (see load): those which haven't passed
+    since their dependencies were recorded, or whose module, baselines (any
+    of which may be missing, or replaced) or any of whose dependencies have
+    changed since.
+    """
+    module_hashes = _module_hashes(classes)
+    baselines = store.open_store(image_dir)
+    changed = set()
+    to_check = {}  # test name -> its resources
+    with baselines.batch():
+        for Test in classes:
+            for test in Test.__test_methods:
+                name = getattr(test, '__name')
+                recorded = tests.get(name)
+                if (recorded is None
+                        or module_hashes[Test] is None
+                        or recorded['module_hash'] != module_hashes[Test]
+                        or recorded['baselines'] != _baseline_hashes(
+                            baselines, Test, test)):
+                    changed.add(name)
+                else:
+                    to_check[name] = recorded['resources']
+
+    urls = {}
+    for resources in to_check.values():
+        urls.update(resources)
+    changed_resources = changed_urls(urls)
+    for name, resources in to_check.items():
+        if changed_resources.intersection(resources):
+            changed.add(name)
+    return changed
+
+
+def _baseline_hashes(baselines, Test, test):
+    """
+    Return dict of the name of each of test's screenshots to the hash of its
+    baseline's pixels in the store baselines, or None if it has none.
+    """
+    return dict((shot_name, baselines.pixel_hash(shot_name))
+                for shot_name in _screenshot_names(Test, test))
+
+
+def changed_urls(resources):
+    """
+    Return set of the urls in resources (a dict of url to what was served
+    for it) whose content has changed, checking CHECK_THREADS at a time.
+    """
+    import requests  # Only needed here, and slow to import.
+    changed = set()
+    jobs = Queue()
+    for url in resources:
+        jobs.put(url)
+    def check():
+        session = requests.Session()
+        while True:
+            url = jobs.get()
+            if url is None:
+                return
+            if _is_changed(session, url, resources[url]):
+                changed.add(url)  # set.add is atomic.
+    threads = []
+    for _ in range(min(CHECK_THREADS, len(resources))):
+        jobs.put(None)
+        thread = threading.Thread(target=check)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return changed
+
+
+def _is_changed(session, url, served):
+    """
+    Return True if url would now be served differently to served (see
+    seltest.proxy._recorded), or can't be checked.
+    """
+    import requests
+    if served['hash'] is None:
+        return True
+    headers = {'Accept-Encoding': 'identity'}
+    if served['accept']:
+        headers['Accept'] = served['accept']
+    if served['etag']:
+        headers['If-None-Match'] = served['etag']
+    if served['last_modified']:
+        headers['If-Modified-Since'] = served['last_modified']
+    try:
+        response = session.get(url, headers=headers, timeout=CHECK_TIMEOUT)
+    except requests.RequestException:
+        return True
+    if response.status_code == 304:
+        return False
+    return (response.status_code != served['status']
+            or hashlib.sha1(response.content).hexdigest() != served['hash'])
+
+
+def _module_hashes(classes):
+    """
+    Return dict of each of classes to a hash of the source of its module.
+    """
+    hashes = {}
+    for Test in classes:
+        path = getattr(sys.modules[Test.__module__], '__file__', None) or ''
+        if path.endswith(('.pyc', '.pyo')):
+            path = path[:-1]
+        try:
+            with open(path, 'rb') as f:
+                hashes[Test] = hashlib.sha1(f.read()).hexdigest()
+        except IOError:
+            hashes[Test] = None
+    return hashes
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Tolerant, pixel-by-pixel comparison of screenshots.
+
+Requires NumPy, which is only imported when a test asks for a tolerance or a
+diff mask is written.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import PIL.Image as Image
+
+from collections import deque, namedtuple
+import io
+
+np = None  # NumPy, once _import_numpy has imported it.
+
+
+BLOCK_SIZE = 16  # pixels; changed pixels this close are boxed together.
+MASK_COLOR = (255, 0, 0)
+
+Diff = namedtuple('Diff', ['passes', 'differing', 'ratio', 'boxes', 'mask'])
+
+
+def diff(old_png, new_png, threshold=0, max_ratio=0.0):
+    """
+    Return a Diff of two PNGs (bytes).
+
+    A pixel differs if any of its channels differ by more than threshold,
+    which is either one number for all channels or a list with one per
+    channel (e.g. [R, G, B, A]). The diff passes if no more than max_ratio of
+    all pixels differ.
+
+    Diff.boxes is a list of (left, top, right, bottom) bounding boxes of the
+    changed regions, and Diff.mask a boolean array of the pixels that differ
+    (None if the images' sizes differ, in which case the diff fails).
+    """
+    if not available():
+        raise ImportError('NumPy is required to compare screenshots with a '
+                          'tolerance: `pip install numpy`.')
+    old, new = _to_array(old_png), _to_array(new_png)
+    if old.shape != new.shape:
+        return Diff(False, None, 1.0, [], None)
+    # Comparing whole pixels as 32-bit ints is much faster than comparing
+    # channels, so we only compare channels of the pixels which changed.
+    mask = old.view(np.uint32)[:, :, 0] != new.view(np.uint32)[:, :, 0]
+    thresholds = np.clip(np.asarray(threshold), 0, 255).astype(np.uint8)
+    if thresholds.any():
+        if thresholds.ndim:  # Channels without a threshold are exact.
+            thresholds = np.pad(thresholds, (0, 4 - len(thresholds)),
+                                'constant')
+        changed = np.nonzero(mask)
+        old_px, new_px = old[changed], new[changed]
+        delta = np.maximum(old_px, new_px) - np.minimum(old_px, new_px)
+        mask[changed] = (delta > thresholds).any(axis=1)
+    differing = int(np.count_nonzero(mask))
+    ratio = differing / float(mask.size)
+    return Diff(ratio <= max_ratio, differing, ratio,
+                bounding_boxes(mask) if differing else [], mask)
+
+
+def available():
+    """
+    Return True if NumPy is installed, importing it if so.
+    """
+    return _import_numpy() is not None
+
+
+def bounding_boxes(mask, block_size=BLOCK_SIZE):
+    """
+    Return list of (left, top, right, bottom) boxes around each region of
+    True in the 2D boolean array mask, sorted top to bottom.
+
+    Changed pixels within a block_size of each other are in the same region.
+    """
+    height, width = mask.shape
+    rows, cols = -(-height // block_size), -(-width // block_size)
+    padded = np.zeros((rows * block_size, cols * block_size), dtype=bool)
+    padded[:height, :width] = mask
+    blocks = padded.reshape(rows, block_size, cols, block_size).any(axis=(1, 3))
+
+    boxes = []
+    seen = np.zeros_like(blocks)
+    for start in zip(*np.nonzero(blocks)):
+        if seen[start]:
+            continue
+        seen[start] = True
+        top, left, bottom, right = start[0], start[1], start[0], start[1]
+        queue = deque([start])
+        while queue:
+            row, col = queue.popleft()
+            top, bottom = min(top, row), max(bottom, row)
+            left, right = min(left, col), max(right, col)
+            for r in range(max(row - 1, 0), min(row + 2, rows)):
+                for c in range(max(col - 1, 0), min(col + 2, cols)):
+                    if blocks[r, c] and not seen[r, c]:
+                        seen[r, c] = True
+                        queue.append((r, c))
+        # Shrink the box from whole blocks to the changed pixels within them.
+        y0, x0 = top * block_size, left * block_size
+        region = mask[y0:(bottom + 1) * block_size, x0:(right + 1) * block_size]
+        ys = np.flatnonzero(region.any(axis=1))
+        xs = np.flatnonzero(region.any(axis=0))
+        boxes.append((int(x0 + xs[0]), int(y0 + ys[0]),
+                      int(x0 + xs[-1] + 1), int(y0 + ys[-1] + 1)))
+    return sorted(boxes, key=lambda box: (box[1], box[0]))
+
+
+def mask_png(old_png, mask):
+    """
+    Return a PNG (bytes) of the old screenshot, faded, with the pixels that
+    differ according to mask highlighted.
+    """
+    _import_numpy()
+    with Image.open(io.BytesIO(old_png)) as old:
+        faded = np.asarray(old.convert('L'), dtype=np.uint8) // 4 + 191
+    out = np.repeat(faded[:, :, np.newaxis], 3, axis=2)
+    out[mask] = MASK_COLOR
+    buf = io.BytesIO()
+    Image.fromarray(out, 'RGB').save(buf, 'PNG', compress_level=1)
+    return buf.getvalue()
+
+
+def _import_numpy():
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            return None
+        np = numpy
+    return np
+
+
+def _to_array(png):
+    with Image.open(io.BytesIO(png)) as image:
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        return np.ascontiguousarray(image, dtype=np.uint8)
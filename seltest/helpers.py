@@ -1,4 +1,23 @@
 # -*- coding: utf-8 -*-
+import base64
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import threading
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+# Query parameters carrying a test's hidden selectors, and its name, to the
+# proxy, which strips them before the request reaches the server under test.
+HIDE_PARAM = '__seltest_hide'
+TEST_PARAM = '__seltest_test'
+HIDE_STYLE_ID = '__seltest_hide'
+
 
 def url(url_str=''):
     """
@@ -61,9 +80,9 @@ def dontwaitfor(css_selector):
 
 def hide(css_selector):
     """
-    Hides (by setting `el.hidden = true` in javascript) elements matching the
-    selector. Useful for elements which may change from test to test and thus
-    should be hidden.
+    Hides (with a `display: none` stylesheet, from the page's first paint)
+    elements matching the selector. Useful for elements which may change from
+    test to test and thus should be hidden.
     """
     def decorator(method):
         if not isinstance(getattr(method, '__hide', None), list):
@@ -73,6 +92,79 @@ def hide(css_selector):
     return decorator
 
 
+def tolerate(threshold=0, max_ratio=0.0):
+    """
+    Decorator allowing the screenshot to differ slightly from the last one and
+    still pass. Pixels differ only if one of their channels differs by more
+    than threshold (a number, or a list of one per channel: [R, G, B, A]), and
+    the test passes if no more than max_ratio of all pixels differ.
+
+    Requires NumPy.
+    """
+    def decorator(method):
+        setattr(method, '__tolerance', {'threshold': threshold,
+                                        'max_ratio': max_ratio})
+        return method
+    return decorator
+
+
+def snapshot(css_selector):
+    """
+    Decorator limiting the screenshot to the region of the page containing
+    the elements matching the selector: the box bounding them. Cheaper to
+    capture, store and compare than the whole window, for tests of a single
+    component.
+
+    Each region added has its own screenshot; they're named in the order
+    they're written. Overrides the class-level `snapshot`.
+    """
+    def decorator(method):
+        if not isinstance(getattr(method, '__snapshots', None), list):
+            setattr(method, '__snapshots', [])
+        # Decorators apply bottom up; keep the order they're written in.
+        method.__snapshots.insert(0, css_selector)
+        return method
+    return decorator
+
+
+def hide_stylesheet(selectors):
+    """
+    Return the CSS hiding the elements matched by each of selectors.
+
+    Each selector gets its own rule, so that one invalid selector doesn't stop
+    the others from applying.
+    """
+    css = ''.join('{} {{ display: none !important; }}\n'.format(selector)
+                  for selector in selectors)
+    return css.replace('</', '<\\/')  # Mustn't end the <style> element.
+
+
+def encode_hide_param(selectors):
+    """
+    Return the value of HIDE_PARAM for a list of selectors.
+    """
+    data = json.dumps(list(selectors)).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_hide_param(value):
+    """
+    Return the list of selectors encoded in value by encode_hide_param, or []
+    if value is empty or malformed.
+    """
+    if not value:
+        return []
+    try:
+        data = base64.urlsafe_b64decode(str(value + '=' * (-len(value) % 4)))
+        selectors = json.loads(data.decode('utf-8'))
+    except (TypeError, ValueError):
+        return []
+    if not isinstance(selectors, list):
+        return []
+    return [selector for selector in selectors
+            if isinstance(selector, type(u''))]
+
+
 def with_metaclass(mcls):
     """
     For metaclass compatibility between Python 2 and 3.
@@ -86,3 +178,53 @@ def with_metaclass(mcls):
         body.pop('__weakref__', None)
         return mcls(cls.__name__, cls.__bases__, body)
     return decorator
+
+
+def makedirs(path):
+    """
+    Create directory path and its parents, if it doesn't already exist.
+    """
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):  # Lost a race to create it; fine.
+                raise
+
+
+def atomic_write(path, data):
+    """
+    Write bytes data to path, such that readers of path see either the old or
+    the new file in full, never a partially-written one.
+    """
+    tmp_path = '{}.{}-{}.tmp'.format(path, os.getpid(),
+                                     threading.current_thread().ident)
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    try:
+        os.replace(tmp_path, path)
+    except AttributeError:  # py2
+        os.rename(tmp_path, path)
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive lock for the file at path for the duration of the
+    block, so other processes taking it wait. A no-op where there's no fcntl,
+    e.g. Windows.
+
+    The lock is taken on a file in the temporary directory, named for path,
+    rather than one left lying around beside it.
+    """
+    if fcntl is None:
+        yield
+        return
+    lock_path = os.path.join(tempfile.gettempdir(), 'seltest-{}.lock'.format(
+        hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()))
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+How long each test has taken recently, for scheduling the longest tests
+first, and estimating how long runs will take.
+
+Each test's duration is an exponentially weighted moving average of the wall
+times of its runs, so one unusually slow (or fast) run doesn't throw it off.
+They're kept in history.json, in the image directory.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import heapq
+import json
+import os
+
+from seltest.helpers import atomic_write
+
+
+HISTORY_FILENAME = 'history.json'
+HISTORY_VERSION = 1
+WEIGHT = 0.3  # of the latest run in a test's average.
+DEFAULT_DURATION = 1.0  # seconds; the estimate when there's no history.
+
+
+def load(image_dir):
+    """
+    Return dict of test name to its average duration in seconds, for the
+    tests which have run with images in image_dir.
+    """
+    try:
+        with open(os.path.join(image_dir, HISTORY_FILENAME)) as f:
+            history = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    if history.get('version') != HISTORY_VERSION:
+        return {}
+    return history['durations']
+
+
+def record(image_dir, durations):
+    """
+    Add durations (a dict of test name to seconds) of tests which just ran to
+    their averages in image_dir's history.
+    """
+    if not durations:
+        return
+    history = load(image_dir)
+    for name, duration in durations.items():
+        if name in history:
+            duration = WEIGHT * duration + (1 - WEIGHT) * history[name]
+        history[name] = round(duration, 3)
+    atomic_write(os.path.join(image_dir, HISTORY_FILENAME),
+                 json.dumps({'version': HISTORY_VERSION,
+                             'durations': history},
+                            indent=1, sort_keys=True).encode('utf-8'))
+
+
+def estimates(names, durations):
+    """
+    Return dict of each of names to its duration in durations (a dict of
+    test name to seconds) or, if it has none, the median of those of names
+    which do.
+    """
+    known = sorted(durations[name] for name in names
+                   if durations.get(name) is not None)
+    if not known:
+        median = DEFAULT_DURATION
+    elif len(known) % 2:
+        median = known[len(known) // 2]
+    else:
+        median = (known[len(known) // 2 - 1] + known[len(known) // 2]) / 2.0
+    return dict((name, durations[name] if durations.get(name) is not None
+                 else median) for name in names)
+
+
+def longest_first(estimates, count):
+    """
+    Return list of count lists of the names of tests in estimates (see
+    estimates), assigning the longest first, each to whichever list has the
+    least total duration so far. Ties go by name, so it's deterministic.
+    """
+    assigned = [[] for _ in range(count)]
+    totals = [(0.0, idx) for idx in range(count)]  # A heap, smallest first.
+    for name in sorted(estimates, key=lambda name: (-estimates[name], name)):
+        total, idx = heapq.heappop(totals)
+        assigned[idx].append(name)
+        heapq.heappush(totals, (total + estimates[name], idx))
+    return assigned
+
+
+def run_time(estimates, workers):
+    """
+    Return an estimate of how many seconds running the tests in estimates
+    (see estimates) longest first, on workers workers, will take.
+    """
+    return max(sum(estimates[name] for name in names)
+               for names in longest_first(estimates, max(workers, 1)))
+
+
+def format_duration(seconds):
+    """
+    Return seconds as a string like 42.0s or 3m05s.
+    """
+    if seconds < 60:
+        return '{:.1f}s'.format(seconds)
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    return '{}m{:02d}s'.format(minutes, seconds)
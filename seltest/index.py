@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+Finds test classes and their tests without importing (or running) anything.
+
+Test modules are parsed, not imported, to find the subclasses of Base in
+them, their tests, and the tests' `@url`, `@waitfor` and `@hide` decorators.
+The result for each module is cached in .seltest-index.json, in the directory
+of tests, until the module changes.
+
+Modules which do something the index can't follow (e.g. subclass Base by
+another name) are marked dynamic, and have to be imported to find their tests.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import ast
+import hashlib
+import json
+import os
+
+from seltest.helpers import atomic_write
+
+
+INDEX_FILENAME = '.seltest-index.json'
+INDEX_VERSION = 2
+SELTEST_MODULES = ('seltest', 'seltest.seltest')
+# Methods decorated with these aren't functions, so aren't tests.
+NOT_TEST_DECORATORS = ('staticmethod', 'classmethod', 'property',
+                       'cached_property', 'getter', 'setter', 'deleter')
+
+
+def index(path):
+    """
+    Return list of dicts describing each test module in directory path, in
+    order of filename. Each has the module's name, whether it's dynamic, and
+    its classes, each of which has its name and tests.
+
+    Only modules which have changed since they were last indexed are parsed.
+    """
+    cache_path = os.path.join(path, INDEX_FILENAME)
+    cached = _read_cache(cache_path)
+    modules = []
+    changed = False
+    for filename in sorted(test_filenames(path)):
+        filepath = os.path.join(path, filename)
+        stat = os.stat(filepath)
+        entry = cached.get(filename)
+        if (entry is None or entry['mtime'] != stat.st_mtime
+                or entry['size'] != stat.st_size):
+            with open(filepath, 'rb') as f:
+                source = f.read()
+            source_hash = hashlib.sha1(source).hexdigest()
+            if entry is None or entry['hash'] != source_hash:
+                entry = index_source(source, filename)
+                entry['hash'] = source_hash
+            entry['mtime'] = stat.st_mtime
+            entry['size'] = stat.st_size
+            changed = True
+        modules.append(entry)
+    if changed or len(cached) != len(modules):
+        _write_cache(cache_path, modules)
+    return modules
+
+
+def test_filenames(path):
+    """
+    Return list of the filenames of the test modules in directory path.
+    """
+    return [f for f in os.listdir(path)
+            if os.path.isfile(os.path.join(path, f)) and f.startswith('test')
+            and f.endswith('.py')]
+
+
+def index_source(source, filename):
+    """
+    Return dict describing the test module with source (see index).
+    """
+    module = {'module': filename.split('.')[0], 'filename': filename,
+              'dynamic': False, 'classes': []}
+    try:
+        tree = ast.parse(source, filename)
+    except SyntaxError:
+        module['dynamic'] = True  # Importing it will say what's wrong.
+        return module
+
+    base_names, base_modules = _names_for_base(tree)
+    module_attrs = _literal_assignments(tree.body)
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.ClassDef):
+            continue
+        is_test_class = False
+        for base in node.bases:
+            if _refers_to_base(base, base_names, base_modules):
+                is_test_class = True
+            elif _final_name(base) == 'Base':
+                module['dynamic'] = True  # A Base we can't trace to seltest.
+        if is_test_class and node not in tree.body:
+            module['dynamic'] = True  # e.g. defined conditionally.
+        elif is_test_class:
+            module['classes'].append(_index_class(node, module_attrs))
+            if _binds_other_attributes(node):
+                module['dynamic'] = True  # They may be tests, too.
+    module['classes'].sort(key=lambda cls: cls['name'])
+    return module
+
+
+def _index_class(node, module_attrs):
+    """
+    Return dict of the name and tests of the test class defined by node,
+    mirroring seltest.seltest.BaseMeta.
+    """
+    attrs = _literal_assignments(node.body)
+    if 'base_url' in attrs:
+        base_url = attrs['base_url']
+    else:
+        base_url = module_attrs.get('base_url', '')
+    tests = {}  # by method name; a redefinition replaces the test.
+    for item in node.body:
+        if (not isinstance(item, ast.FunctionDef)
+                or item.name.startswith('_')
+                or any(_final_name(decorator) in NOT_TEST_DECORATORS
+                       for decorator in item.decorator_list)):
+            continue
+        test = {'name': '{}_{}'.format(node.name.lower(),
+                                       '-'.join(item.name.split('_'))),
+                'method': item.name,
+                'doc': ast.get_docstring(item, clean=False),
+                'url': '',
+                'waitfors': [],
+                'hides': []}
+        # Decorators apply bottom up.
+        for decorator in reversed(item.decorator_list):
+            _apply_decorator(test, decorator)
+        if test['url'] is None or base_url is None:
+            test['url'] = None  # Not known until it's imported.
+        else:
+            test['url'] = base_url + test['url']
+            if test['url'].startswith('/'):
+                test['url'] = test['url'][1:]
+        tests[item.name] = test
+    return {'name': node.name,
+            'tests': sorted(tests.values(), key=lambda test: test['name'])}
+
+
+def _binds_other_attributes(node):
+    """
+    Return whether the class defined by node binds public attributes other
+    than by def or assigning literals, i.e. ones which could be functions, and
+    so tests, that only importing it will tell.
+    """
+    for item in node.body:
+        if isinstance(item, (ast.FunctionDef, ast.ClassDef, ast.Expr,
+                             ast.Pass)):
+            continue
+        if isinstance(item, ast.Assign) or type(item).__name__ == 'AnnAssign':
+            if item.value is None or _is_literal(item.value):
+                continue
+        for sub in ast.walk(item):
+            if isinstance(sub, ast.Name) and isinstance(sub.ctx, ast.Store):
+                name = sub.id
+            elif isinstance(sub, (ast.FunctionDef, ast.ClassDef)):
+                name = sub.name
+            elif type(sub).__name__ == 'AsyncFunctionDef':
+                name = sub.name
+            else:
+                continue
+            if not name.startswith('_'):
+                return True
+    return False
+
+
+def _apply_decorator(test, decorator):
+    """
+    Record what decorator (an AST node) does to test. Arguments which aren't
+    literals are recorded as None.
+    """
+    if not isinstance(decorator, ast.Call):
+        return
+    name = _final_name(decorator.func)
+    args = [_literal(arg) for arg in decorator.args]
+    kwargs = dict((kw.arg, _literal(kw.value)) for kw in decorator.keywords)
+    if name == 'url':
+        test['url'] = args[0] if args else kwargs.get('url_str', '')
+    elif name == 'waitfor':
+        selector = args[0] if args else kwargs.get('css_selector')
+        test['waitfors'].append(selector)
+    elif name == 'hide':
+        test['hides'].append(args[0] if args else kwargs.get('css_selector'))
+
+
+def _names_for_base(tree):
+    """
+    Return (names, modules): the names bound to seltest's Base in the module
+    tree, and the names bound to seltest modules, whose Base attribute is it.
+    """
+    names, modules = set(), set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom) and node.module in SELTEST_MODULES:
+            for alias in node.names:
+                if alias.name in ('Base', '*'):
+                    names.add(alias.asname or 'Base')
+        elif isinstance(node, ast.Import):
+            for alias in node.names:
+                if alias.name in SELTEST_MODULES:
+                    modules.add(alias.asname or alias.name)
+                    if not alias.asname:  # `import a.b` binds a, too.
+                        modules.add(alias.name.split('.')[0])
+    return names, modules
+
+
+def _refers_to_base(node, base_names, base_modules):
+    if isinstance(node, ast.Name):
+        return node.id in base_names
+    if isinstance(node, ast.Attribute) and node.attr == 'Base':
+        return _dotted_name(node.value) in base_modules
+    return False
+
+
+def _literal_assignments(body):
+    """
+    Return dict of the names assigned literal values in body (a list of
+    statements) to their values.
+    """
+    values = {}
+    for node in body:
+        if isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    values[target.id] = _literal(node.value)
+    return values
+
+
+def _literal(node):
+    try:
+        return ast.literal_eval(node)
+    except (ValueError, TypeError, SyntaxError):
+        return None
+
+
+def _is_literal(node):
+    try:
+        ast.literal_eval(node)
+    except (ValueError, TypeError, SyntaxError):
+        return False
+    return True
+
+
+def _final_name(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        return node.attr
+    return None
+
+
+def _dotted_name(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        prefix = _dotted_name(node.value)
+        return prefix and '{}.{}'.format(prefix, node.attr)
+    return None
+
+
+def _read_cache(cache_path):
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    if cache.get('version') != INDEX_VERSION:
+        return {}
+    return dict((m['filename'], m) for m in cache['modules'])
+
+
+def _write_cache(cache_path, modules):
+    try:
+        atomic_write(cache_path, json.dumps(
+            {'version': INDEX_VERSION, 'modules': modules},
+            indent=1, sort_keys=True).encode('utf-8'))
+    except (IOError, OSError):
+        pass  # e.g. a read-only checkout; we'll just parse again next time.
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Timing of the phases of each test, for `sel test --profile`.
+
+Events are recorded in the Chrome trace event format, so a profile can be
+loaded into chrome://tracing (or https://ui.perfetto.dev) as a timeline: one
+track per worker, plus one for the requests made through the proxy.
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+
+from collections import defaultdict
+import contextlib
+import json
+import os
+import threading
+import time
+
+from seltest.helpers import atomic_write
+
+
+SUMMARY_SIZE = 10  # Number of slowest tests reported.
+TEST_CATEGORY = 'test'
+PHASE_CATEGORY = 'phase'
+PROXY_CATEGORY = 'proxy'
+
+
+class Profiler(object):
+    """
+    Records how long things take as Chrome trace events.
+
+    A disabled profiler records nothing, and costs next to nothing to use.
+    """
+    def __init__(self, enabled=True, label=None):
+        self.enabled = enabled
+        self.events = []
+        if enabled and label:
+            self.events.append(_process_name(label))
+
+    @contextlib.contextmanager
+    def phase(self, name, category=PHASE_CATEGORY, **args):
+        """
+        Context manager recording the time spent in its block as an event
+        called name, with args (a dict of details).
+        """
+        if not self.enabled:
+            yield
+            return
+        start = now()
+        try:
+            yield
+        finally:
+            self.events.append(event(name, category, start, now() - start,
+                                     **args))
+
+    def test(self, name, **args):
+        """
+        Context manager recording the time spent running a whole test, which
+        is the parent of the phases recorded within it.
+        """
+        return self.phase(name, category=TEST_CATEGORY, **args)
+
+    def extend(self, events):
+        """
+        Add events recorded elsewhere (e.g. in a worker, or by the proxy).
+        """
+        if self.enabled:
+            self.events.extend(events)
+
+    def write(self, path):
+        """
+        Write the recorded events to path as a Chrome trace.
+        """
+        trace = {'traceEvents': self.events, 'displayTimeUnit': 'ms'}
+        atomic_write(path, json.dumps(trace).encode('utf-8'))
+
+    def print_summary(self, limit=SUMMARY_SIZE):
+        """
+        Print the slowest tests, and how much time was spent in each phase.
+        """
+        tests = [e for e in self.events if e.get('cat') == TEST_CATEGORY]
+        if tests:
+            print('Slowest tests:')
+            for e in sorted(tests, key=lambda e: -e['dur'])[:limit]:
+                print('  {:>9}  {}'.format(_ms(e['dur']), e['name']))
+
+        phases = defaultdict(list)
+        for e in self.events:
+            if e.get('cat') == PHASE_CATEGORY:
+                phases[e['name']].append(e['dur'])
+        if phases:
+            print('Time per phase:')
+            print('  {:<16} {:>6} {:>10} {:>9} {:>9}'.format(
+                'phase', 'count', 'total', 'mean', 'max'))
+            for name, durs in sorted(phases.items(), key=lambda p: -sum(p[1])):
+                print('  {:<16} {:>6} {:>10} {:>9} {:>9}'.format(
+                    name, len(durs), _ms(sum(durs)),
+                    _ms(sum(durs) / len(durs)), _ms(max(durs))))
+
+        requests = [e for e in self.events if e.get('cat') == PROXY_CATEGORY]
+        if requests:
+            slowest = max(requests, key=lambda e: e['dur'])
+            print('Proxy served {} requests in {} (slowest: {} in {})'.format(
+                len(requests), _ms(sum(e['dur'] for e in requests)),
+                slowest['name'], _ms(slowest['dur'])))
+
+
+class RequestLog(object):
+    """
+    A thread-safe log of the requests served by the proxy, as trace events.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = [_process_name('proxy')]
+
+    def record(self, name, start, **args):
+        """
+        Record a request called name, which started at start (see now()) and
+        has just finished.
+        """
+        e = event(name, PROXY_CATEGORY, start, now() - start, **args)
+        with self._lock:
+            self._events.append(e)
+
+    def drain(self):
+        """
+        Return the events recorded since the last call, forgetting them.
+        """
+        with self._lock:
+            events, self._events = self._events, []
+        return events
+
+
+def now():
+    """
+    Return the current time in microseconds, the unit of trace events.
+    """
+    return int(time.time() * 1e6)
+
+
+def event(name, category, start, duration, **args):
+    """
+    Return a complete trace event, in this process and thread.
+    """
+    return {'name': name, 'cat': category, 'ph': 'X', 'ts': start,
+            'dur': duration, 'pid': os.getpid(),
+            'tid': threading.current_thread().ident, 'args': args}
+
+
+def _process_name(label):
+    return {'name': 'process_name', 'ph': 'M', 'pid': os.getpid(),
+            'args': {'name': label}}
+
+
+def _ms(microseconds):
+    return '{:.1f}ms'.format(microseconds / 1000.0)
@@ -1,91 +1,716 @@
 """
 Reverse proxy requests to the server under test with injected JavaScript.
 
-Used to inject JavaScript to instrument XHR requests so they can be tracked and
-counted.
+Used to inject JavaScript to instrument XHR and fetch requests, WebSockets and
+resource loads, so that seltest can tell when the page is done loading, and a
+stylesheet hiding the elements a test hides, so they're never painted.
+
+Also records which upstream responses each test's page was served, and hashes
+of their content, so that tests can be skipped when none of them change (see
+seltest.dependencies).
 """
 from __future__ import absolute_import, unicode_literals, print_function
+import hashlib
 import re
+import signal
+import sys
+import threading
+import zlib
+try:  # py2
+    from cookielib import DefaultCookiePolicy
+    from urllib import quote, unquote, urlencode
+except ImportError:  # py3
+    from http.cookiejar import DefaultCookiePolicy
+    from urllib.parse import quote, unquote, urlencode
 
-from flask import Flask, request, Response, make_response
+from flask import Flask, request, Response, make_response, jsonify
 import requests
+from werkzeug.serving import make_server
+
+from seltest.cache import AssetCache, HOP_BY_HOP_HEADERS
+from seltest.helpers import (HIDE_PARAM, HIDE_STYLE_ID, TEST_PARAM,
+                             decode_hide_param, hide_stylesheet)
+from seltest import profile
 
 
 CHUNK_SIZE = 1024
-HEAD_RE = re.compile('<head', re.I)
+POOL_SIZE = 10  # Keep-alive connections kept open to each upstream host.
+CACHE_SIZE = 256 * 1024 * 1024  # bytes
+HEAD_RE = re.compile(br'<head(?=[\s>/])', re.I)
+# How far into a document to look for `<head` before giving up on injecting.
+LOOKAHEAD = 64 * 1024  # bytes
+# Window bits telling zlib to expect or write a gzip or zlib header.
+ZLIB_WBITS = {'gzip': 16 + zlib.MAX_WBITS,
+              'x-gzip': 16 + zlib.MAX_WBITS,
+              'deflate': zlib.MAX_WBITS}
 TRACKING_PENDING_REQUESTS_JS = b"""
 <script>
-window.__SELTEST_PENDING_REQUESTS = 0;
+(function() {
+  window.__SELTEST_PENDING_REQUESTS = 0;
+  window.__SELTEST_LAST_ACTIVITY = Date.now();
+  window.__SELTEST_LAST_FRAME = 0;
   var READY_STATE_DONE = 4,
       XHRSend = XMLHttpRequest.prototype.send;
 
-  XMLHttpRequest.prototype.send = function() {
+  // Something happened on the network: wait for it to be painted, and let
+  // anyone waiting for the page know.
+  function activity() {
+    window.__SELTEST_LAST_ACTIVITY = Date.now();
+    if (window.requestAnimationFrame) {
+      window.requestAnimationFrame(function() {
+        window.__SELTEST_LAST_FRAME = Date.now();
+      });
+    } else {
+      window.__SELTEST_LAST_FRAME = Date.now();
+    }
+    if (window.__SELTEST_NOTIFY) window.__SELTEST_NOTIFY();
+  }
+  function started() {
     window.__SELTEST_PENDING_REQUESTS++;
+    activity();
+  }
+  function finished() {
+    window.__SELTEST_PENDING_REQUESTS--;
+    activity();
+  }
+
+  XMLHttpRequest.prototype.send = function() {
+    started();
     this.addEventListener('readystatechange', function() {
       if (this.readyState === READY_STATE_DONE) {
-        window.__SELTEST_PENDING_REQUESTS--;
+        finished();
       }
     }.bind(this), false);
     XHRSend.apply(this, arguments);
   };
+
+  if (window.fetch) {
+    var fetch = window.fetch;
+    window.fetch = function() {
+      started();
+      return fetch.apply(this, arguments).then(function(response) {
+        finished();
+        return response;
+      }, function(error) {
+        finished();
+        throw error;
+      });
+    };
+  }
+
+  if (window.WebSocket) {
+    var NativeWebSocket = window.WebSocket;
+    window.WebSocket = function(url, protocols) {
+      var ws = (protocols === undefined ? new NativeWebSocket(url)
+                                        : new NativeWebSocket(url, protocols)),
+          connecting = true;
+      function connected() {
+        if (connecting) {
+          connecting = false;
+          finished();
+        }
+      }
+      started();
+      ws.addEventListener('open', connected);
+      ws.addEventListener('error', connected);
+      ws.addEventListener('close', connected);
+      ws.addEventListener('message', activity);
+      return ws;
+    };
+    window.WebSocket.prototype = NativeWebSocket.prototype;
+    ['CONNECTING', 'OPEN', 'CLOSING', 'CLOSED'].forEach(function(state) {
+      window.WebSocket[state] = NativeWebSocket[state];
+    });
+  }
+
+  // Images, scripts, stylesheets, fonts &c. (load events don't bubble, but
+  // can be captured.) The page's own load event is only fired at window.
+  document.addEventListener('load', activity, true);
+  document.addEventListener('error', activity, true);
+  window.addEventListener('load', activity);
+  try {
+    new PerformanceObserver(activity).observe({entryTypes: ['resource']});
+  } catch (e) {}  // Not supported by this browser.
+  // So a frame is painted after the last activity even on a page which
+  // makes no requests at all.
+  activity();
+
+  // Returns true if nothing has happened on the network for quietTime ms,
+  // and the page has been painted since.
+  window.__SELTEST_IS_IDLE = function(quietTime) {
+    var loadingImages = Array.prototype.some.call(document.images, function(img) {
+      return !img.complete && img.loading !== 'lazy';
+    });
+    var loadingFonts = document.fonts && document.fonts.status === 'loading';
+    return (window.__SELTEST_PENDING_REQUESTS === 0 &&
+            document.readyState === 'complete' &&
+            !loadingImages && !loadingFonts &&
+            Date.now() - window.__SELTEST_LAST_ACTIVITY >= quietTime &&
+            window.__SELTEST_LAST_FRAME >= window.__SELTEST_LAST_ACTIVITY);
+  };
+})();
+</script>
+"""
+# Query parameters meant for the proxy, not the server under test.
+PROXY_PARAMS = (HIDE_PARAM, TEST_PARAM)
+# Names the test a request was made for, for requests other than the test's
+# navigation (which has TEST_PARAM).
+TEST_COOKIE = TEST_PARAM
+HIDE_MARKUP = """
+<style id="{style_id}">
+{css}</style>
+"""
+# Takes PROXY_PARAMS back out of the page's URL before any of its own scripts
+# can see them.
+CLEAN_URL_MARKUP = """
+<script>
+(function() {{
+  if (!window.history || !history.replaceState) return;
+  var href = location.href, hashAt = href.indexOf('#'),
+      hash = hashAt < 0 ? '' : href.slice(hashAt),
+      url = hashAt < 0 ? href : href.slice(0, hashAt),
+      queryAt = url.indexOf('?');
+  if (queryAt < 0) return;
+  var params = url.slice(queryAt + 1).split('&').filter(function(param) {{
+    return !/^(?:{params})=/.test(param);
+  }});
+  history.replaceState(history.state, '', url.slice(0, queryAt) +
+                       (params.length ? '?' + params.join('&') : '') + hash);
+}})();
 </script>
 """
 
 app = Flask(__name__.split('.')[0], static_url_path='/__SELTEST_AVOIDING_STATIC_URLS__')
 
 
+def _create_session(pool_size):
+    """
+    Return a requests.Session keeping up to pool_size keep-alive connections
+    open to each upstream host.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    # Cookies belong to the browser; the session must not keep its own.
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
 HOST = None
+HOSTS = {}  # Maps the port a request came in on to the host it proxies.
+SESSION = _create_session(POOL_SIZE)
+CACHE = None  # A seltest.cache.AssetCache, if caching assets.
+CACHE_STATS = {'cache_hits': 0, 'cache_revalidated': 0, 'cache_misses': 0}
+REQUEST_LOG = None  # A seltest.profile.RequestLog, if profiling.
+RECORD_DEPENDENCIES = False  # Whether to record what's served for each test.
+DEPENDENCIES = {}  # test name -> {url: what was served for it (see _record)}
+LAST_HASHES = {}  # url -> hash of the content it was last served with
+DEPENDENCIES_LOCK = threading.Lock()
 def init(host):
     global HOST
     HOST = host
     return app
 
 
+def serve(commands, replies, bind='localhost', pool_size=POOL_SIZE,
+          cache_dir=None, cache_size=CACHE_SIZE, profile_requests=False):
+    """
+    Serve the proxy on one port per host under test, forever.
+
+    Reads lists of hosts from the commands queue and, for each list, puts a
+    dict mapping each of those hosts to the port proxying it on the replies
+    queue. Ports are bound and listening before the reply is sent, so the
+    proxy is ready for requests as soon as the reply is received.
+
+    If cache_dir is given, cacheable responses are cached there, up to
+    cache_size bytes of them. If profile_requests, the time taken to serve
+    each request is recorded, for /__seltest__/trace.
+
+    Exits on SIGTERM, saving the cache's index first.
+    """
+    global SESSION, CACHE, REQUEST_LOG
+    SESSION = _create_session(pool_size)
+    if cache_dir:
+        CACHE = AssetCache(cache_dir, cache_size)
+    if profile_requests:
+        REQUEST_LOG = profile.RequestLog()
+    signal.signal(signal.SIGTERM, _exit)  # See ReverseProxy.stop.
+    try:
+        while True:
+            hosts = commands.get()
+            replies.put(dict((host, _listen(host, bind)) for host in hosts))
+    finally:
+        if CACHE is not None:
+            CACHE.flush()
+
+
+def _exit(signum, frame):
+    sys.exit()
+
+
+def _listen(host, bind):
+    """
+    Return the port proxying host, starting a server thread for it if needed.
+    """
+    for port, proxied_host in HOSTS.items():
+        if proxied_host == host:
+            return port
+    server = make_server(bind, 0, app, threaded=True)
+    HOSTS[server.server_port] = host
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server.server_port
+
+
+def _host():
+    port = request.environ.get('SERVER_PORT')
+    return HOSTS.get(int(port) if port else None, HOST)
+
+
+def pool_stats():
+    """
+    Return dict of the number of upstream requests made, the number of new
+    connections opened for them, and the number which reused a pooled
+    connection. Includes counts of asset cache hits, revalidations and misses
+    when caching.
+    """
+    pools = SESSION.get_adapter('http://').poolmanager.pools
+    stats = {'requests': 0, 'new_connections': 0}
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is not None:
+            stats['requests'] += pool.num_requests
+            stats['new_connections'] += pool.num_connections
+    stats['pool_hits'] = stats['requests'] - stats['new_connections']
+    if CACHE is not None:
+        stats.update(CACHE_STATS)
+    return stats
+
+
+@app.route('/__seltest__/stats')
+def _stats():
+    return jsonify(pool_stats())
+
+
+@app.route('/__seltest__/trace')
+def _trace():
+    """
+    Return the trace events of the requests served since the last call.
+    """
+    return jsonify(REQUEST_LOG.drain() if REQUEST_LOG else [])
+
+
+@app.route('/__seltest__/dependencies')
+def _dependencies():
+    """
+    Return the upstream responses served for each test since the last call.
+    """
+    global DEPENDENCIES
+    with DEPENDENCIES_LOCK:
+        dependencies, DEPENDENCIES = DEPENDENCIES, {}
+    return jsonify(dependencies)
+
+
+@app.route('/__seltest__/record-dependencies')
+def _record_dependencies():
+    """
+    Start recording the upstream responses served for each test, if the on
+    parameter is 1, or stop.
+    """
+    global RECORD_DEPENDENCIES
+    RECORD_DEPENDENCIES = request.args.get('on') == '1'
+    return jsonify(RECORD_DEPENDENCIES)
+
+
+@app.route('/__seltest__/blank')
+def _blank():
+    """
+    Return an empty page, for `sel daemon` to clear this port's storage on.
+    """
+    return '<!doctype html><title></title>'
+
+
 @app.route('/')
 @app.route('/<path:url>')
 def _reverse_proxy(url='/'):
-    if not HOST:
+    start = profile.now()
+    host = _host()
+    if not host:
         raise ValueError('URL has no host.'.format(url))
 
-    url = 'http://{}/{}'.format(HOST, url)
+    url = 'http://{}/{}'.format(host, url)
+    test = _test_name()
 
     print('\n--------------\nURL: ', url,
           '\nHEADERS:\n', request.headers,
           '\n--------------')
 
-    req_headers = dict(request.headers)
-    response = requests.get(
+    req_headers = _without_test_cookie(dict(request.headers))
+    if 'text/html' in (_get_header(req_headers, 'accept') or ''):
+        # Navigations have JS injected into them, which is cheaper to do if
+        # we don't have to decompress and recompress them.
+        req_headers = dict((name, value) for name, value in req_headers.items()
+                           if name.lower() != 'accept-encoding')
+        req_headers['Accept-Encoding'] = 'identity'
+    status, headers, body = _fetch(url, req_headers)
+    headers = dict((name.lower(), value) for name, value in headers.items()
+                   if name.lower() not in HOP_BY_HOP_HEADERS)
+    if test and RECORD_DEPENDENCIES:
+        body = _recorded(body, test, _with_query(url), status, headers,
+                         _get_header(req_headers, 'accept'))
+        # Have the browser revalidate everything it's cached, rather than
+        # reuse it without asking, so every resource a test uses is seen.
+        # Only while recording: it costs a request for each cached asset.
+        # Upstream's own directives (e.g. no-store, private) are kept.
+        headers['cache-control'] = _with_no_cache(
+            headers.get('cache-control', ''))
+
+    is_html_response = 'text/html' in headers.get('content-type', '')
+    if is_html_response and status not in (204, 304):
+        body = _inject(TRACKING_PENDING_REQUESTS_JS + _page_markup(),
+                       body, headers)
+    if REQUEST_LOG is not None:
+        body = _timed(body, url, start, status=status,
+                      headers_ms=(profile.now() - start) / 1000.0)
+    response = make_response((Response(body,
+                                        mimetype=headers.get('content-type')),
+                              status,
+                              headers))
+    if request.args.get(TEST_PARAM):
+        response.set_cookie(TEST_COOKIE, quote(test, safe=''), path='/')
+    return response
+
+
+def _test_name():
+    """
+    Return the name of the test the request was made for, or None.
+    """
+    if request.args.get(TEST_PARAM):
+        return request.args.get(TEST_PARAM)
+    cookie = request.cookies.get(TEST_COOKIE)
+    return unquote(cookie) if cookie else None
+
+
+def _without_test_cookie(req_headers):
+    """
+    Return req_headers without TEST_COOKIE, which is the proxy's own.
+    """
+    for name, value in req_headers.items():
+        if name.lower() == 'cookie':
+            cookies = [c for c in value.split(';')
+                       if c.strip().split('=', 1)[0] != TEST_COOKIE]
+            if cookies:
+                req_headers[name] = ';'.join(cookies).strip()
+            else:
+                del req_headers[name]
+            break
+    return req_headers
+
+
+def _recorded(body, test, url, status, headers, accept):
+    """
+    Return an iterator over body, the response to a request for url made for
+    test, which records what was served once body has been sent.
+
+    Encoded bodies are hashed decoded, since encoding them needn't be
+    deterministic. A `304 Not Modified` is recorded with the hash the url was
+    last served with, if any.
+    """
+    encoding = headers.get('content-encoding', 'identity').strip().lower()
+    decompressor = None
+    if encoding in ZLIB_WBITS:
+        decompressor = zlib.decompressobj(ZLIB_WBITS[encoding])
+    digest = hashlib.sha1()
+    hashable = encoding in ZLIB_WBITS or encoding == 'identity'
+    for chunk in body:
+        if hashable:
+            try:
+                digest.update(decompressor.decompress(chunk)
+                              if decompressor else chunk)
+            except zlib.error:
+                hashable = False
+        yield chunk
+
+    with DEPENDENCIES_LOCK:
+        if status == 304:
+            content_hash = LAST_HASHES.get(url)
+        elif hashable:
+            content_hash = LAST_HASHES[url] = digest.hexdigest()
+        else:
+            content_hash = None  # Always counts as changed.
+        DEPENDENCIES.setdefault(test, {})[url] = {
+            'status': 200 if status == 304 else status,
+            'hash': content_hash,
+            'etag': headers.get('etag'),
+            'last_modified': headers.get('last-modified'),
+            'accept': accept
+        }
+
+
+def _timed(body, url, start, **args):
+    """
+    Return an iterator over body which logs the request for url, started at
+    start, once body has been sent.
+    """
+    try:
+        for chunk in body:
+            yield chunk
+    finally:
+        REQUEST_LOG.record(url, start, **args)
+
+
+def _page_markup():
+    """
+    Return the markup for the test's page, other than the tracking JS: a
+    stylesheet hiding the elements selected by HIDE_PARAM, and a script
+    removing PROXY_PARAMS from its URL.
+    """
+    markup = ''
+    selectors = decode_hide_param(request.args.get(HIDE_PARAM))
+    if selectors:
+        markup += HIDE_MARKUP.format(style_id=HIDE_STYLE_ID,
+                                     css=hide_stylesheet(selectors))
+    if any(param in request.args for param in PROXY_PARAMS):
+        markup += CLEAN_URL_MARKUP.format(params='|'.join(PROXY_PARAMS))
+    return markup.encode('utf-8')
+
+
+def _upstream_args():
+    """
+    Return list of the request's (name, value) query parameters, except those
+    meant for the proxy.
+    """
+    return [(name, value) for name, value in request.args.items(multi=True)
+            if name not in PROXY_PARAMS]
+
+
+def _with_query(url):
+    """
+    Return url with the request's query string, less PROXY_PARAMS.
+    """
+    args = _upstream_args()
+    if not args:
+        return url
+    return url + '?' + urlencode([(name.encode('utf-8'), value.encode('utf-8'))
+                                  for name, value in args])
+
+
+class _HeadInjector(object):
+    """
+    Injects markup before the `<head>` tag of an HTML document fed to it in
+    chunks.
+
+    Holds back output until the tag is found, so that tags split across
+    chunks are still found, or until lookahead bytes have been fed without
+    finding one, at which point the document is passed through unchanged.
+    """
+    def __init__(self, markup, lookahead=LOOKAHEAD):
+        self.markup = markup
+        self.lookahead = lookahead
+        self.done = False
+        self.injected = False
+        self._buffer = b''
+
+    def feed(self, chunk):
+        """
+        Return the bytes of the document which can be output after chunk.
+        """
+        if self.done:
+            return chunk
+        # Only rescan the tail of what we've already searched.
+        start = max(0, len(self._buffer) - len(b'<head '))
+        self._buffer += chunk
+        match = HEAD_RE.search(self._buffer, start)
+        if match:
+            self.injected = True
+            idx = match.start()
+            return self._finish(self._buffer[:idx] + self.markup +
+                                self._buffer[idx:])
+        if len(self._buffer) >= self.lookahead:
+            return self._finish(self._buffer)
+        return b''
+
+    def flush(self):
+        """
+        Return any held back bytes, once the document has ended.
+        """
+        return self._finish(self._buffer)
+
+    def _finish(self, output):
+        self.done = True
+        self._buffer = b''
+        return output
+
+
+def _inject(markup, body, headers):
+    """
+    Return an iterator over body (an HTML document), with markup injected
+    before its `<head>` tag, updating headers to match.
+
+    Encoded bodies are decoded to inject into them, and reencoded as they're
+    output, unless the encoding isn't one we can handle. `Content-Length` is
+    kept if the new length is known before the body starts being sent.
+    """
+    encoding = headers.get('content-encoding', 'identity').strip().lower()
+    if encoding not in ZLIB_WBITS and encoding != 'identity':
+        return body  # e.g. brotli, which we'd need a library for.
+    if encoding in ZLIB_WBITS:
+        body = _decode(body, encoding)
+
+    # Read until we know whether we'll inject, so headers are right.
+    injector = _HeadInjector(markup)
+    held = []
+    for chunk in body:
+        held.append(injector.feed(chunk))
+        if injector.done:
+            break
+    else:
+        held.append(injector.flush())
+
+    if encoding in ZLIB_WBITS:
+        headers.pop('content-length', None)
+    elif injector.injected and headers.get('content-length'):
+        headers['content-length'] = str(
+            int(headers['content-length']) + len(markup))
+
+    def injected():
+        for chunk in held:
+            yield chunk
+        for chunk in body:
+            yield chunk
+    if encoding in ZLIB_WBITS:
+        return _encode(injected(), encoding)
+    return injected()
+
+
+def _decode(chunks, encoding):
+    """
+    Return an iterator over chunks, decompressed from encoding.
+    """
+    decompressor = zlib.decompressobj(ZLIB_WBITS[encoding])
+    for chunk in chunks:
+        try:
+            data = decompressor.decompress(chunk)
+        except zlib.error:
+            if encoding != 'deflate':
+                raise
+            # Some servers send raw deflate streams, without a zlib header.
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            encoding = 'raw deflate'
+            data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    yield decompressor.flush()
+
+
+def _encode(chunks, encoding):
+    """
+    Return an iterator over chunks, compressed with encoding.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, ZLIB_WBITS[encoding])
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _fetch(url, req_headers):
+    """
+    Return (status, headers, iterator over body chunks) of the response to a
+    request for url with req_headers, from the asset cache if it has a fresh
+    copy of the response.
+    """
+    if (CACHE is None or _get_header(req_headers, 'range')
+            or not CACHE.is_cacheable_request(req_headers)):
+        return _fetch_upstream(url, req_headers)
+    cache_url = _with_query(url)
+
+    entry, is_fresh = CACHE.lookup(cache_url, req_headers)
+    if entry is not None and is_fresh:
+        CACHE_STATS['cache_hits'] += 1
+        etag = _get_header(entry['headers'], 'etag')
+        if etag and _get_header(req_headers, 'if-none-match') == etag:
+            return 304, entry['headers'], iter([])
+    elif entry is not None:
+        conditional_headers = dict(
+            (name, value) for name, value in req_headers.items()
+            if name.lower() not in ('if-none-match', 'if-modified-since'))
+        conditional_headers.update(CACHE.validators(entry))
+        status, headers, body = _fetch_upstream(url, conditional_headers)
+        if status != 304:
+            CACHE_STATS['cache_misses'] += 1
+            return status, headers, _cache_body(
+                cache_url, req_headers, status, headers, body)
+        body.close()
+        entry = CACHE.refresh(entry, headers)
+        CACHE_STATS['cache_revalidated'] += 1
+    if entry is not None:
+        try:
+            return (entry['status'], entry['headers'],
+                    CACHE.read(entry, CHUNK_SIZE))
+        except IOError:
+            pass  # Evicted since we looked it up; fetch it again.
+
+    CACHE_STATS['cache_misses'] += 1
+    status, headers, body = _fetch_upstream(url, req_headers)
+    return status, headers, _cache_body(cache_url, req_headers,
+                                        status, headers, body)
+
+
+def _cache_body(cache_url, req_headers, status, headers, body):
+    if CACHE.is_cacheable(status, headers):
+        return CACHE.tee(cache_url, req_headers, status, headers, body)
+    return body
+
+
+def _fetch_upstream(url, req_headers):
+    """
+    Return (status, headers, iterator over body chunks) of the response from
+    the application server to a request for url with req_headers.
+    """
+    response = SESSION.get(
         url,
         stream=True,
-        params=request.args,
+        params=_upstream_args(),
         headers=req_headers)
-    headers = dict(response.headers)
 
     print("Response from application server: " , response.status_code,
           '\n', response.headers, '\n-------------')
 
-    # TODO: fix this; we want a content-length
-    if headers.get('content-length'):
-        del headers['content-length']
-    is_html_response = 'text/html' in headers.get('content-type', '')
-    def resp_iter():
-        is_first_chunk = True
-        for chunk in response.iter_content(CHUNK_SIZE):
-            # TODO: Possible bug: '<head' could span 2 chunks... (very unlikely)
-            if is_first_chunk and is_html_response and _head_in_chunk(chunk):
-                idx = HEAD_RE.search(chunk).start()
-                yield chunk[:idx] + TRACKING_PENDING_REQUESTS_JS + chunk[idx:]
-            else:
+    def body():
+        try:
+            # Bodies are passed on as they were sent, still encoded.
+            for chunk in response.raw.stream(CHUNK_SIZE,
+                                             decode_content=False):
                 yield chunk
-            is_first_chunk = False
-    return make_response((Response(resp_iter(),
-                                   mimetype=headers.get('content-type')),
-                          response.status_code,
-                          headers))
+        finally:
+            # Hands the connection back to the pool, or drops it if the
+            # browser went away before the body was read.
+            response.close()
+    return response.status_code, response.headers, body()
+
+
+def _get_header(headers, name):
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
 
 
-def _head_in_chunk(chunk):
-    return HEAD_RE.search(chunk) is not None
+def _with_no_cache(cache_control):
+    """
+    Return the Cache-Control header value cache_control with the no-cache
+    directive added, unless it has it (without field names, which would only
+    apply it to those headers) or no-store, which is stricter.
+    """
+    directives = [d.strip() for d in cache_control.split(',') if d.strip()]
+    lowered = [d.lower() for d in directives]
+    if 'no-cache' not in lowered and 'no-store' not in lowered:
+        directives.append('no-cache')
+    return ', '.join(directives)
 
 
 if __name__ == '__main__':
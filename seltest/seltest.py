@@ -1,32 +1,168 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
-import PIL.Image as Image
-from selenium import webdriver
-from selenium.webdriver.support.ui import Select, WebDriverWait
+# selenium.webdriver imports every browser's driver, which is slow, so its
+# modules are imported where they're used: finding and listing tests
+# shouldn't have to wait for them.
 from selenium.common.exceptions import (WebDriverException,
-                                        NoSuchElementException,
                                         TimeoutException)
-from selenium.webdriver.common.action_chains import ActionChains
 
-import hashlib
-import imgurpython
+import PIL.Image as Image
+
+from collections import OrderedDict
+import contextlib
+import io
+import numbers
 import os
-import pkg_resources
 import sys
 import time
 import types
+import weakref
+try:  # py2
+    from urllib import quote
+except ImportError:  # py3
+    from urllib.parse import quote
 
-from seltest.helpers import with_metaclass
+from seltest import diff, store, uploads
+from seltest.baselines import describe, TILE_SIZE
+from seltest.profile import Profiler
+from seltest.helpers import (HIDE_PARAM, HIDE_STYLE_ID, TEST_PARAM,
+                             atomic_write, encode_hide_param,
+                             hide_stylesheet, with_metaclass)
 
 
 AJAX_TIMEOUT = 10  # seconds
-AJAX_TIMEOUT_MSG = 'Timed out waiting for XMLHTTPRequests to finish.'
-GET_PENDING_REQUESTS_JS = 'return window.__SELTEST_PENDING_REQUESTS;'
+AJAX_TIMEOUT_MSG = 'Timed out waiting for the network to be idle.'
+# Adds the stylesheet hiding a test's elements if the page doesn't have it,
+# e.g. because the test navigated away from the page the proxy injected it
+# into.
+ENSURE_HIDDEN_JS = """
+function ensureHidden(css) {
+  if (!css || document.getElementById('""" + HIDE_STYLE_ID + """')) return;
+  var style = document.createElement('style');
+  style.id = '""" + HIDE_STYLE_ID + """';
+  style.textContent = css;
+  (document.head || document.documentElement).appendChild(style);
+}
+"""
+# True if there's been no network activity for arguments[0] ms (see the JS
+# injected by seltest.proxy). Once it is, ensures the CSS in arguments[1] hides
+# the test's elements.
+NETWORK_IDLE_JS = ENSURE_HIDDEN_JS + """
+var idle = !!window.__SELTEST_IS_IDLE && window.__SELTEST_IS_IDLE(arguments[0]);
+if (idle) ensureHidden(arguments[1]);
+return idle;
+"""
+NETWORK_IDLE = 100  # ms
+IDLE_POLL_FREQUENCY = 0.05  # seconds
 WAIT_TIMEOUT = 10  # seconds
 WAIT_TIMEOUT_MSG = 'Timed out waiting for: {}.'
+JS_WAIT_TIMEOUT = 60  # seconds
+WAIT_MODES = ('poll', 'push')
+# The longest a push wait can take: PUSH_WAIT_JS gives up on its own first,
+# so it can tell us why.
+PUSH_WAIT_TIMEOUT = JS_WAIT_TIMEOUT + AJAX_TIMEOUT + 5  # seconds
+# Checks every waitfor in arguments[0] at once, returning a status for each.
+WAITFORS_STATUS_JS = """
+return arguments[0].map(function(waitfor) {
+  var el = document.querySelector(waitfor.css_selector);
+  if (!el) return 'missing';
+  var text = (el.innerText === undefined ? el.textContent : el.innerText);
+  if (waitfor.text && text.trim() !== waitfor.text) return 'text';
+  var classes = ' ' + el.className + ' ';
+  if (waitfor.classes && !waitfor.classes.every(function(c) {
+        return classes.indexOf(' ' + c + ' ') !== -1; })) return 'classes';
+  return 'ok';
+});
+"""
+# Resolves once the waitfors in arguments[0] and JS strings in arguments[1]
+# are all satisfied, and the network has been idle for arguments[3] ms (see
+# NETWORK_IDLE_JS), then ensures the CSS in arguments[4] hides the test's
+# elements. Changes are pushed to it by a MutationObserver and by the proxy's
+# network tracking. Gives up after arguments[2] ms.
+PUSH_WAIT_JS = ENSURE_HIDDEN_JS + """
+var waitfors = arguments[0], jsStrings = arguments[1], timeout = arguments[2],
+    quietTime = arguments[3], hideCss = arguments[4],
+    done = arguments[arguments.length - 1];
+var waitforStatuses = function() {
+""" + WAITFORS_STATUS_JS + """
+};
+var start = Date.now(), finished = false, observer, fallback, deadline;
+
+function state() {
+  return {
+    statuses: waitforStatuses(waitfors),
+    js: jsStrings.map(function(js) {
+      try { return !!(new Function(js))(); } catch (e) { return false; }
+    }),
+    idle: (Date.now() - start >= quietTime && !!window.__SELTEST_IS_IDLE &&
+           window.__SELTEST_IS_IDLE(quietTime)),
+    pending: window.__SELTEST_PENDING_REQUESTS
+  };
+}
+function isSatisfied(s) {
+  return s.statuses.every(function(status) { return status === 'ok'; }) &&
+         s.js.every(Boolean) && s.idle;
+}
+function finish(s, timedOut) {
+  if (finished) return;
+  finished = true;
+  observer.disconnect();
+  clearInterval(fallback);
+  clearTimeout(deadline);
+  window.__SELTEST_NOTIFY = null;
+  s.timedOut = timedOut;
+  done(s);
+}
+function check() {
+  if (finished) return;
+  var s = state();
+  if (isSatisfied(s)) {
+    ensureHidden(hideCss);
+    finish(s, false);
+  }
+}
+
+observer = new MutationObserver(check);
+observer.observe(document.documentElement, {
+  childList: true, subtree: true, attributes: true, characterData: true
+});
+window.__SELTEST_NOTIFY = check;
+// Catches what a MutationObserver can't see, e.g. JS strings becoming true,
+// or the network falling quiet.
+fallback = setInterval(check, 50);
+deadline = setTimeout(function() { finish(state(), true); }, timeout);
+check();
+"""
+WAITFOR_STATUS_MSGS = {'missing': 'not found',
+                       'text': 'text differs',
+                       'classes': 'classes missing'}
+
+# The box bounding the visible elements matching the selector arguments[0],
+# in the screenshot's (device) pixels, and how many elements match, or null
+# if none of them are visible.
+SNAPSHOT_REGION_JS = """
+var els = document.querySelectorAll(arguments[0]);
+var left = Infinity, top = Infinity, right = -Infinity, bottom = -Infinity;
+for (var i = 0; i < els.length; i++) {
+  var rect = els[i].getBoundingClientRect();
+  if (!rect.width || !rect.height) continue;
+  left = Math.min(left, rect.left);
+  top = Math.min(top, rect.top);
+  right = Math.max(right, rect.right);
+  bottom = Math.max(bottom, rect.bottom);
+}
+if (left === Infinity) return null;
+var ratio = window.devicePixelRatio || 1;
+return {count: els.length,
+        box: [Math.floor(left * ratio), Math.floor(top * ratio),
+              Math.ceil(right * ratio), Math.ceil(bottom * ratio)]};
+"""
 
 DEFAULT_WINDOW_SIZE = [2000, 1800]
+# Whether each driver can take screenshots of elements, once it's been tried.
+ELEMENT_SCREENSHOTS = weakref.WeakKeyDictionary()
+MAX_REPORTED_BOXES = 5
 
 
 class BaseMeta(type):
@@ -88,21 +224,33 @@ class BaseMeta(type):
 @with_metaclass(BaseMeta)
 class Base(object):
     """Base from which all tests must inherit from."""
-    def __init__(self, driver, imgur_client_id=None):
+    def __init__(self, driver, imgur_client_id=None, wait_mode='poll',
+                 network_idle=NETWORK_IDLE, profiler=None, uploader=None):
         __module = sys.modules[self.__module__]
+        # Without an uploader (see seltest.uploads), one is started for each
+        # run with imgur_client_id, if given.
         self.imgur_client_id = imgur_client_id
-        self.window_size = (getattr(self, 'window_size', None)
-                            or getattr(__module, 'window_size', None)
-                            or DEFAULT_WINDOW_SIZE)
-        self.host = (getattr(self, 'host', None)
-                     or getattr(__module, 'host', None))
+        self.uploader = uploader
+        if wait_mode not in WAIT_MODES:
+            raise ValueError('`wait_mode` must be one of {}.'.format(
+                ', '.join(WAIT_MODES)))
+        self.wait_mode = wait_mode
+        self.network_idle = network_idle
+        self.profiler = profiler or Profiler(enabled=False)
+        self.window_sizes = _window_sizes_of(type(self))
+        self.window_size = list(self.window_sizes[0])
+        self.resize_in_place = bool(
+            getattr(self, 'resize_in_place', None)
+            or getattr(__module, 'resize_in_place', None))
+        self.host = _host_of(type(self))
         if self.host is None:
             raise ValueError('`host` must be specified at the module or class level.')
         self.__test_methods = type(self).__dict__['__test_methods']
         self.base_url = ''
         self.driver = driver
-        self.driver.set_window_size(*self.window_size)
         self.driver.implicitly_wait(10)
+        if wait_mode == 'push':
+            self.driver.set_script_timeout(PUSH_WAIT_TIMEOUT)
         return super(Base, self).__init__()
 
     def hide(self, css_selector):
@@ -114,75 +262,204 @@ class Base(object):
             }};
             """.format(css_selector))
 
-    def _run(self, image_dir, proxy_port, wait=None):
-        passes = True
-        for test in self.__test_methods:
-            name, url = self._name_and_url(test)
-            try:
-                self._prepare_page(test, name, url, proxy_port)
-            except TimeoutException as e:
-                print('  ✗ {}: test timed out: {}'.format(name, e))
-                passes = False
-                continue
-            except AssertionError as e:
-                print('  ✗ {}: assertion failed: {}'.format(name, e))
-                passes = False
-                continue
-            finally:
-                if wait:
-                    time.sleep(float(wait))
-            if not self._screenshot_and_diff(name, image_dir):
-                passes = False
-        return passes
-
-    def _update(self, image_dir, proxy_port, wait=None):
-        for test in self.__test_methods:
-            name, url = self._name_and_url(test)
-            try:
-                self._prepare_page(test, name, url, proxy_port)
-            except TimeoutException as e:
-                print('  ✗ {}: test timed out: {}'.format(name, e))
-                continue
-            except AssertionError as e:
-                print('  ✗ {}: assertion failed: {}'.format(name, e))
-                continue
-            finally:
-                if wait:
-                    time.sleep(float(wait))
-            self._update_screenshot(name, image_dir)
+    def _run(self, image_dir, proxy_port, wait=None, baselines=None):
+        """
+        Return True if all tests pass. Whether each test passed is recorded,
+        by name, in self.results, and how long it took in self.durations.
+        baselines is the store of the baselines in image_dir, if it's open.
+        """
+        def capture(test, shot_name):
+            return all([png is not None and self._screenshot_and_diff(
+                name, png, image_dir, self._tolerance(test))
+                for name, png in self._snapshots(test, shot_name)])
+        own_uploader = self.uploader is None and self.imgur_client_id
+        if own_uploader:
+            self.uploader = uploads.Uploader(self.imgur_client_id)
+        try:
+            self._visit(image_dir, proxy_port, capture, wait, baselines)
+        finally:
+            if own_uploader:
+                uploads.print_uploads(self.uploader.finish())
+                self.uploader = None
+        return all(self.results.values())
+
+    def _update(self, image_dir, proxy_port, wait=None, baselines=None):
+        """
+        Update the screenshots of all tests. Whether each test's screenshot
+        was taken is recorded, by name, in self.results, and how long it took
+        in self.durations. baselines is as for _run.
+        """
+        def capture(test, shot_name):
+            captured = True
+            for name, png in self._snapshots(test, shot_name):
+                if png is None:
+                    captured = False
+                else:
+                    self._update_screenshot(name, png, image_dir,
+                                            self._tolerance(test))
+            return captured
+        self._visit(image_dir, proxy_port, capture, wait, baselines)
+
+    def _visit(self, image_dir, proxy_port, capture, wait=None,
+               baselines=None):
+        """
+        Load each test's page at each of self.window_sizes, calling capture
+        with the test and the name of its screenshot there once it's ready.
+        A test passes if capture returns True for all of its screenshots.
+
+        Tests are grouped by window size, so the window is only resized once
+        for each size; or, with resize_in_place, each test's page is loaded
+        once, and resized to each size in turn.
+
+        Changes to the baselines' bookkeeping are written once, at the end.
+        """
+        self._store = baselines or store.open_store(image_dir)
+        with self._store.batch():
+            self._visit_tests(proxy_port, capture, wait)
+
+    def _visit_tests(self, proxy_port, capture, wait):
+        self.results = OrderedDict()
+        self.durations = OrderedDict()
+        tests = self.__test_methods
+        for test in tests:
+            self.results[getattr(test, '__name')] = True
+        sizes = self._size_order()
+        if not self.resize_in_place:
+            for size in sizes:
+                self._resize(size)
+                for test in tests:
+                    self._visit_sizes(test, [size], proxy_port, capture,
+                                      wait)
+        else:
+            for idx, test in enumerate(tests):
+                # Each test starts at the size the last one finished at.
+                self._visit_sizes(test, sizes if idx % 2 == 0 else sizes[::-1],
+                                  proxy_port, capture, wait)
+
+    def _visit_sizes(self, test, sizes, proxy_port, capture, wait=None):
+        """
+        Load test's page and capture its screenshots at each of sizes in
+        turn (see _visit), re-settling the page after each resize.
+        """
+        name, url = self._name_and_url(test)
+        for idx, size in enumerate(sizes):
+            shot_name = _screenshot_name(name, size, self.window_sizes)
+            with self._timing(name, shot_name):
+                self._resize(size)
+                if idx == 0:
+                    ready = self._ready(shot_name, wait, self._prepare_page,
+                                        test, name, url, proxy_port)
+                else:
+                    ready = self._ready(shot_name, wait, self._settle, test)
+                if not ready:
+                    self.results[name] = False
+                    if idx == 0:
+                        break  # There's no page to resize.
+                    continue
+                passed = capture(test, shot_name)
+                self.results[name] = passed and self.results[name]
+
+    def _ready(self, shot_name, wait, prepare, *args):
+        """
+        Return whether prepare(*args) got the page ready for the screenshot
+        shot_name, printing why not if it didn't.
+        """
+        try:
+            prepare(*args)
+        except TimeoutException as e:
+            print('  ✗ {}: test timed out: {}'.format(shot_name, e))
+            return False
+        except AssertionError as e:
+            print('  ✗ {}: assertion failed: {}'.format(shot_name, e))
+            return False
+        except WebDriverException as e:
+            # e.g. the browser can't run PUSH_WAIT_JS, lacking
+            # MutationObserver.
+            print('  ✗ {}: driver error: {}{}'.format(
+                shot_name, e.msg or type(e).__name__,
+                ' (try --wait-mode poll)' if self.wait_mode == 'push'
+                else ''))
+            return False
+        finally:
+            if wait:
+                time.sleep(float(wait))
+        return True
+
+    def _size_order(self):
+        """
+        Return self.window_sizes, starting from the driver's current size if
+        it's one of them, e.g. because the last test class ended on it.
+        """
+        current = self.driver.get_window_size()
+        self.window_size = [current['width'], current['height']]
+        sizes = list(self.window_sizes)
+        if tuple(self.window_size) in sizes:
+            idx = sizes.index(tuple(self.window_size))
+            sizes = sizes[idx:] + sizes[:idx]
+        return sizes
+
+    def _resize(self, size):
+        if list(size) != self.window_size:
+            with self.profiler.phase('resize'):
+                self.driver.set_window_size(*size)
+            self.window_size = list(size)
+
+    def _profile_name(self, name):
+        return '{}.{}'.format(type(self).__name__, name)
+
+    @contextlib.contextmanager
+    def _timing(self, name, shot_name=None):
+        """
+        Time (the screenshot shot_name of) test name, adding it to
+        self.durations, and profiling it.
+        """
+        start = time.time()
+        try:
+            with self.profiler.test(self._profile_name(shot_name or name)):
+                yield
+        finally:
+            self.durations[name] = (self.durations.get(name, 0)
+                                    + time.time() - start)
 
     def _prepare_page(self, test, name, url, proxy_port):
-        self._reset_mouse_position()
-        self.driver.get('http://localhost:{}/{}'.format(proxy_port, url))
-        test(self, self.driver)
-        self._handle_waitfors(test)
-        time.sleep(0.1)  # Give JS a chance to fire any other AJAX.
-        self._wait_for_ajax()
-        self._hide_elements(test)
+        hidden_selectors = getattr(test, '__hide', [])
+        with self.profiler.phase('navigate'):
+            self._reset_mouse_position()
+            self.driver.get(_proxy_url(proxy_port, url, name,
+                                       hidden_selectors))
+        with self.profiler.phase('test body'):
+            test(self, self.driver)
+        self._settle(test)
+
+    def _settle(self, test):
+        """
+        Wait for test's page to be ready for its screenshot.
+        """
+        hidden_selectors = getattr(test, '__hide', [])
+        # The proxy hides the test's elements from the page's first paint;
+        # the final wait only has to check they're still hidden.
+        hide_css = hide_stylesheet(hidden_selectors)
+        if self.wait_mode == 'push':
+            with self.profiler.phase('push wait'):
+                self._push_wait(test, hide_css)
+        else:
+            with self.profiler.phase('waitfors'):
+                self._handle_waitfors(test)
+            with self.profiler.phase('network idle'):
+                self._wait_for_network_idle(hide_css)
 
     def _are_waitfors_satisfied(self, test):
         if not getattr(test, '__waitfors', None):
             return True  # If there aren't any waitfors, don't wait.
-        results = []
-        for waitfor in getattr(test, '__waitfors'):
-            sel = waitfor['css_selector']  # required
-            text = waitfor.get('text')  # optional
-            classes = waitfor.get('classes')  #optional
-            try:
-                el = self.driver.find_element_by_css_selector(sel)
-                text_present = True
-                if text:
-                    text_present = el.text == text
-                has_classes = True
-                if classes:
-                    el_classes = el.get_attribute('class').split(' ')
-                    has_classes = all(c in el_classes for c in classes)
-                results.append(text_present and has_classes)
-            except NoSuchElementException:
-                return False
+        # One round trip for all waitfors, rather than several for each.
+        statuses = self.driver.execute_script(WAITFORS_STATUS_JS,
+                                              getattr(test, '__waitfors'))
+        self._waitfor_statuses = statuses
+        if 'missing' in statuses:
+            return False
         for waitfor in getattr(test, '__wait_for_js_strings', []):
             self._wait_for_js_string(waitfor)
-        return all(results)
+        return all(status == 'ok' for status in statuses)
 
     def _name_and_url(self, test):
         name = getattr(test, '__name')
@@ -190,40 +467,88 @@ class Base(object):
         return name, url
 
     def _reset_mouse_position(self, offset=-10000000):
+        from selenium.webdriver.common.action_chains import ActionChains
         action = ActionChains(self.driver)
         action.move_by_offset(offset, offset)
         action.perform()
 
-    def _wait_for_ajax(self):
+    def _wait_for_network_idle(self, hide_css=''):
+        """
+        Wait for there to have been no network activity for network_idle ms,
+        giving JS at least that long to fire any other requests. Then makes
+        sure hide_css is applied to the page.
+        """
+        from selenium.webdriver.support.ui import WebDriverWait
+        start = time.time()
+        def is_idle(driver):
+            if time.time() - start < self.network_idle / 1000.0:
+                return False
+            return driver.execute_script(NETWORK_IDLE_JS, self.network_idle,
+                                         hide_css)
         self.driver.implicitly_wait(0)
-        WebDriverWait(self.driver, AJAX_TIMEOUT).until(
-            _ajax_is_complete,  AJAX_TIMEOUT_MSG)
-        self.driver.implicitly_wait(WAIT_TIMEOUT)
+        try:
+            WebDriverWait(self.driver, AJAX_TIMEOUT,
+                          poll_frequency=IDLE_POLL_FREQUENCY).until(
+                is_idle, AJAX_TIMEOUT_MSG)
+        finally:
+            self.driver.implicitly_wait(WAIT_TIMEOUT)
 
     def _wait_for_js_string(self, string):
+        from selenium.webdriver.support.ui import WebDriverWait
         self.driver.implicitly_wait(0)
-        WebDriverWait(self.driver, 60).until(
+        WebDriverWait(self.driver, JS_WAIT_TIMEOUT).until(
             lambda d: d.execute_script(string),
             'timed out waiting for "{}"'.format(string))
         self.driver.implicitly_wait(60)
 
     def _handle_waitfors(self, test):
+        from selenium.webdriver.support.ui import WebDriverWait
+        self._waitfor_statuses = None
         self.driver.implicitly_wait(0)
-        WebDriverWait(self.driver, WAIT_TIMEOUT).until(
-            lambda s: self._are_waitfors_satisfied(test),
-            WAIT_TIMEOUT_MSG.format(self._waitfor_str(test)))
-        self.driver.implicitly_wait(WAIT_TIMEOUT)
-
-    def _hide_elements(self, test):
-        hidden_selectors = getattr(test, '__hide', [])
-        for sel in hidden_selectors:
-            self.hide(sel)
-
-    def _waitfor_str(self, test):
+        try:
+            WebDriverWait(self.driver, WAIT_TIMEOUT).until(
+                lambda s: self._are_waitfors_satisfied(test))
+        except TimeoutException:
+            raise TimeoutException(WAIT_TIMEOUT_MSG.format(
+                self._waitfor_str(test, self._waitfor_statuses)))
+        finally:
+            self.driver.implicitly_wait(WAIT_TIMEOUT)
+
+    def _push_wait(self, test, hide_css=''):
+        """
+        Wait, in a single call to the driver, for the page to be ready: for
+        test's waitfors and JS strings to be satisfied, and for the network to
+        be idle. Then makes sure hide_css is applied to the page.
+        """
+        waitfors = getattr(test, '__waitfors', None) or []
+        js_strings = getattr(test, '__wait_for_js_strings', [])
+        timeout = ((JS_WAIT_TIMEOUT if js_strings else WAIT_TIMEOUT)
+                   + AJAX_TIMEOUT)
+        # Within the driver's script timeout, set in __init__.
+        state = self.driver.execute_async_script(
+            PUSH_WAIT_JS, waitfors, js_strings, timeout * 1000,
+            self.network_idle, hide_css)
+        if state['timedOut']:
+            waiting_for = [self._waitfor_str(test, state['statuses'])]
+            waiting_for += ['"{}"'.format(js)
+                            for js, ok in zip(js_strings, state['js'])
+                            if not ok]
+            if not state['idle']:
+                waiting_for.append(
+                    'the network to be idle ({} requests pending)'.format(
+                        state['pending']))
+            raise TimeoutException(WAIT_TIMEOUT_MSG.format(
+                ', '.join(w for w in waiting_for if w)))
+
+    def _waitfor_str(self, test, statuses=None):
+        """
+        Return a description of test's waitfors. If given, statuses (from
+        WAITFORS_STATUS_JS) say why each waitfor isn't yet satisfied.
+        """
         if not getattr(test, '__waitfors', None):
             return ''
         waitstrs = []
-        for waitfor in getattr(test, '__waitfors'):
+        for idx, waitfor in enumerate(getattr(test, '__waitfors')):
             waitstr = ''
             waitstr += waitfor['css_selector']
             text = waitfor.get('text')
@@ -232,66 +557,299 @@ class Base(object):
             classes = waitfor.get('classes')
             if classes:
                 waitstr += ' (classes={})'.format(' '.join(classes))
+            status = statuses[idx] if statuses else None
+            if status in WAITFOR_STATUS_MSGS:
+                waitstr += ' [{}]'.format(WAITFOR_STATUS_MSGS[status])
             waitstrs.append(waitstr)
         return ', '.join(waitstrs)
 
-    def _screenshot_and_diff(self, name, image_dir):
-        old_path = '{0}/{1}.png'.format(image_dir, name)
-        if not os.path.isfile(old_path):
+    def _snapshots(self, test, shot_name):
+        """
+        Yield (name, png) for each screenshot test takes at the current
+        window size, for which shot_name is its screenshot's name: the whole
+        window, or, with snapshot selectors (see seltest.helpers.snapshot),
+        each of the regions they select. png is None for regions which
+        couldn't be captured, once why is printed.
+
+        See _capture_region for how each region is captured.
+        """
+        selectors = _snapshot_selectors(type(self), test)
+        if not selectors:
+            with self.profiler.phase('capture'):
+                png = self.driver.get_screenshot_as_png()
+            yield shot_name, png
+            return
+        window_png = []  # The window's screenshot, once taken.
+        for idx, selector in enumerate(selectors):
+            name = _region_name(shot_name, idx, selectors)
+            with self.profiler.phase('capture'):
+                region = self.driver.execute_script(SNAPSHOT_REGION_JS,
+                                                    selector)
+                png = None
+                if not region:
+                    print('  ✗ {}: nothing matching {} is visible'.format(
+                        name, selector))
+                else:
+                    png = self._capture_region(name, selector, region,
+                                               window_png)
+            yield name, png
+
+    def _capture_region(self, name, selector, region, window_png):
+        """
+        Return a screenshot (PNG bytes) of region (from SNAPSHOT_REGION_JS),
+        the screenshot name of the elements matching selector, or None, once
+        why is printed, if it couldn't be captured.
+
+        A region of a single element is captured with an element screenshot
+        if the driver can take them, which is found out by trying once for
+        each driver, so that a region is captured the same way every time.
+        The rest are cropped from the window's screenshot, which is taken
+        once, into window_png (a list).
+        """
+        if (region['count'] == 1
+                and ELEMENT_SCREENSHOTS.get(self.driver) is not False):
+            try:
+                # By.CSS_SELECTOR, without importing selenium.webdriver.
+                element = self.driver.find_element('css selector', selector)
+                png = element.screenshot_as_png
+            except WebDriverException as e:
+                if self.driver in ELEMENT_SCREENSHOTS:
+                    print("  ✗ {}: couldn't screenshot {}: {}".format(
+                        name, selector, e.msg or type(e).__name__))
+                    return None
+                ELEMENT_SCREENSHOTS[self.driver] = False  # Crop from now on.
+            else:
+                ELEMENT_SCREENSHOTS[self.driver] = True
+                return png
+        if not window_png:
+            window_png.append(self.driver.get_screenshot_as_png())
+        png = _crop_png(window_png[0], region['box'])
+        if png is None:
+            print('  ✗ {}: {} is outside the window'.format(name, selector))
+        return png
+
+    def _tolerance(self, test):
+        return (getattr(test, '__tolerance', None)
+                or getattr(self, 'tolerance', None))
+
+    def _diff(self, name, png, tolerance):
+        """
+        Return a seltest.diff.Diff of png against baseline name, or None if
+        there's no tolerance and NumPy isn't installed.
+        """
+        if not tolerance and not diff.available():
+            return None
+        return diff.diff(self._store.read(name), png, **(tolerance or {}))
+
+    def _screenshot_and_diff(self, name, png, image_dir, tolerance=None):
+        new_path = '{image_dir}/{name}.NEW.png'.format(image_dir=image_dir,
+                                                       name=name)
+        diff_path = '{0}/{1}.DIFF.png'.format(image_dir, name)
+        if not self._store.has(name):
             msg = '  • {0}: no screenshot found, creating for the first time.'
             print(msg.format(name))
-            self.driver.save_screenshot(old_path)
+            with self.profiler.phase('write'):
+                self._store.write(name, png, describe(png))
             return True
         else:
-            new_path = '{image_dir}/{name}.NEW.png'.format(image_dir=image_dir,
-                                                           name=name)
-            self.driver.save_screenshot(new_path)
-            if _are_same_files(new_path, old_path):
-                os.remove(new_path)
-                msg = '  ✓ {name}: no change'
-                print(msg.format(name=name))
+            with self.profiler.phase('compare'):
+                is_same, entry = self._store.matches(name, png)
+            result = None
+            if not is_same:
+                with self.profiler.phase('diff'):
+                    result = self._diff(name, png, tolerance)
+            if is_same or (result and result.passes):
+                for path in (new_path, diff_path):
+                    if os.path.isfile(path):  # Left over from a failed run.
+                        os.remove(path)
+                if is_same:
+                    msg = '  ✓ {name}: no change'
+                else:
+                    msg = ('  ✓ {name}: within tolerance '
+                           '({ratio:.3%} of pixels differ)')
+                print(msg.format(name=name, ratio=result and result.ratio))
                 return True
             else:
                 msg = ('  ✗ {name}: screenshots differ, '
                        'see {path}')
-                path = "{image_dir}/{name}.NEW.png".format(
-                    name=name, image_dir=image_dir)
-                print(msg.format(name=name, path=path))
-                if self.imgur_client_id:
-                    im = imgurpython.ImgurClient(self.imgur_client_id, None)
-                    image = im.upload_from_path(path)
-                    print('    uploaded image at {}'.format(image['link']))
+                print(msg.format(name=name, path=new_path))
+                with self.profiler.phase('write'):
+                    atomic_write(new_path, png)
+                if result:
+                    with self.profiler.phase('diff'):
+                        self._report_diff(result, name, diff_path)
+                elif entry.get('changed_tiles'):
+                    tiles = ', '.join('({}, {})'.format(*tile)
+                                      for tile in entry['changed_tiles'])
+                    print('    first changed {0}x{0} tiles (column, row): '
+                          '{1}'.format(TILE_SIZE, tiles))
+                if self.uploader:
+                    # Uploaded in the background; links are printed at the
+                    # end of the run.
+                    self.uploader.upload(name, new_path)
                 return False
 
-    def _update_screenshot(self, name, image_dir):
-        path = '{0}/{1}.png'.format(image_dir, name)
-        if not os.path.isfile(path):
+    def _report_diff(self, result, name, diff_path):
+        if result.mask is None:
+            print('    screenshots are different sizes')
+            return
+        atomic_write(diff_path, diff.mask_png(self._store.read(name),
+                                              result.mask))
+        boxes = ', '.join('({}, {}, {}, {})'.format(*box)
+                          for box in result.boxes[:MAX_REPORTED_BOXES])
+        if len(result.boxes) > MAX_REPORTED_BOXES:
+            boxes += ', ...'
+        print('    {:.3%} of pixels differ, in {} regions: {}; see {}'.format(
+            result.ratio, len(result.boxes), boxes, diff_path))
+
+    def _update_screenshot(self, name, png, image_dir, tolerance=None):
+        entry = None
+        if not self._store.has(name):
             msg = '  • {0}: creating for the first time.'
             print(msg.format(name))
         else:
-            new_path = '{0}/_{1}.png'.format(image_dir, name)
-            self.driver.save_screenshot(new_path)
-            if _are_same_files(new_path, path):
+            with self.profiler.phase('compare'):
+                is_same, entry = self._store.matches(name, png,
+                                                     early_exit=False)
+            if not is_same and tolerance:
+                with self.profiler.phase('diff'):
+                    is_same = self._diff(name, png, tolerance).passes
+            if is_same:
                 msg = '  ✓ {0}: no change'
                 print(msg.format(name))
+                return
             else:
                 msg = '  ✗ {0}: screenshots differ, updating'
                 print(msg.format(name))
-            os.remove(new_path)
-        self.driver.save_screenshot(path)
-
-
-def _ajax_is_complete(driver):
-    return driver.execute_script(GET_PENDING_REQUESTS_JS) == 0
+        with self.profiler.phase('write'):
+            self._store.write(name, png, entry)
+
+
+def _host_of(cls):
+    """
+    Return the host under test for test class cls, or None if not specified.
+    """
+    module = sys.modules[cls.__module__]
+    return getattr(cls, 'host', None) or getattr(module, 'host', None)
+
+
+def _window_sizes_of(cls):
+    """
+    Return list of the (width, height) window sizes test class cls takes
+    screenshots at: its (or its module's) window_size is either one size,
+    [WIDTH, HEIGHT], or a list of them.
+    """
+    module = sys.modules[cls.__module__]
+    window_size = (getattr(cls, 'window_size', None)
+                   or getattr(module, 'window_size', None)
+                   or DEFAULT_WINDOW_SIZE)
+    if all(isinstance(n, numbers.Number) for n in window_size):
+        window_size = [window_size]
+    sizes = []
+    for size in window_size:
+        if (len(size) != 2
+                or not all(isinstance(n, numbers.Number) for n in size)):
+            raise ValueError('`window_size` must be [WIDTH, HEIGHT], or a '
+                             'list of them.')
+        if tuple(size) not in sizes:
+            sizes.append(tuple(size))
+    return sizes
+
+
+def _screenshot_name(name, size, sizes):
+    """
+    Return the name of test name's screenshot at window size, one of sizes:
+    suffixed with _WIDTHxHEIGHT if there are several.
+    """
+    if len(sizes) == 1:
+        return name
+    return '{}_{}x{}'.format(name, *size)
+
+
+def _snapshot_selectors(cls, test):
+    """
+    Return list of the selectors of the regions test, of test class cls,
+    takes screenshots of (see seltest.helpers.snapshot), or [] if it takes
+    them of the whole window. The class' snapshot may be one selector, or a
+    list of them.
+    """
+    selectors = (getattr(test, '__snapshots', None)
+                 or getattr(cls, 'snapshot', None) or [])
+    if isinstance(selectors, (type(''), type(b''))):
+        selectors = [selectors]
+    return list(selectors)
+
+
+def _region_name(shot_name, idx, selectors):
+    """
+    Return the name of the screenshot of the idx-th of the regions selected
+    by selectors, in the screenshot shot_name: suffixed with _regionN if
+    there are several.
+    """
+    if len(selectors) <= 1:
+        return shot_name
+    return '{}_region{}'.format(shot_name, idx + 1)
+
+
+def _screenshot_names(cls, test):
+    """
+    Return list of the names of the screenshots test, of test class cls,
+    takes.
+    """
+    sizes = _window_sizes_of(cls)
+    selectors = _snapshot_selectors(cls, test)
+    return [_region_name(_screenshot_name(getattr(test, '__name'), size,
+                                          sizes), idx, selectors)
+            for size in sizes for idx in range(max(len(selectors), 1))]
+
+
+def _crop_png(png, box):
+    """
+    Return png (bytes) cropped to box, (left, top, right, bottom) in pixels,
+    or None if box is entirely outside it. Whatever of box is outside png is
+    cut off.
+    """
+    with Image.open(io.BytesIO(png)) as image:
+        width, height = image.size
+        left, top, right, bottom = box
+        box = (max(left, 0), max(top, 0), min(right, width),
+               min(bottom, height))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return None
+        out = io.BytesIO()
+        image.crop(box).save(out, 'PNG')
+    return out.getvalue()
+
+
+def _proxy_url(proxy_port, url, name, hidden_selectors):
+    """
+    Return the URL of url (relative to the host) on the proxy at proxy_port,
+    telling it which test it's for (name), and to hide the elements matching
+    hidden_selectors.
+    """
+    url = 'http://localhost:{}/{}'.format(proxy_port, url)
+    url, hash_sep, fragment = url.partition('#')
+    url += '&' if '?' in url else '?'
+    url += '{}={}'.format(TEST_PARAM, quote(name, safe=''))
+    if hidden_selectors:
+        url += '&{}={}'.format(HIDE_PARAM,
+                               encode_hide_param(hidden_selectors))
+    return url + hash_sep + fragment
 
 
 def _are_same_files(*args):
-    hashed = None
+    """
+    Return True if the PNGs at each path in args have the same pixels. Files
+    which are byte-for-byte identical to the first aren't decoded, and the
+    rest are decoded, but only hashed up to their first band of tiles which
+    differs.
+    """
+    first = None
     for path in args:
-        with Image.open(path) as i:
-            next_hashed = hashlib.sha512(i.tobytes()).hexdigest()
-            if hashed is not None:
-                if next_hashed != hashed:
-                    return False
-            hashed = next_hashed
+        with open(path, 'rb') as f:
+            described = describe(f.read(), first, early_exit=True)
+        if first is None:
+            first = described
+        elif described['pixel_hash'] != first['pixel_hash']:
+            return False
     return True
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Splitting tests into shards, to run on several machines, and the results
+files each shard writes, for `sel merge` to combine.
+
+Every machine must assign each test to the same shard, so assignment only
+depends on the tests' names, and (if given) the durations recorded for them:
+with durations, shards are balanced, longest test first; without, each test is
+assigned by a hash of its name, so adding a test doesn't move any others.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+import json
+import re
+
+from seltest import history
+from seltest.helpers import atomic_write
+
+
+RESULTS_VERSION = 1
+SHARD_RE = re.compile(r'^(\d+)/(\d+)$')
+
+
+def parse(shard):
+    """
+    Return (index, count) of shard, a string like '1/4', or None if it isn't
+    a valid shard (indices start from 1).
+    """
+    match = SHARD_RE.match(shard.strip())
+    if not match:
+        return None
+    index, count = int(match.group(1)), int(match.group(2))
+    if not 1 <= index <= count:
+        return None
+    return index, count
+
+
+def assign(names, count, durations=None):
+    """
+    Return list of count sets of names, one for each shard.
+
+    If durations (a dict of test name to seconds) has any of names, tests
+    are assigned longest first, to balance the shards (see
+    seltest.history.longest_first).
+    """
+    durations = durations or {}
+    if any(durations.get(name) is not None for name in names):
+        return [set(shard) for shard in history.longest_first(
+            history.estimates(names, durations), count)]
+    shards = [set() for _ in range(count)]
+    for name in names:
+        digest = hashlib.sha1(name.encode('utf-8')).hexdigest()
+        shards[int(digest, 16) % count].add(name)
+    return shards
+
+
+def write_results(path, command, results, durations, shard=None):
+    """
+    Write the results of running (or updating, per command) tests to path,
+    as JSON.
+
+    results maps the name of each test to whether it passed, durations to how
+    long it took in seconds, and shard is the (index, count) of the shard
+    they were, if any.
+    """
+    tests = dict((name, {'passed': bool(passed),
+                         'duration': _round(durations.get(name))})
+                 for name, passed in results.items())
+    save_results(path, {'version': RESULTS_VERSION,
+                        'command': command,
+                        'shards': [list(shard)] if shard else [],
+                        'tests': tests})
+
+
+def save_results(path, results):
+    """
+    Write results (see load_results), e.g. those merged by merge, to path.
+    """
+    atomic_write(path, json.dumps(results, indent=1,
+                                  sort_keys=True).encode('utf-8'))
+
+
+def load_results(path):
+    """
+    Return the results written to path by write_results, or None if there
+    aren't any there.
+    """
+    try:
+        with open(path) as f:
+            results = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if results.get('version') != RESULTS_VERSION:
+        return None
+    return results
+
+
+def durations_of(results):
+    """
+    Return dict of the name of each test in results (see load_results) to
+    how long it took, for assign.
+    """
+    return dict((name, test['duration'])
+                for name, test in results['tests'].items()
+                if test.get('duration') is not None)
+
+
+def merge(all_results):
+    """
+    Return results combining the list of results all_results (see
+    load_results), e.g. of each shard of a run.
+    """
+    merged = {'version': RESULTS_VERSION, 'command': None, 'shards': [],
+              'tests': {}}
+    for results in all_results:
+        merged['command'] = merged['command'] or results.get('command')
+        merged['shards'].extend(results['shards'])
+        merged['tests'].update(results['tests'])
+    merged['shards'].sort()
+    return merged
+
+
+def missing_shards(results):
+    """
+    Return sorted list of the indices of the shards results (see
+    load_results) should have, but doesn't.
+    """
+    counts = set(count for _, count in results['shards'])
+    have = set(index for index, _ in results['shards'])
+    return sorted(set(index for count in counts
+                      for index in range(1, count + 1)) - have)
+
+
+def _round(duration):
+    return None if duration is None else round(duration, 3)
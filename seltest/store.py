@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+"""
+Where baseline screenshots are kept.
+
+By default, each baseline is a NAME.png file in the image directory (a
+FlatStore), which is easy to look at, and to diff under version control.
+
+A BlobStore instead keeps baselines in the image directory's store/
+directory, for suites with so many that checking out or syncing them all is
+slow. Each distinct image is stored once, as a blob named by the hash of its
+pixels (see seltest.baselines.describe), re-encoded at PNG's highest
+compression, and index.json maps the name of each baseline to its blob's
+hash. Blobs start out loose, one per file, and can be packed into a few large
+files by `sel gc --pack`. Each blob's tiles (see seltest.baselines) are kept
+beside them:
+
+    store/index.json
+    store/blobs/ab/ab12...png
+    store/packs/pack-cd34....pack
+    store/packs/pack-cd34....json  (the offset and length of each blob)
+    store/tiles/ab/ab12...
+
+`sel migrate` moves baselines from one kind of store to the other. Whichever
+is in the image directory is used.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import PIL.Image as Image
+
+import contextlib
+import glob
+import hashlib
+import io
+import json
+import os
+import shutil
+
+from seltest.baselines import (Manifest, describe, read_tiles, remove_tiles,
+                               write_tiles)
+from seltest.helpers import atomic_write, file_lock, makedirs
+
+
+STORE_DIRNAME = 'store'
+INDEX_FILENAME = 'index.json'
+STORE_VERSION = 1
+PACK_SIZE = 256 * 1024 * 1024  # bytes; packs are started anew past this.
+KINDS = ('flat', 'blobs')
+
+
+def open_store(image_dir):
+    """
+    Return the store of the baselines in image_dir: a BlobStore if there's
+    one there, otherwise a FlatStore.
+    """
+    if os.path.isfile(os.path.join(image_dir, STORE_DIRNAME,
+                                   INDEX_FILENAME)):
+        return BlobStore(image_dir)
+    return FlatStore(image_dir)
+
+
+def new_store(image_dir, kind):
+    """
+    Return a store of kind (one of KINDS) for the baselines in image_dir.
+    """
+    return {'flat': FlatStore, 'blobs': BlobStore}[kind](image_dir)
+
+
+def migrate(source, target):
+    """
+    Return the number of baselines moved from store source to store target,
+    which replaces it. Nothing is removed from source until all of its
+    baselines are in target, and if moving any fails (or is interrupted),
+    target is removed, leaving source as it was.
+    """
+    names = source.names()
+    try:
+        with target.batch():
+            for name in names:
+                target.write(name, source.read(name))
+    except BaseException:
+        target.delete()
+        raise
+    source.delete()
+    return len(names)
+
+
+class FlatStore(object):
+    """
+    Baselines kept as NAME.png files in image_dir, described by a
+    seltest.baselines.Manifest.
+    """
+    kind = 'flat'
+
+    def __init__(self, image_dir):
+        self.image_dir = image_dir
+        self._manifest = Manifest(image_dir)
+
+    def names(self):
+        """
+        Return sorted list of the names of the baselines in the store.
+        """
+        names = []
+        for path in glob.glob(os.path.join(self.image_dir, '*.png')):
+            name = os.path.basename(path)[:-len('.png')]
+            if not name.endswith(('.NEW', '.DIFF')):
+                names.append(name)
+        return sorted(names)
+
+    def has(self, name):
+        return os.path.isfile(self._path(name))
+
+    def pixel_hash(self, name):
+        """
+        Return the hash of the pixels of baseline name (see
+        seltest.baselines.describe), or None if there's no such baseline.
+        """
+        if not self.has(name):
+            return None
+        return self._manifest.entry(name, self._path(name))['pixel_hash']
+
+    def read(self, name):
+        """
+        Return the PNG (bytes) of baseline name.
+        """
+        with open(self._path(name), 'rb') as f:
+            return f.read()
+
+    def matches(self, name, png, early_exit=True):
+        """
+        Return (is_same, entry), as seltest.baselines.Manifest.matches does,
+        for the screenshot png against baseline name.
+        """
+        return self._manifest.matches(name, self._path(name), png,
+                                      early_exit)
+
+    def write(self, name, png, entry=None):
+        """
+        Make png (bytes) baseline name. entry is its description (see
+        seltest.baselines.describe), if it's already been computed.
+        """
+        atomic_write(self._path(name), png)
+        self._manifest.record(name, self._path(name), entry or describe(png))
+
+    def batch(self):
+        """
+        Return a context manager deferring bookkeeping for the baselines
+        written in it until its end (see seltest.baselines.Manifest.batch).
+        """
+        return self._manifest.batch()
+
+    def delete(self):
+        """
+        Remove every baseline, and the manifest.
+        """
+        for name in self.names():
+            os.remove(self._path(name))
+        self._manifest.delete()
+
+    def _path(self, name):
+        return os.path.join(self.image_dir, '{}.png'.format(name))
+
+
+class BlobStore(object):
+    """
+    Baselines kept as blobs, named by the hashes of their pixels, in
+    image_dir's store directory (see above).
+
+    Like the manifest, safe to share between processes: the index is updated
+    under a lock, and blobs are only ever added while tests run.
+    """
+    kind = 'blobs'
+
+    def __init__(self, image_dir):
+        self.image_dir = image_dir
+        self.path = os.path.join(image_dir, STORE_DIRNAME)
+        self._index_path = os.path.join(self.path, INDEX_FILENAME)
+        self._tiles_dir = os.path.join(self.path, 'tiles')
+        self._baselines, self._blobs = self._read()
+        self._packed = None  # hash -> (pack path, offset, length), once read.
+        self._pending = None  # Changes deferred by batch.
+
+    def names(self):
+        return sorted(self._baselines)
+
+    def has(self, name):
+        return name in self._baselines
+
+    def pixel_hash(self, name):
+        return self._baselines.get(name)
+
+    def read(self, name):
+        return self._read_blob(self._baselines[name])
+
+    def matches(self, name, png, early_exit=True):
+        pixel_hash = self._baselines[name]
+        baseline = dict(self._blobs[pixel_hash], pixel_hash=pixel_hash)
+        # Tiles are only needed if the bytes differ (and older versions kept
+        # them in the index).
+        if ('tiles' not in baseline
+                and hashlib.sha1(png).hexdigest() != baseline['file_hash']):
+            tiles = read_tiles(self._tiles_dir, pixel_hash)
+            if tiles is None:  # Removed since; compute them again.
+                tiles = describe(self.read(name))['tiles']
+                write_tiles(self._tiles_dir, dict(baseline, tiles=tiles))
+            baseline['tiles'] = tiles
+        entry = describe(png, baseline, early_exit)
+        return entry['pixel_hash'] == pixel_hash, entry
+
+    def write(self, name, png, entry=None):
+        entry = entry or describe(png)
+        pixel_hash = entry['pixel_hash']
+        if not self._has_blob(pixel_hash):
+            path = self._blob_path(pixel_hash)
+            makedirs(os.path.dirname(path))
+            atomic_write(path, _compress(png))
+        if 'tiles' in entry:
+            write_tiles(self._tiles_dir, entry)
+        blob = dict((key, entry[key]) for key in ('file_hash', 'size'))
+        self._update({name: pixel_hash}, {pixel_hash: blob})
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Write the index once, at the end of the block, rather than for each
+        baseline written in it. Nested blocks are part of the outermost one.
+        """
+        if self._pending is not None:
+            yield
+            return
+        self._pending = ({}, {})
+        try:
+            yield
+        finally:
+            pending, self._pending = self._pending, None
+            if pending[0]:
+                self._update(*pending)
+
+    def delete(self):
+        shutil.rmtree(self.path)
+        self._baselines, self._blobs, self._packed = {}, {}, {}
+
+    def gc(self, names, pack=False):
+        """
+        Return (baselines, blobs): the number of baselines removed from the
+        store, because they aren't in names, and the number of blobs removed,
+        because no baseline's image is in them.
+
+        Packs only some of whose blobs are referenced are kept, unless pack,
+        in which case all the blobs left are packed into as few packs as
+        possible, replacing the loose blobs and old packs.
+        """
+        names = set(names)
+        with file_lock(self._index_path):
+            self._baselines, self._blobs = self._read()
+            removed = [name for name in self._baselines if name not in names]
+            for name in removed:
+                del self._baselines[name]
+            live = set(self._baselines.values())
+            for pixel_hash in set(self._blobs) - live:
+                del self._blobs[pixel_hash]
+                remove_tiles(self._tiles_dir, pixel_hash)
+            self._write_index()
+            loose = self._loose_blobs()
+            packed = self._read_packs()
+            packs = set(path for path, _, _ in packed.values())
+            if pack:
+                kept_packs = self._write_packs(sorted(live))
+                kept = live
+                gone = set(loose)
+            else:
+                kept_packs = set(path for pixel_hash, (path, _, _)
+                                 in packed.items() if pixel_hash in live)
+                gone = set(loose) - live
+                kept = (set(loose) - gone) | set(
+                    pixel_hash for pixel_hash, (path, _, _) in packed.items()
+                    if path in kept_packs)
+            for path in packs - kept_packs:
+                _remove_pack(path)
+            for pixel_hash in gone:
+                os.remove(loose[pixel_hash])
+            self._packed = None
+        return len(removed), len((set(loose) | set(packed)) - kept)
+
+    def _update(self, baselines, blobs):
+        """
+        Add baselines, a dict of baseline name to the hash of its blob, and
+        blobs, a dict of hash to its blob's description, to the index.
+        """
+        if self._pending is not None:
+            self._pending[0].update(baselines)
+            self._pending[1].update(blobs)
+            self._baselines.update(baselines)
+            self._blobs.update(blobs)
+            return
+        makedirs(self.path)
+        with file_lock(self._index_path):
+            self._baselines, self._blobs = self._read()
+            self._baselines.update(baselines)
+            for pixel_hash, blob in blobs.items():
+                self._blobs.setdefault(pixel_hash, blob)
+            self._write_index()
+
+    def _read(self):
+        try:
+            with open(self._index_path) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            return {}, {}
+        if index.get('version') != STORE_VERSION:
+            return {}, {}
+        return index['baselines'], index['blobs']
+
+    def _write_index(self):
+        atomic_write(self._index_path, json.dumps(
+            {'version': STORE_VERSION, 'baselines': self._baselines,
+             'blobs': self._blobs},
+            indent=1, sort_keys=True).encode('utf-8'))
+
+    def _blob_path(self, pixel_hash):
+        return os.path.join(self.path, 'blobs', pixel_hash[:2],
+                            '{}.png'.format(pixel_hash))
+
+    def _has_blob(self, pixel_hash):
+        if os.path.isfile(self._blob_path(pixel_hash)):
+            return True
+        if self._packed is None:
+            self._packed = self._read_packs()
+        return pixel_hash in self._packed
+
+    def _read_blob(self, pixel_hash):
+        try:
+            with open(self._blob_path(pixel_hash), 'rb') as f:
+                return f.read()
+        except IOError:
+            pass
+        if self._packed is None or pixel_hash not in self._packed:
+            self._packed = self._read_packs()  # Maybe it's since been packed.
+        path, offset, length = self._packed[pixel_hash]
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def _loose_blobs(self):
+        """
+        Return dict of the hash of each loose blob to its path.
+        """
+        paths = glob.glob(os.path.join(self.path, 'blobs', '*', '*.png'))
+        return dict((os.path.basename(path)[:-len('.png')], path)
+                    for path in paths)
+
+    def _read_packs(self):
+        """
+        Return dict of the hash of each packed blob to (path of its pack,
+        offset, length).
+        """
+        packed = {}
+        for index_path in glob.glob(os.path.join(self.path, 'packs',
+                                                 'pack-*.json')):
+            pack_path = index_path[:-len('.json')] + '.pack'
+            with open(index_path) as f:
+                for pixel_hash, (offset, length) in json.load(f).items():
+                    packed[pixel_hash] = (pack_path, offset, length)
+        return packed
+
+    def _write_packs(self, hashes):
+        """
+        Return set of the paths of new packs, of up to about PACK_SIZE bytes
+        each, written with the blobs hashes (a list).
+        """
+        makedirs(os.path.join(self.path, 'packs'))
+        tmp_path = os.path.join(self.path, 'packs',
+                                'new-{}.pack.tmp'.format(os.getpid()))
+        pack_paths = set()
+        hashes = iter(hashes)
+        pixel_hash = next(hashes, None)
+        while pixel_hash is not None:
+            offsets = {}
+            digest = hashlib.sha1()
+            with open(tmp_path, 'wb') as f:
+                while pixel_hash is not None and f.tell() < PACK_SIZE:
+                    data = self._read_blob(pixel_hash)
+                    offsets[pixel_hash] = [f.tell(), len(data)]
+                    digest.update(data)
+                    f.write(data)
+                    pixel_hash = next(hashes, None)
+            pack_path = os.path.join(self.path, 'packs', 'pack-{}.pack'.format(
+                digest.hexdigest()))
+            os.rename(tmp_path, pack_path)
+            # A pack is only read once its index exists.
+            atomic_write(pack_path[:-len('.pack')] + '.json',
+                         json.dumps(offsets, sort_keys=True).encode('utf-8'))
+            pack_paths.add(pack_path)
+        return pack_paths
+
+
+def _remove_pack(path):
+    os.remove(path[:-len('.pack')] + '.json')
+    os.remove(path)
+
+
+def _compress(png):
+    """
+    Return png (bytes) re-encoded at PNG's highest compression, or png itself
+    if that's no smaller.
+    """
+    with Image.open(io.BytesIO(png)) as image:
+        out = io.BytesIO()
+        image.save(out, 'PNG', optimize=True)
+    return min(png, out.getvalue(), key=len)
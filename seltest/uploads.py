@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Uploading the images of failed tests, in the background.
+
+Images are uploaded to imgur's image API (or a stand-in for it, at another
+endpoint) by a few threads sharing one HTTP session, so tests carry on while
+they upload. Uploads which fail for reasons which may pass (the connection
+failing, or a 429 or 5xx response) are retried, with backoff.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import base64
+import threading
+import time
+try:  # py2
+    from Queue import Queue
+except ImportError:  # py3
+    from queue import Queue
+
+
+UPLOAD_ENDPOINT = 'https://api.imgur.com/3/image'
+UPLOAD_THREADS = 4
+UPLOAD_QUEUE_SIZE = 16  # Tests wait to queue more uploads than this.
+UPLOAD_TIMEOUT = 30  # seconds
+UPLOAD_ATTEMPTS = 3
+RETRY_DELAY = 1  # seconds, doubling after each attempt.
+
+
+class Uploader(object):
+    """
+    Uploads images in the background, with the API client ID client_id, to
+    endpoint, which takes them as imgur's image API does.
+    """
+    def __init__(self, client_id, endpoint=UPLOAD_ENDPOINT,
+                 threads=UPLOAD_THREADS):
+        import requests  # Only needed here, and slow to import.
+        self.endpoint = endpoint
+        self._session = requests.Session()
+        self._session.headers['Authorization'] = 'Client-ID {}'.format(
+            client_id)
+        self._queue = Queue(UPLOAD_QUEUE_SIZE)
+        self._uploads = []  # [name, path, link, error] for each, in order.
+        self._threads = []
+        for _ in range(threads):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True  # Don't hold up exiting if interrupted.
+            thread.start()
+            self._threads.append(thread)
+
+    def upload(self, name, path):
+        """
+        Upload the image of test name at path, in the background.
+        """
+        upload = [name, path, None, None]
+        self._uploads.append(upload)
+        self._queue.put(upload)
+
+    def finish(self):
+        """
+        Return list of (name, link, error) for each image uploaded, in the
+        order they were queued, once they all have been (or have failed to
+        be, for error), stopping the uploading threads.
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._session.close()
+        return [(name, link, error) for name, _, link, error in self._uploads]
+
+    def _work(self):
+        for upload in iter(self._queue.get, None):
+            try:
+                upload[2] = self._upload(upload[1])
+            except Exception as e:
+                upload[3] = '{}'.format(e) or type(e).__name__
+
+    def _upload(self, path):
+        """
+        Return the link to the image at path, once uploaded.
+        """
+        import requests
+        with open(path, 'rb') as f:
+            data = {'image': base64.b64encode(f.read()), 'type': 'base64'}
+        for attempt in range(UPLOAD_ATTEMPTS):
+            if attempt:
+                time.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+            try:
+                response = self._session.post(self.endpoint, data=data,
+                                              timeout=UPLOAD_TIMEOUT)
+            except requests.RequestException as e:
+                error = e
+                continue
+            if response.status_code == 429 or response.status_code >= 500:
+                error = 'HTTP {}'.format(response.status_code)
+                continue
+            if response.status_code != 200:
+                raise ValueError('HTTP {}: {}'.format(response.status_code,
+                                                      response.text[:200]))
+            return response.json()['data']['link']
+        raise ValueError('gave up after {} attempts: {}'.format(
+            UPLOAD_ATTEMPTS, error))
+
+
+def print_uploads(uploaded):
+    """
+    Print the links to the images uploaded (see Uploader.finish), if any.
+    """
+    if not uploaded:
+        return
+    print('Uploaded images of failed tests:')
+    for name, link, error in uploaded:
+        if error:
+            print('  ✗ {}: upload failed: {}'.format(name, error))
+        else:
+            print('  {}: {}'.format(name, link))
+
+
+class Deferred(object):
+    """
+    Collects the images given to upload, for an Uploader in another process
+    (see seltest.cli._work) to upload.
+    """
+    def __init__(self):
+        self.images = []
+
+    def upload(self, name, path):
+        self.images.append((name, path))
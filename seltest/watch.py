@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Finding the files which have changed, and the tests they affect, for `sel
+watch`.
+
+Files are polled for changes to their modification times, which works the
+same everywhere, and is quick enough for the directories of an app.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import os
+try:  # py2
+    from urllib import unquote
+    from urlparse import urlparse
+except ImportError:  # py3
+    from urllib.parse import unquote, urlparse
+
+
+# Directories not worth watching, which can be huge. Hidden ones are skipped
+# too.
+SKIP_DIRS = ('node_modules', '__pycache__')
+
+
+def snapshot(dirs, ignore=()):
+    """
+    Return dict of the path of each file in dirs (and their subdirectories)
+    to its modification time. Hidden files and directories, SKIP_DIRS, and
+    the paths in ignore (and whatever's in them) are skipped.
+    """
+    ignore = set(os.path.abspath(path) for path in ignore)
+    mtimes = {}
+    for top in dirs:
+        for root, dirnames, filenames in os.walk(top):
+            dirnames[:] = [d for d in dirnames
+                           if not d.startswith('.') and d not in SKIP_DIRS
+                           and os.path.abspath(os.path.join(root, d))
+                           not in ignore]
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                if filename.startswith('.') or os.path.abspath(path) in ignore:
+                    continue
+                try:
+                    mtimes[path] = os.stat(path).st_mtime
+                except OSError:
+                    pass  # Removed since it was listed.
+    return mtimes
+
+
+def changed_files(old, new):
+    """
+    Return set of the paths of files added, removed or modified between
+    snapshots old and new.
+    """
+    return set(path for path in set(old) | set(new)
+               if old.get(path) != new.get(path))
+
+
+def tests_using_files(paths, dirs, served):
+    """
+    Return (tests, unmatched): the set of names of the tests in served (a
+    dict of test name to the urls served for it) which loaded one of the
+    files at paths, and the list of those paths no test loaded.
+
+    A test loaded a file if the path of one of its urls ends with the path of
+    the file relative to the one of dirs it's in; e.g. /static/app.css for
+    static/app.css in the app's directory.
+    """
+    url_paths = {}  # test name -> paths of its urls
+    for name, urls in served.items():
+        url_paths[name] = [unquote(urlparse(url).path) for url in urls]
+    tests = set()
+    unmatched = []
+    for path in paths:
+        suffix = '/' + _relative_path(path, dirs)
+        matched = set(name for name, test_paths in url_paths.items()
+                      if any(p.endswith(suffix) for p in test_paths))
+        if matched:
+            tests.update(matched)
+        else:
+            unmatched.append(path)
+    return tests, unmatched
+
+
+def tests_using_urls(urls, served):
+    """
+    Return set of the names of the tests in served (see tests_using_files)
+    which loaded any of urls.
+    """
+    return set(name for name, test_urls in served.items()
+               if any(url in test_urls for url in urls))
+
+
+def _relative_path(path, dirs):
+    path = os.path.abspath(path)
+    for top in dirs:
+        top = os.path.abspath(top)
+        if path.startswith(top + os.sep):
+            return os.path.relpath(path, top).replace(os.sep, '/')
+    return os.path.basename(path)
@@ -20,8 +20,10 @@ setup(name='seltest',
                         'docopt',
                         'Pillow',
                         'flask',
-                        'requests',
-                        'imgurpython'],
+                        'requests'],
+      extras_require={
+          'diff': ['numpy']
+      },
       entry_points={
           'console_scripts': [
              'sel = seltest.cli:main',
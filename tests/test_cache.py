@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+try:  # py3
+    from unittest import mock
+except ImportError:  # py2
+    import mock
+
+from seltest import cache
+
+
+URL = 'http://localhost:8000/app.js'
+HEADERS = {'Cache-Control': 'max-age=60'}
+
+
+class AssetCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='seltest-test-')
+        self.index_path = os.path.join(self.directory, cache.INDEX_FILENAME)
+        self.cache = cache.AssetCache(self.directory, 1024 * 1024)
+        self.addCleanup(self.cache.flush)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _store(self, url=URL, body=b'var a;'):
+        self.cache.store(url, {}, 200, HEADERS, body)
+
+    def test_index_saved_once_for_many_stores(self):
+        for i in range(3):
+            self._store('{}?v={}'.format(URL, i))
+        self.assertFalse(os.path.exists(self.index_path))
+        self.cache.flush()
+        self.assertTrue(os.path.exists(self.index_path))
+        mtime = os.stat(self.index_path).st_mtime
+        self.cache.flush()  # Nothing's changed since.
+        self.assertEqual(os.stat(self.index_path).st_mtime, mtime)
+
+    def test_reload(self):
+        self._store()
+        self.cache.flush()
+        reloaded = cache.AssetCache(self.directory, 1024 * 1024)
+        entry, is_fresh = reloaded.lookup(URL, {})
+        self.assertTrue(is_fresh)
+        self.assertEqual(b''.join(reloaded.read(entry, 1024)), b'var a;')
+
+    @mock.patch.object(cache, 'SAVE_DELAY', 0.01)
+    def test_saved_after_delay(self):
+        self._store()
+        self.cache._save_timer.join()
+        self.assertTrue(os.path.exists(self.index_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import PIL.Image as Image
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+try:  # py3
+    from unittest import mock
+except ImportError:  # py2
+    import mock
+
+from seltest import Base, dependencies
+
+
+host = 'localhost:8000'
+URL = 'http://localhost:8000/'
+
+
+class Panel(Base):
+    def one(self, driver):
+        pass
+
+
+def _png(color):
+    out = io.BytesIO()
+    Image.new('RGB', (40, 30), color).save(out, 'PNG')
+    return out.getvalue()
+
+
+class ChangedTestsTest(unittest.TestCase):
+    def setUp(self):
+        self.image_dir = tempfile.mkdtemp(prefix='seltest-test-')
+        self.baseline = os.path.join(self.image_dir, 'panel_one.png')
+        self._write_baseline('white')
+        dependencies.record(
+            self.image_dir, [Panel], {'panel_one': True},
+            {'panel_one': {URL: {'status': 200, 'hash': 'abc'}}})
+        # Nothing served for the test has changed.
+        patcher = mock.patch.object(dependencies, 'changed_urls',
+                                    return_value=set())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.image_dir)
+
+    def _write_baseline(self, color, mtime=None):
+        with open(self.baseline, 'wb') as f:
+            f.write(_png(color))
+        if mtime is not None:
+            os.utime(self.baseline, (mtime, mtime))
+
+    def _changed(self):
+        return dependencies.changed_tests(
+            dependencies.load(self.image_dir), [Panel], self.image_dir)
+
+    def test_unchanged(self):
+        self.assertEqual(self._changed(), set())
+
+    def test_replaced_baseline(self):
+        self._write_baseline('black',
+                             mtime=os.stat(self.baseline).st_mtime + 10)
+        self.assertEqual(self._changed(), set(['panel_one']))
+
+    def test_missing_baseline(self):
+        os.remove(self.baseline)
+        self.assertEqual(self._changed(), set(['panel_one']))
+
+    def test_rewritten_baseline_with_same_pixels(self):
+        self._write_baseline('white',
+                             mtime=os.stat(self.baseline).st_mtime + 10)
+        self.assertEqual(self._changed(), set())
+
+    def test_unrecorded(self):
+        dependencies.record(self.image_dir, [Panel], {'panel_one': False},
+                            {})
+        self.assertEqual(self._changed(), set(['panel_one']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import textwrap
+import unittest
+
+from seltest import index
+
+
+def _index(source):
+    return index.index_source(textwrap.dedent(source), 'test_a.py')
+
+
+def _test_names(module):
+    return [test['name'] for cls in module['classes'] for test in cls['tests']]
+
+
+def _imported_test_names(source):
+    namespace = {'__name__': __name__}
+    exec(textwrap.dedent(source), namespace)
+    return [getattr(method, '__name')
+            for method in getattr(namespace['A'], '__test_methods')]
+
+
+class IndexSourceTest(unittest.TestCase):
+    def test_tests(self):
+        module = _index("""
+            from seltest import Base, url
+
+            class A(Base):
+                base_url = 'app'
+
+                @url('/page')
+                def page(self, driver):
+                    pass
+
+                def _helper(self):
+                    pass
+            """)
+        self.assertFalse(module['dynamic'])
+        self.assertEqual(_test_names(module), ['a_page'])
+        self.assertEqual(module['classes'][0]['tests'][0]['url'], 'app/page')
+
+    def test_methods_which_arent_functions(self):
+        source = """
+            from seltest import Base
+
+            class A(Base):
+                @staticmethod
+                def helper():
+                    pass
+
+                @classmethod
+                def factory(cls):
+                    pass
+
+                @property
+                def prop(self):
+                    pass
+
+                @prop.setter
+                def prop(self, value):
+                    pass
+
+                def page(self, driver):
+                    pass
+            """
+        module = _index(source)
+        self.assertFalse(module['dynamic'])
+        self.assertEqual(_test_names(module), ['a_page'])
+        self.assertEqual(_imported_test_names(source), ['a_page'])
+
+    def test_assigned_functions(self):
+        source = """
+            from seltest import Base
+
+            class A(Base):
+                other = lambda self, driver: None
+
+                def page(self, driver):
+                    pass
+            """
+        self.assertTrue(_index(source)['dynamic'])
+        self.assertEqual(_imported_test_names(source), ['a_other', 'a_page'])
+
+    def test_functions_defined_conditionally(self):
+        module = _index("""
+            from seltest import Base
+
+            class A(Base):
+                if True:
+                    def other(self, driver):
+                        pass
+            """)
+        self.assertTrue(module['dynamic'])
+
+    def test_literal_and_private_assignments(self):
+        module = _index("""
+            from seltest import Base
+
+            class A(Base):
+                window_size = [1024, 768]
+                _helper = lambda self: None
+
+                def page(self, driver):
+                    pass
+            """)
+        self.assertFalse(module['dynamic'])
+        self.assertEqual(_test_names(module), ['a_page'])
+
+
+if __name__ == '__main__':
+    unittest.main()
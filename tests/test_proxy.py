@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import unittest
+
+from seltest import proxy
+
+
+class WithNoCacheTest(unittest.TestCase):
+    def test_added(self):
+        self.assertEqual(proxy._with_no_cache(''), 'no-cache')
+        self.assertEqual(proxy._with_no_cache('public,max-age=60'),
+                         'public, max-age=60, no-cache')
+
+    def test_upstream_directives_kept(self):
+        self.assertEqual(proxy._with_no_cache('private, max-age=60'),
+                         'private, max-age=60, no-cache')
+        self.assertEqual(proxy._with_no_cache('no-store'), 'no-store')
+        self.assertEqual(proxy._with_no_cache('No-Cache'), 'No-Cache')
+
+
+if __name__ == '__main__':
+    unittest.main()
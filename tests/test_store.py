@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import PIL.Image as Image
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from seltest import store
+
+
+def _png(color):
+    out = io.BytesIO()
+    Image.new('RGB', (40, 30), color).save(out, 'PNG')
+    return out.getvalue()
+
+
+class MigrateTest(unittest.TestCase):
+    def setUp(self):
+        self.image_dir = tempfile.mkdtemp(prefix='seltest-test-')
+        self.flat = store.FlatStore(self.image_dir)
+        self.flat.write('a', _png('white'))
+        self.flat.write('c', _png('black'))
+
+    def tearDown(self):
+        shutil.rmtree(self.image_dir)
+
+    def test_migrate(self):
+        target = store.new_store(self.image_dir, 'blobs')
+        self.assertEqual(store.migrate(self.flat, target), 2)
+        baselines = store.open_store(self.image_dir)
+        self.assertEqual(baselines.kind, 'blobs')
+        self.assertEqual(baselines.names(), ['a', 'c'])
+        self.assertEqual(baselines.matches('c', _png('black'))[0], True)
+        self.assertEqual(self.flat.names(), [])
+
+    def test_failed_migrate_leaves_source(self):
+        with open(os.path.join(self.image_dir, 'b.png'), 'wb') as f:
+            f.write(b'not a PNG')  # Fails partway through, after a.
+        target = store.new_store(self.image_dir, 'blobs')
+        with self.assertRaises(Exception):
+            store.migrate(self.flat, target)
+        self.assertFalse(os.path.exists(target.path))
+        baselines = store.open_store(self.image_dir)
+        self.assertEqual(baselines.kind, 'flat')
+        self.assertEqual(baselines.names(), ['a', 'b', 'c'])
+        self.assertEqual(baselines.matches('a', _png('white'))[0], True)
+
+
+if __name__ == '__main__':
+    unittest.main()